@@ -12,7 +12,7 @@ class Admin(User):
         Initialize an Admin object.
 
         Args:
-            user_id (str): Unique identifier for the admin.
+            user_id (int): Unique identifier for the admin.
             name (str): Name of the admin.
             email (str): Email address of the admin.
             password (str): Password for admin authentication.
@@ -35,7 +35,7 @@ class Admin(User):
 
     def view_sales(self, sales_reports):
         """
-        Display sales reports.
+        Display the sales totals of each report, read from their rollups.
 
         Args:
             sales_reports (list or dict): Collection of sales reports to be displayed.
@@ -43,6 +43,8 @@ class Admin(User):
         Returns:
             None
         """
+        if hasattr(sales_reports, "values"):
+            sales_reports = sales_reports.values()
         print("Sales Reports:")
         for report in sales_reports:
-            print(report)
+            print(report.summary())
@@ -0,0 +1,365 @@
+# benchmarks.py
+#
+# Micro-benchmarks for the storage and pricing paths of the ticketing system.
+# Run with:  python benchmarks.py
+# All data is written to a temporary folder; the real data/ files are never touched.
+
+import contextlib
+import copyreg
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import pricing
+from constants import TICKET_PRICES, TICKET_VALIDITY
+from data_storage import DataStorage
+from group_commit import GroupCommitter
+from write_ahead_log import WriteAheadLog
+from user import User
+from ticket import Ticket
+from ticket_block import TicketBlock
+from purchase_history import PurchaseHistory
+from pricing import PricingEngine
+from record_format import TicketRecordFormat, TICKET_TYPE_CODES
+from utils import Utils
+
+
+def _make_user(index, tickets_per_user):
+    user = User(Utils.generate_unique_id(), f"Customer {index}", f"customer{index}@example.com", "password")
+    for _ in range(tickets_per_user):
+        ticket = Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2025-01-01")
+        ticket.set_validity_dates(user)
+        user.purchase_history.append(ticket)
+    return user
+
+
+def _time_per_call(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def benchmark_wal_purchase_cost(user_counts=(100, 1000, 10000), tickets_per_user=5, purchases=20):
+    """
+    Compare the per-purchase write cost of a full users.pkl rewrite with a write-ahead log append.
+
+    The full rewrite grows with the number of stored customers; the log append stays flat.
+    """
+    print("Per-purchase write cost (ms)")
+    print(f"{'users':>8} {'full save':>12} {'log append':>12}")
+    folder = tempfile.mkdtemp()
+    try:
+        for user_count in user_counts:
+            filename = os.path.join(folder, f"users_{user_count}.pkl")
+            users = {}
+            for index in range(user_count):
+                user = _make_user(index, tickets_per_user)
+                users[user.email] = user
+            with contextlib.redirect_stdout(io.StringIO()):
+                DataStorage.save_to_file(users, filename)
+            buyer = next(iter(users.values()))
+
+            def full_save():
+                ticket = Ticket(Utils.generate_unique_id(), "Two-Day Pass", 480, "2 Days", "2025-01-02")
+                buyer.purchase_history.append(ticket)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    DataStorage.save_to_file(users, filename)
+
+            def log_append():
+                ticket = Ticket(Utils.generate_unique_id(), "Two-Day Pass", 480, "2 Days", "2025-01-02")
+                buyer.purchase_history.append(ticket)
+                DataStorage.append_changes(
+                    [WriteAheadLog.extend_record(buyer.email, "purchase_history", [ticket])],
+                    filename
+                )
+
+            full_ms = _time_per_call(full_save, purchases)
+            append_ms = _time_per_call(log_append, purchases)
+            print(f"{user_count:>8} {full_ms:>12.3f} {append_ms:>12.3f}")
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_group_commit(kiosks=32, sales_per_kiosk=25, window=0.002):
+    """
+    Measure sales per second when many kiosks persist a sale (report + tickets) at the same time,
+    with one fsync per sale versus group commit.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        users_file = os.path.join(folder, "users.pkl")
+        reports_file = os.path.join(folder, "sales_reports.pkl")
+        with contextlib.redirect_stdout(io.StringIO()):
+            DataStorage.save_to_file({f"kiosk{n}@example.com": _make_user(n, 0) for n in range(kiosks)}, users_file)
+
+        def sale_changes(kiosk):
+            ticket = Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2025-01-01")
+            return {
+                reports_file: [WriteAheadLog.set_record(ticket.ticket_id, ticket.price)],
+                users_file: [WriteAheadLog.extend_record(f"kiosk{kiosk}@example.com", "purchase_history", [ticket])],
+            }
+
+        def direct(kiosk):
+            for _ in range(sales_per_kiosk):
+                for filename, changes in sale_changes(kiosk).items():
+                    DataStorage.write_batches(filename, [changes])
+
+        committer = GroupCommitter(DataStorage.write_batches, window=window)
+
+        def grouped(kiosk):
+            for _ in range(sales_per_kiosk):
+                committer.submit(sale_changes(kiosk)).result()
+
+        print(f"Sales per second with {kiosks} concurrent kiosks")
+        for label, worker in (("fsync per sale", direct), ("group commit", grouped)):
+            threads = [threading.Thread(target=worker, args=(kiosk,)) for kiosk in range(kiosks)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            print(f"{label:>16}: {kiosks * sales_per_kiosk / elapsed:10.0f}")
+        print(f"{'':>16}  ({committer.submissions_written} sales in {committer.groups_written} group writes)")
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_cold_start(user_count=2000, tickets_per_user=50):
+    """
+    Compare startup time and memory of loading users with inline purchase histories
+    against the user index whose histories are paged in on first access.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        users = {}
+        for index in range(user_count):
+            user = _make_user(index, tickets_per_user)
+            users[user.email] = user
+        inline_file = os.path.join(folder, "inline_users.pkl")
+        with open(inline_file, 'wb') as file:
+            pickle.dump(users, file)
+        index_file = os.path.join(folder, "users.pkl")
+        with contextlib.redirect_stdout(io.StringIO()):
+            DataStorage.save_to_file(users, index_file)
+        del users
+
+        print(f"Cold start with {user_count} users x {tickets_per_user} tickets")
+        for label, filename in (("inline history", inline_file), ("lazy history", index_file)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                loaded = DataStorage.load_from_file(filename)
+            elapsed = (time.perf_counter() - start) * 1000
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            size = os.path.getsize(filename) / 1024
+            print(f"{label:>16}: {elapsed:8.1f} ms, {peak / 1024 / 1024:7.1f} MiB peak, users file {size:9.1f} KiB")
+            del loaded
+    finally:
+        shutil.rmtree(folder)
+
+
+class _ObjectTicketPickler(pickle.Pickler):
+    """Pickles users and tickets as full Python objects, the way users.pkl stored them before ticket records."""
+    def reducer_override(self, obj):
+        if isinstance(obj, Ticket):
+            return object.__reduce_ex__(obj, pickle.HIGHEST_PROTOCOL)
+        if isinstance(obj, User):
+            state = obj.__getstate__()
+            if state.pop("_history_records", None) is not None:
+                state["purchase_history"] = obj.purchase_history
+            return (copyreg.__newobj__, (User,), state)
+        return NotImplemented
+
+
+def benchmark_ticket_format(user_count=2000, tickets_per_user=50):
+    """
+    Compare the size and load time of a users file with inline purchase histories when tickets
+    are pickled as Python objects against tickets packed as binary records.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        users = {}
+        for index in range(user_count):
+            user = _make_user(index, tickets_per_user)
+            users[user.email] = user
+        object_file = os.path.join(folder, "object_tickets.pkl")
+        with open(object_file, 'wb') as file:
+            _ObjectTicketPickler(file, pickle.HIGHEST_PROTOCOL).dump(users)
+        record_file = os.path.join(folder, "record_tickets.pkl")
+        with open(record_file, 'wb') as file:
+            pickle.dump(users, file, protocol=pickle.HIGHEST_PROTOCOL)
+        del users
+
+        print(f"Ticket encoding with {user_count} users x {tickets_per_user} tickets")
+        for label, filename in (("ticket objects", object_file), ("ticket records", record_file)):
+            start = time.perf_counter()
+            with open(filename, 'rb') as file:
+                loaded = pickle.load(file)
+            load_time = (time.perf_counter() - start) * 1000
+            for user in loaded.values():
+                user.purchase_history
+            read_time = (time.perf_counter() - start) * 1000
+            size = os.path.getsize(filename) / 1024
+            print(f"{label:>16}: {load_time:8.1f} ms to load, {read_time:8.1f} ms with every history read, "
+                  f"users file {size:9.1f} KiB")
+            del loaded
+        record_size = TicketRecordFormat.LAYOUTS[TicketRecordFormat.VERSION].size
+        print(f"{'':>16}  ({record_size} bytes per ticket record)")
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_batch_quotes(line_count=100_000):
+    """
+    Compare pricing an agency order line by line (Ticket, apply_discounts, set_validity_dates)
+    with one vectorized PricingEngine.quote_batch call over the same columns.
+    """
+    catalog = {ticket_type: {"price": price, "validity": TICKET_VALIDITY[ticket_type], "discount": 0.0}
+               for ticket_type, price in TICKET_PRICES.items()}
+    engine = PricingEngine(catalog)
+    member = _make_user(0, 0)
+    membership = Ticket(Utils.generate_unique_id(), "Annual Membership", 1840, "1 Year", "2025-01-01")
+    membership.set_validity_dates(member)
+    member.purchase_history.append(membership)
+    newcomer = _make_user(1, 0)
+
+    ticket_types = list(TICKET_PRICES)
+    payment_methods = ["credit card", "cash", "net banking", "coupon", "digital wallet"]
+    first_day = date(2025, 6, 1)
+    lines = [(ticket_types[index % len(ticket_types)], 1 + index % 30, payment_methods[index % len(payment_methods)],
+              (first_day + timedelta(days=index % 90)).isoformat(), member if index % 7 == 0 else newcomer)
+             for index in range(line_count)]
+
+    print(f"Pricing {line_count} order lines")
+    start = time.perf_counter()
+    tickets = []
+    for ticket_type, quantity, payment_method, visit_date, user in lines:
+        details = catalog[ticket_type]
+        ticket = Ticket(Utils.generate_unique_id(), ticket_type, details["price"], details["validity"], visit_date,
+                        default_discount=details["discount"])
+        ticket.apply_discounts(user, quantity, payment_method)
+        ticket.set_validity_dates(user)
+        tickets.append(ticket)
+    per_object = time.perf_counter() - start
+    print(f"{'per object':>16}: {per_object * 1000:8.1f} ms, {per_object / line_count * 1e6:6.2f} us per line")
+
+    if pricing.np is None:
+        print(f"{'batch':>16}: skipped, NumPy is not installed")
+        return
+    np = pricing.np
+    codes = np.array([TICKET_TYPE_CODES[line[0]] for line in lines])
+    quantities = np.array([line[1] for line in lines])
+    methods = np.array([line[2] for line in lines])
+    visit_dates = np.array([line[3] for line in lines], dtype="datetime64[D]")
+    membership_ends = np.array([membership.validity_end_date if line[4] is member else None for line in lines],
+                               dtype="datetime64[D]")
+    start = time.perf_counter()
+    batch = engine.quote_batch(codes, quantities, methods, visit_dates, membership_ends=membership_ends)
+    vectorized = time.perf_counter() - start
+    print(f"{'batch':>16}: {vectorized * 1000:8.1f} ms, {vectorized / line_count * 1e6:6.2f} us per line "
+          f"({per_object / vectorized:.0f}x faster)")
+
+    expected_prices = np.array([ticket.price for ticket in tickets])
+    expected_ends = np.array([ticket.validity_end_date for ticket in tickets], dtype="datetime64[D]")
+    if not (np.array_equal(batch.prices, expected_prices) and np.array_equal(batch.validity_end, expected_ends)):
+        raise AssertionError("Batch quotes differ from per-ticket pricing.")
+
+
+class _DictTicket:
+    """A ticket with a per-instance __dict__, laid out like Ticket before it used __slots__."""
+    def __init__(self, ticket_id, ticket_type, price, validity, visit_date, default_discount=0.0):
+        self.ticket_id = ticket_id
+        self.ticket_type = ticket_type
+        self.price = price
+        self.base_price = price
+        self.validity = validity
+        self.visit_date = visit_date
+        self.discount = 0.0
+        self.default_discount = default_discount
+        self.validity_start_date = None
+        self.validity_end_date = None
+        self.limited_availability = 20
+
+
+def _issue_tickets(ticket_class, count):
+    visit_day = date(2025, 1, 1)
+    for index in range(count):
+        ticket = ticket_class(Utils.generate_unique_id(), "Single-Day Pass", 275.0, "1 Day", "2025-01-01")
+        ticket.validity_start_date = visit_day + timedelta(days=index % 365)
+        ticket.validity_end_date = ticket.validity_start_date
+        yield ticket
+
+
+def benchmark_ticket_memory(ticket_count=1_000_000):
+    """
+    Compare the memory held by issued tickets as objects with a __dict__, as objects with
+    __slots__, and as rows of a columnar PurchaseHistory.
+    """
+    print(f"Memory for {ticket_count} issued tickets")
+    builders = (
+        ("dict objects", lambda: list(_issue_tickets(_DictTicket, ticket_count))),
+        ("slot objects", lambda: list(_issue_tickets(Ticket, ticket_count))),
+        ("columnar", lambda: PurchaseHistory(_issue_tickets(Ticket, ticket_count))),
+    )
+    for label, build in builders:
+        tracemalloc.start()
+        tickets = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:>16}: {current / 1024 / 1024:8.1f} MiB, {current / ticket_count:6.1f} bytes per ticket")
+        del tickets
+
+
+def benchmark_group_purchase(group_size=500, order_count=200):
+    """
+    Compare adding a school group's tickets to a purchase history one Ticket at a time with
+    adding them as one TicketBlock, including the write-ahead log change each purchase logs.
+    """
+    print(f"Adding {order_count} orders of {group_size} tickets")
+
+    def per_ticket(user, ticket):
+        for _ in range(group_size):
+            copy = Ticket(Utils.generate_unique_id(), ticket.ticket_type, ticket.price, ticket.validity,
+                          ticket.visit_date)
+            copy.discount = ticket.discount
+            copy.validity_start_date = ticket.validity_start_date
+            copy.validity_end_date = ticket.validity_end_date
+            user.purchase_ticket(copy)
+
+    def as_block(user, ticket):
+        user.purchase_block(TicketBlock(ticket, group_size))
+
+    for label, purchase in (("per ticket", per_ticket), ("ticket block", as_block)):
+        user = _make_user(0, 0)
+        user.purchase_history = PurchaseHistory()
+        ticket = Ticket(Utils.generate_unique_id(), "Group Ticket (10+)", 220, "1 Day", "2025-05-20")
+        ticket.apply_discount(0.2)
+        log_bytes = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(order_count):
+                purchase(user, ticket)
+                changes = user.pending_changes(user.email)
+                log_bytes += len(pickle.dumps(changes, protocol=pickle.HIGHEST_PROTOCOL))
+                user.mark_saved(changes)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>16}: {elapsed / order_count * 1000:8.3f} ms, {log_bytes / order_count:9.0f} log bytes per order")
+
+
+if __name__ == "__main__":
+    benchmark_wal_purchase_cost()
+    benchmark_group_commit()
+    benchmark_cold_start()
+    benchmark_ticket_format()
+    benchmark_batch_quotes()
+    benchmark_ticket_memory()
+    benchmark_group_purchase()
@@ -0,0 +1,318 @@
+from write_ahead_log import WriteAheadLog
+
+
+class TrackedRecord:
+    """
+    Mixin for records (users, sales reports) that know which of their changes are not saved yet.
+
+    A record that was never saved is written whole. After that, only the items appended to
+    its `tracked_list` attribute since the last save are written, as one "extend" change.
+    Tracking state is never pickled.
+
+    Subclasses may declare `__slots__`; their pickled state is still a plain dictionary.
+    """
+    __slots__ = ("_tracker", "_key", "_pending", "_is_new")
+    TRACKING_FIELDS = __slots__
+    tracked_list = None  # Name of the list attribute whose appends are saved incrementally
+
+    def _init_tracking(self, is_new=True):
+        self._tracker = None
+        self._key = None
+        self._pending = []
+        self._is_new = is_new
+
+    def attach_tracker(self, tracker, key):
+        """Report future changes of this record to `tracker` under `key`."""
+        self._tracker = tracker
+        self._key = key
+
+    def mark_dirty(self):
+        """Tell the owning collection that this record has unsaved changes."""
+        if self._tracker is not None:
+            self._tracker.mark_dirty(self._key)
+
+    def record_appended(self, items):
+        """Remember items appended to the tracked list so the next save writes only them."""
+        self._pending.extend(items)
+        self.mark_dirty()
+
+    def has_pending_changes(self):
+        """Return True if the record has changes that were not saved yet."""
+        return self._is_new or bool(self._pending)
+
+    def pending_changes(self, key):
+        """
+        Build the changes that bring the saved copy of this record up to date.
+
+        Args:
+            key: The key of the record in its collection.
+
+        Returns:
+            list: The changes, empty if the record is clean.
+        """
+        if self._is_new:
+            return [WriteAheadLog.set_record(key, self)]
+        if self._pending:
+            return [WriteAheadLog.extend_record(key, self.tracked_list, self._pending)]
+        return []
+
+    def mark_saved(self, changes):
+        """
+        Forget the changes returned by `pending_changes` once they are on disk.
+
+        Items appended after the changes were built stay pending.
+        """
+        for change in changes:
+            if change[0] == WriteAheadLog.SET:
+                self._is_new = False
+                self._pending = []
+            elif change[0] == WriteAheadLog.EXTEND:
+                del self._pending[:len(change[3])]
+
+    def mark_clean(self):
+        """Treat the record as fully saved, e.g. after it was written as part of a full snapshot."""
+        self._is_new = False
+        self._pending = []
+
+    def after_load(self, filename):
+        """Hook called after the record was read from the snapshot of `filename`."""
+        return None
+
+    def before_snapshot(self, filename):
+        """
+        Hook called before the record is written into a snapshot of `filename`.
+
+        Returns:
+            An object with a `sync()` method that must be flushed before the snapshot is
+            renamed into place, or None.
+        """
+        return None
+
+    def same_record(self, other):
+        """
+        Return True if `other` is another saved copy of this record, so local changes may be rebased onto it.
+
+        Records that cannot be matched across processes return False.
+        """
+        return False
+
+    def rebase(self, newer, filename):
+        """
+        Adopt a newer saved copy of this record written by another process, then re-append the
+        items this copy has not saved yet so the next flush writes them on top.
+
+        Args:
+            newer (TrackedRecord): The newer copy, for which `same_record` is True.
+            filename (str): The data file the record belongs to.
+
+        Returns:
+            None
+        """
+        unsaved = list(getattr(self, self.tracked_list)) if self._is_new else list(self._pending)
+        tracker, key = self._tracker, self._key
+        self.__setstate__(newer.__getstate__())
+        self.after_load(filename)
+        self.attach_tracker(tracker, key)
+        getattr(self, self.tracked_list).extend(unsaved)
+        self.record_appended(unsaved)
+
+    @classmethod
+    def _slot_names(cls):
+        names = []
+        for klass in reversed(cls.__mro__):
+            slots = klass.__dict__.get("__slots__", ())
+            names.extend([slots] if isinstance(slots, str) else slots)
+        return [name for name in names
+                if name not in TrackedRecord.TRACKING_FIELDS and name not in ("__dict__", "__weakref__")]
+
+    def __getstate__(self):
+        state = dict(getattr(self, "__dict__", {}))
+        for name in self._slot_names():
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        for name in TrackedRecord.TRACKING_FIELDS:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._init_tracking(is_new=False)
+
+
+class ChangeTracker:
+    """
+    Mixin for collections that remember which keys changed since they were last saved.
+
+    Saving a tracked collection with `DataStorage.flush` writes only the dirty records,
+    so its cost depends on what changed rather than on the size of the collection.
+
+    Collections loaded from a pickle file also remember the version of each record (the log
+    sequence number of its last saved change) and how far into the write-ahead log they have
+    read, which `DataStorage` uses to catch up on changes written by other processes.
+    """
+    def _init_change_tracker(self):
+        self.dirty_keys = {}
+        self.versions = {}  # key -> sequence number of the last saved change
+        self.log_position = None  # (log file id, byte offset, sequence number) read up to
+
+    def track(self, key, value):
+        """Let a record report its own changes to this collection."""
+        if isinstance(value, TrackedRecord):
+            value.attach_tracker(self, key)
+
+    def mark_dirty(self, key):
+        """Remember that the record under `key` changed."""
+        self.dirty_keys[key] = True
+
+    def tracked_record(self, key):
+        """Return the in-memory record for a dirty key, or None if it was deleted."""
+        raise NotImplementedError
+
+    def pending_changes(self):
+        """
+        Build the changes for every dirty record.
+
+        Returns:
+            list: (key, changes) pairs to pass back to `mark_saved` once written.
+        """
+        pending = []
+        for key in list(self.dirty_keys):
+            record = self.tracked_record(key)
+            if record is None:
+                changes = [WriteAheadLog.delete_record(key)]
+            elif isinstance(record, TrackedRecord):
+                changes = record.pending_changes(key)
+            else:
+                changes = [WriteAheadLog.set_record(key, record)]
+            pending.append((key, changes))
+        return pending
+
+    def mark_saved(self, pending):
+        """
+        Clear the dirty state covered by changes returned from `pending_changes`.
+
+        Args:
+            pending (list): The (key, changes) pairs that were written.
+
+        Returns:
+            None
+        """
+        for key, changes in pending:
+            record = self.tracked_record(key)
+            if isinstance(record, TrackedRecord):
+                record.mark_saved(changes)
+                if record.has_pending_changes():
+                    continue
+            self.dirty_keys.pop(key, None)
+
+    def mark_all_saved(self):
+        """Clear all dirty state after the whole collection was written as a snapshot."""
+        for key in list(self.dirty_keys):
+            record = self.tracked_record(key)
+            if isinstance(record, TrackedRecord):
+                record.mark_clean()
+        self.dirty_keys.clear()
+
+
+class TrackedDict(ChangeTracker, dict):
+    """
+    A dictionary that records which keys were set, deleted or changed in place.
+
+    It pickles as a plain dictionary, so snapshots stay readable by older code.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._init_change_tracker()
+        for key, value in dict.items(self):
+            self.track(key, value)
+
+    def tracked_record(self, key):
+        return dict.get(self, key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.track(key, value)
+        self.mark_dirty(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.mark_dirty(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.mark_dirty(key)
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def load_saved(self, key, value):
+        """Store a record read back from disk without marking it dirty, dropping unsaved changes to it."""
+        self._detach(key)
+        super().__setitem__(key, value)
+        self.track(key, value)
+        self.dirty_keys.pop(key, None)
+
+    def remove_saved(self, key):
+        """Remove a record that was deleted on disk without marking it dirty."""
+        self._detach(key)
+        super().pop(key, None)
+        self.dirty_keys.pop(key, None)
+
+    def _detach(self, key):
+        record = dict.get(self, key)
+        if isinstance(record, TrackedRecord):
+            record.attach_tracker(None, None)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class TicketCatalog(TrackedDict):
+    """
+    The ticket catalog (ticket type -> price, validity and admin discount) with change tracking.
+
+    Catalog entries are plain dictionaries, so edits must go through `set_discount`
+    to be picked up by the next flush. `revision` is bumped on every change, so caches
+    built from the catalog (e.g. the `PricingEngine` price table) know when to rebuild.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.revision = 0
+
+    def mark_dirty(self, key):
+        self.revision += 1
+        super().mark_dirty(key)
+
+    def load_saved(self, key, value):
+        self.revision += 1
+        super().load_saved(key, value)
+
+    def remove_saved(self, key):
+        self.revision += 1
+        super().remove_saved(key)
+
+    def set_discount(self, ticket_type, discount):
+        """
+        Set the admin discount of a ticket type.
+
+        Args:
+            ticket_type (str): The ticket type to update.
+            discount (float): The new discount (e.g., 0.15 for 15%).
+
+        Returns:
+            None
+        """
+        if ticket_type not in self:
+            raise ValueError("Invalid ticket type!")
+        if not (0 <= discount <= 1):
+            raise ValueError("Discount must be between 0 and 1.")
+        dict.__getitem__(self, ticket_type)['discount'] = discount
+        self.mark_dirty(ticket_type)
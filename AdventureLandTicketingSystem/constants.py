@@ -2,6 +2,38 @@
 FILE_PATH_USERS = "data/users.pkl"
 FILE_PATH_TICKETS = "data/tickets.pkl"
 FILE_PATH_SALES_REPORTS = "data/sales_reports.pkl"
+FILE_PATH_DATABASE = "data/adventureland.db"
+FILE_PATH_INVENTORY = "data/inventory.pkl"
+FILE_PATH_SALES_ROLLUPS = "data/sales_rollups.pkl"  # Monthly and yearly rollups of closed days
+FILE_PATH_IDEMPOTENCY = "data/idempotency_keys.pkl"  # Outcomes of purchases, by idempotency key
+
+# Ticket, payment, transaction, report and user IDs: 64-bit integers made of the milliseconds
+# since ID_EPOCH_MS, the node ID leased by the issuing process and a sequence number
+ID_EPOCH_MS = 1_704_067_200_000  # 2024-01-01 00:00:00 UTC
+ID_NODE_BITS = 10
+ID_SEQUENCE_BITS = 12
+DIRECTORY_PATH_NODE_LEASES = "data/nodes"
+ID_LEASE_WINDOW_MS = 1000  # How far ahead a node's high-water mark is saved
+
+# Storage engine: "pickle" (pickle files with a write-ahead log) or "sqlite" (FILE_PATH_DATABASE)
+STORAGE_ENGINE = "pickle"
+
+# Write-ahead log compaction: fold the log into a new snapshot once it passes either threshold
+WAL_COMPACT_MAX_BYTES = 1024 * 1024
+WAL_COMPACT_MAX_AGE_SECONDS = 300
+WAL_COMPACT_CHECK_INTERVAL_SECONDS = 5
+
+# Group commit: writes from purchases landing within the window share one fsync'd write per file
+GROUP_COMMIT_ENABLED = True
+GROUP_COMMIT_WINDOW_SECONDS = 0.002
+GROUP_COMMIT_MAX_BATCH = 256
+
+# Keep purchase histories read from disk in columnar arrays instead of one object per ticket
+COLUMNAR_PURCHASE_HISTORY = True
+
+# Several processes (e.g. a CLI and a GUI kiosk) use the same data folder: lock the data files,
+# check record versions before writing and catch up on changes written by the other processes
+SHARED_DATA_DIRECTORY = False
 
 # Ticket discount constants
 DISCOUNT_ON_TWO_DAY_PASS = 0.10  
@@ -28,6 +60,62 @@ TICKET_VALIDITY = {
     "VIP Experience Pass": "1 Day",
 }
 
+# Payment methods accepted at the kiosks
+PAYMENT_METHODS = ("net banking", "credit card", "digital wallet", "cash", "coupon")
+
+# Payment methods settled by the payment gateway; the others are settled at the kiosk
+ONLINE_PAYMENT_METHODS = frozenset(["net banking", "credit card", "digital wallet"])
+
+# The (host, port) of the payment gateway; None runs the simulated gateway on a local port
+PAYMENT_GATEWAY_ADDRESS = None
+PAYMENT_GATEWAY_POOL_SIZE = 8  # Connections kept open to the gateway
+PAYMENT_GATEWAY_TIMEOUT_SECONDS = 10
+PAYMENT_GATEWAY_RETRIES = 2  # Extra attempts for requests the gateway did not settle or answer
+PAYMENT_POLL_INTERVAL_MS = 50  # How often the GUI checks for the outcome of a payment
+
+# Behaviour of the simulated gateway
+SIMULATED_GATEWAY_LATENCY_SECONDS = (0.05, 0.2)
+SIMULATED_GATEWAY_FAILURE_RATE = 0.0  # Share of requests answered "unavailable"
+SIMULATED_GATEWAY_DECLINE_RATE = 0.0
+SIMULATED_GATEWAY_LOST_REPLY_RATE = 0.0  # Share of settled requests whose reply never arrives
+
+# Outcomes of purchases made with an idempotency key are kept, so a retried purchase is not done twice
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_CACHE_SIZE = 10000  # Outcomes kept in memory
+IDEMPOTENCY_WAIT_SECONDS = 30  # How long a retry waits for the same purchase still in progress
+
+# Ticket types that count as an accompanying adult for a Child Ticket
+ADULT_TICKET_TYPES = ("Single-Day Pass", "Two-Day Pass", "Annual Membership", "VIP Experience Pass")
+
+# Days a ticket stays valid after its first day
+TICKET_VALIDITY_DAYS = {
+    "Single-Day Pass": 0,
+    "Two-Day Pass": 1,
+    "Annual Membership": 365,
+    "Child Ticket": 0,
+    "Group Ticket (10+)": 0,
+    "VIP Experience Pass": 0,
+}
+
+# Tickets that can be sold per visit date, for ticket types with limited daily capacity
+DAILY_TICKET_CAPACITY = {
+    "VIP Experience Pass": 20,
+}
+
+# Tickets held for a purchase are given back if the purchase is not completed within the TTL
+HOLD_TTL_SECONDS = 300
+HOLD_EXPIRY_CHECK_INTERVAL_SECONDS = 1
+
+# End-of-day close: the sales reports of past days are sealed and folded into monthly and yearly rollups
+SALES_CLOSE_CHECK_INTERVAL_SECONDS = 60
+
+# Sizes of the approximate sketches kept with every sales rollup (distinct customers, top buyers)
+SKETCH_HLL_PRECISION = 11  # 2 KB per sketch, about 2.3% standard error
+SKETCH_COUNT_MIN_WIDTH = 512
+SKETCH_COUNT_MIN_DEPTH = 4
+SKETCH_TOP_K = 500
+
 # General limits and settings
 MAX_TICKETS_PER_USER = 10
+SALES_REPORT_PAGE_SIZE = 40  # Lines per page when transactions are shown in the admin menu
 MIN_GROUP_SIZE_FOR_DISCOUNT = 20
@@ -1,50 +1,638 @@
+import contextlib
 import pickle
 import os
+import threading
+
+import constants
+from write_ahead_log import WriteAheadLog
+from sqlite_storage import SQLiteStorage, UserTable, SalesReportTable
+from group_commit import GroupCommitter
+from change_tracking import ChangeTracker, TrackedDict, TrackedRecord
+
+
+class ConcurrentUpdateError(ValueError):
+    """
+    Raised when unsaved changes conflict with records another process saved in the meantime.
+
+    The conflicting records have already been reloaded with the saved version; the local
+    changes to them are dropped. Everything else was saved normally.
+    """
+    def __init__(self, conflicts):
+        """
+        Args:
+            conflicts (dict): Lists of conflicting keys keyed by data file path.
+        """
+        self.conflicts = conflicts
+        described = "; ".join(f"{filename}: {', '.join(map(str, keys))}" for filename, keys in conflicts.items())
+        super().__init__(f"Records changed at another kiosk were reloaded and must be updated again ({described}).")
+
 
 class DataStorage:
     """
     A utility class for saving and loading data using Pickle.
 
     Provides static methods to save data to files and load data from files, handling directory creation if needed.
+    Small changes can be appended to a write-ahead log next to the data file instead of rewriting the whole file;
+    the log is replayed on load and cleared by the next full save.
+
+    When `constants.STORAGE_ENGINE` is "sqlite", the users, tickets and sales report files are served
+    from the SQLite database at `constants.FILE_PATH_DATABASE` instead; other files keep using Pickle.
+
+    When `constants.SHARED_DATA_DIRECTORY` is set, several processes may use the same pickle files.
+    Each write takes a lock file, first applies what other processes wrote since this process last
+    looked (checking the version of every record it is about to write), and only then appends.
+
+    A `StorageBackend` installed with `use_backend` replaces all of the above: every load and save is
+    served by the backend (e.g. an `InMemoryBackend` in tests) and the data folder is not touched.
     """
+    _backend = None
+    _sqlite = None
+    _committer = None
+    _committer_lock = threading.Lock()
+
+    @staticmethod
+    def use_backend(backend):
+        """
+        Serve every data file from a storage backend instead of the data folder.
+
+        Args:
+            backend (StorageBackend): The backend to use, or None to go back to the files on disk.
+
+        Returns:
+            StorageBackend: The backend that was in use before, or None.
+        """
+        previous = DataStorage._backend
+        DataStorage._backend = backend
+        return previous
+
+    @staticmethod
+    def sqlite_storage():
+        """
+        Return the shared SQLite engine, opening the database on first use.
+
+        Returns:
+            SQLiteStorage: The engine for `constants.FILE_PATH_DATABASE`.
+        """
+        if DataStorage._sqlite is None or DataStorage._sqlite.db_path != constants.FILE_PATH_DATABASE:
+            DataStorage._sqlite = SQLiteStorage(constants.FILE_PATH_DATABASE)
+        return DataStorage._sqlite
+
+    @staticmethod
+    def sqlite_table_for(filename):
+        """
+        Return the SQLite table that replaces a pickle file, or None if the file is not served by SQLite.
+
+        Args:
+            filename (str): The path of the pickle file.
+
+        Returns:
+            str: The table name, or None.
+        """
+        if constants.STORAGE_ENGINE != "sqlite":
+            return None
+        return {
+            constants.FILE_PATH_USERS: SQLiteStorage.USERS,
+            constants.FILE_PATH_TICKETS: SQLiteStorage.CATALOG,
+            constants.FILE_PATH_SALES_REPORTS: SQLiteStorage.SALES_REPORTS,
+        }.get(filename)
+
     @staticmethod
     def save_to_file(data, filename):
         """
         Save data to a binary file using Pickle. Creates the folder if it doesn't exist.
 
+        The saved file becomes the new snapshot, so any write-ahead log for it is cleared.
+
+        Args:
+            data: The data object to be saved.
+            filename (str): The path to the file where data should be saved.
+
+        Returns:
+            None
+        """
+        backend = DataStorage._backend
+        if backend is not None:
+            backend.save(data, filename)
+            if isinstance(data, ChangeTracker):
+                data.mark_all_saved()
+            return
+
+        table = DataStorage.sqlite_table_for(filename)
+        if table:
+            # Table views write through, so only their unsaved record changes need writing
+            if isinstance(data, (UserTable, SalesReportTable)):
+                DataStorage.flush(data, filename)
+            else:
+                DataStorage.sqlite_storage().replace_all(table, data)
+                if isinstance(data, ChangeTracker):
+                    data.mark_all_saved()
+            print(f"Data saved to {constants.FILE_PATH_DATABASE} ({table}).")
+            return
+
+        log = WriteAheadLog(filename)
+        tracked = isinstance(data, ChangeTracker)
+        with log.lock():
+            conflicts = DataStorage._catch_up(data, filename)
+            checkpoint = log.last_lsn()
+            versions = None
+            if tracked:
+                if data.dirty_keys:
+                    checkpoint += 1  # The snapshot writes the dirty records as one more batch
+                    for key in data.dirty_keys:
+                        data.versions[key] = checkpoint
+                versions = {key: data.versions.get(key, 0) for key in data}
+            DataStorage.write_snapshot(data, filename, checkpoint, versions)
+            if checkpoint or os.path.exists(log.path):
+                log.reset(checkpoint)
+            if tracked:
+                data.versions = versions
+                data.log_position = (log.file_id(), log.end_offset(), checkpoint)
+        if tracked:
+            data.mark_all_saved()
+        print(f"Data saved to {filename}.")
+        if conflicts:
+            raise ConcurrentUpdateError({filename: conflicts})
+
+    @staticmethod
+    def write_snapshot(data, filename, checkpoint=0, versions=None):
+        """
+        Atomically replace a data file: write a temporary file, fsync it, then rename it over the target.
+
+        A crash at any point leaves either the old or the new file in place, never a truncated one.
+        The checkpoint sequence number of the write-ahead log (and the version of each record, if
+        known) is pickled after the data so that plain `pickle.load` still returns the data.
+
         Args:
             data: The data object to be saved.
             filename (str): The path to the file where data should be saved.
+            checkpoint (int): The last write-ahead log sequence number contained in `data`.
+            versions (dict): The sequence number of the last change of each key, or None if unknown.
 
         Returns:
             None
         """
         # Ensure the directory exists
         folder = os.path.dirname(filename)
-        if not os.path.exists(folder):
+        if folder and not os.path.exists(folder):
             os.makedirs(folder)
 
-        # Save the data
-        with open(filename, 'wb') as file:
-            pickle.dump(data, file)
-            print(f"Data saved to {filename}.")
+        # Side files the records spill into (e.g. purchase histories) must be durable before the rename
+        if isinstance(data, dict):
+            side_files = set()
+            for record in data.values():
+                if isinstance(record, TrackedRecord):
+                    side_file = record.before_snapshot(filename)
+                    if side_file is not None:
+                        side_files.add(side_file)
+            for side_file in side_files:
+                side_file.sync()
+
+        temp_path = f"{filename}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(temp_path, 'wb') as file:
+                pickle.dump(data, file)
+                trailer = {"checkpoint": checkpoint}
+                if versions is not None:
+                    trailer["versions"] = versions
+                pickle.dump(trailer, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, filename)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        # Make the rename itself durable where the platform allows opening directories
+        if hasattr(os, "O_DIRECTORY"):
+            directory = os.open(folder or ".", os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    @staticmethod
+    def read_snapshot(filename):
+        """
+        Read a data file written by `write_snapshot` (or by older versions of `save_to_file`).
+
+        Args:
+            filename (str): The path of the data file.
+
+        Returns:
+            tuple: (data, checkpoint sequence number). Files without a checkpoint report 0.
+        """
+        data, trailer = DataStorage._read_snapshot_trailer(filename)
+        return data, trailer.get("checkpoint", 0)
+
+    @staticmethod
+    def _read_snapshot_trailer(filename):
+        with open(filename, 'rb') as file:
+            data = pickle.load(file)
+            try:
+                trailer = pickle.load(file)
+            except EOFError:
+                trailer = {}
+        DataStorage._notify_loaded(data, filename)
+        return data, trailer
+
+    @staticmethod
+    def _notify_loaded(data, filename):
+        if isinstance(data, dict):
+            for record in data.values():
+                if isinstance(record, TrackedRecord):
+                    record.after_load(filename)
 
     @staticmethod
     def load_from_file(filename):
         """
         Load data from a binary file using Pickle.
 
+        Changes appended with `append_changes` since the last save are replayed on top of the file.
+
         Args:
             filename (str): The path to the file from which data should be loaded.
 
         Returns:
             Any: The data object loaded from the file, or an empty dictionary if the file does not exist.
         """
-        if os.path.exists(filename):
-            with open(filename, 'rb') as file:
-                data = pickle.load(file)
+        if DataStorage._backend is not None:
+            return DataStorage._backend.load(filename)
+        table = DataStorage.sqlite_table_for(filename)
+        if table:
+            return DataStorage.sqlite_storage().table(table)
+        return DataStorage._load_pickle(filename)
+
+    @staticmethod
+    def _load_pickle(filename):
+        return DataStorage._read_pickle(filename)[0]
+
+    @staticmethod
+    def _read_pickle(filename):
+        """Load a pickle file and its log; returns (data, record versions, log position)."""
+        log = WriteAheadLog(filename)
+        with log.lock():
+            versions = {}
+            if os.path.exists(filename):
+                data, trailer = DataStorage._read_snapshot_trailer(filename)
+                checkpoint = trailer.get("checkpoint", 0)
+                versions.update(trailer.get("versions") or {})
                 print(f"Data loaded from {filename}.")
-                return data
+            elif os.path.exists(log.path):
+                data, checkpoint = {}, 0
+            else:
+                print(f"{filename} not found. Returning empty data.")
+                return {}, versions, (None, WriteAheadLog.FILE_HEADER.size, 0)
+
+            if checkpoint and not os.path.exists(log.path):
+                # Keep new sequence numbers above the snapshot's checkpoint
+                log.reset(checkpoint)
+            applied = log.replay(data, after_lsn=checkpoint, versions=versions)
+            if applied:
+                DataStorage._notify_loaded(data, filename)
+                print(f"Replayed {applied} logged changes for {filename}.")
+            position = (log.file_id(), log.end_offset(), max(checkpoint, log.last_lsn()))
+        return data, versions, position
+
+    @staticmethod
+    def load_tracked(filename, tracker_class=TrackedDict):
+        """
+        Load a data file as a collection that tracks its own changes, for use with `flush`.
+
+        Args:
+            filename (str): The path to the file from which data should be loaded.
+            tracker_class (type): The `TrackedDict` subclass to wrap plain dictionaries in.
+
+        Returns:
+            ChangeTracker: The loaded collection.
+        """
+        if DataStorage._backend is not None or DataStorage.sqlite_table_for(filename):
+            data = DataStorage.load_from_file(filename)
+            return data if isinstance(data, ChangeTracker) else tracker_class(data)
+        data, versions, position = DataStorage._read_pickle(filename)
+        tracked = tracker_class(data)
+        tracked.versions = versions
+        tracked.log_position = position
+        return tracked
+
+    @staticmethod
+    def refresh(data, filename):
+        """
+        Apply the changes other processes saved to a tracked collection since it was loaded.
+
+        Only does something when `constants.SHARED_DATA_DIRECTORY` is set. Records saved elsewhere
+        are read back; a newer copy of a record with unsaved local items (e.g. today's sales report)
+        is adopted and the local items stay pending on top of it.
+
+        Args:
+            data (TrackedDict): A collection returned by `load_tracked`.
+            filename (str): The path of the data file the collection belongs to.
+
+        Raises:
+            ConcurrentUpdateError: If unsaved local changes had to be dropped for a newer saved version.
+        """
+        if DataStorage._backend is not None:
+            DataStorage._backend.refresh(data, filename)
+            return
+        conflicts = DataStorage._catch_up(data, filename)
+        if conflicts:
+            raise ConcurrentUpdateError({filename: conflicts})
+
+    @staticmethod
+    def _catch_up(data, filename):
+        """Apply changes saved by other processes; returns the keys whose local changes were dropped."""
+        if (not constants.SHARED_DATA_DIRECTORY or not isinstance(data, TrackedDict)
+                or DataStorage.sqlite_table_for(filename)):
+            return []
+        log = WriteAheadLog(filename)
+        with log.lock():
+            if data.log_position is None:
+                # Not loaded from this file: follow it from here on
+                data.log_position = (log.file_id(), log.end_offset(), log.last_lsn())
+                return []
+            file_id, offset, seen_lsn = data.log_position
+            changes = []
+            if log.file_id() == file_id:
+                batches, offset = log.read_from(offset)
+            else:
+                # The log was rewritten by a save or a compaction in another process
+                if log.base_lsn() > seen_lsn and os.path.exists(filename):
+                    snapshot_changes, checkpoint = DataStorage._snapshot_changes(data, filename)
+                    changes.extend(snapshot_changes)
+                    seen_lsn = max(seen_lsn, checkpoint)
+                batches, offset = log.read_from(WriteAheadLog.FILE_HEADER.size)
+            for lsn, batch in batches:
+                if lsn > seen_lsn:
+                    changes.extend((lsn, change) for change in batch)
+                    seen_lsn = lsn
+
+            conflicts = []
+            for version, change in changes:
+                DataStorage._apply_saved_change(data, filename, version, change, conflicts)
+            data.log_position = (log.file_id(), offset, seen_lsn)
+        return conflicts
+
+    @staticmethod
+    def _snapshot_changes(data, filename):
+        """Compare a collection with a newer snapshot; returns ((version, change) pairs, checkpoint)."""
+        snapshot, trailer = DataStorage._read_snapshot_trailer(filename)
+        checkpoint = trailer.get("checkpoint", 0)
+        versions = trailer.get("versions")
+        changes = []
+        for key, value in snapshot.items():
+            version = checkpoint if versions is None else versions.get(key, 0)
+            if version > data.versions.get(key, 0):
+                changes.append((version, WriteAheadLog.set_record(key, value)))
+        for key in list(data.versions):
+            if key not in snapshot:
+                changes.append((checkpoint, WriteAheadLog.delete_record(key)))
+        return changes, checkpoint
+
+    @staticmethod
+    def _apply_saved_change(data, filename, version, change, conflicts):
+        op, key = change[0], change[1]
+        dirty = key in data.dirty_keys
+        if op == WriteAheadLog.EXTEND:
+            # Appends commute: local unsaved items stay pending after the saved ones
+            WriteAheadLog.apply_change(data, change)
+        elif op == WriteAheadLog.SET:
+            newer = change[2]
+            DataStorage._notify_loaded({key: newer}, filename)
+            local = data.tracked_record(key)
+            if dirty and isinstance(local, TrackedRecord) and local.same_record(newer):
+                local.rebase(newer, filename)
+            else:
+                if dirty:
+                    conflicts.append(key)
+                data.load_saved(key, newer)
         else:
-            print(f"{filename} not found. Returning empty data.")
-            return {}
+            if dirty and data.tracked_record(key) is not None:
+                conflicts.append(key)
+            data.remove_saved(key)
+        WriteAheadLog.record_version(data.versions, change, version)
+
+    @staticmethod
+    def flush(data, filename):
+        """
+        Save only the records of a tracked collection that changed since it was last saved.
+
+        Args:
+            data (ChangeTracker): A collection returned by `load_tracked`.
+            filename (str): The path of the data file the collection belongs to.
+
+        Returns:
+            None
+        """
+        DataStorage.flush_all({filename: data})
+
+    @staticmethod
+    def flush_all(collections):
+        """
+        Save the changed records of several tracked collections as one commit.
+
+        Args:
+            collections (dict): Tracked collections keyed by data file path.
+
+        Returns:
+            None
+
+        Raises:
+            ConcurrentUpdateError: In a shared data directory, if some records changed in another process
+                conflicted with local changes. Everything else is saved before it is raised.
+        """
+        if constants.SHARED_DATA_DIRECTORY and DataStorage._backend is None:
+            DataStorage._flush_shared(collections)
+            return
+        pending = {filename: data.pending_changes() for filename, data in collections.items()}
+        DataStorage.commit({
+            filename: [change for _, changes in entries for change in changes]
+            for filename, entries in pending.items()
+        })
+        for filename, entries in pending.items():
+            collections[filename].mark_saved(entries)
+
+    @staticmethod
+    def _flush_shared(collections):
+        """
+        Flush under the lock files of every pickle file involved.
+
+        Catching up first is the compare step of a compare-and-swap: a record is only written
+        if no other process saved a newer version of it since this process last saw it.
+        """
+        with contextlib.ExitStack() as stack:
+            for filename in sorted(collections):
+                if not DataStorage.sqlite_table_for(filename):
+                    stack.enter_context(WriteAheadLog(filename).lock())
+            conflicts = {}
+            for filename, data in collections.items():
+                keys = DataStorage._catch_up(data, filename)
+                if keys:
+                    conflicts[filename] = keys
+
+            for filename, data in collections.items():
+                entries = data.pending_changes()
+                changes = [change for _, key_changes in entries for change in key_changes]
+                if changes and DataStorage.sqlite_table_for(filename):
+                    DataStorage.write_batches(filename, [changes])
+                elif changes:
+                    log = WriteAheadLog(filename)
+                    lsn = log.append(changes)
+                    if isinstance(data, TrackedDict):
+                        for change in changes:
+                            WriteAheadLog.record_version(data.versions, change, lsn)
+                        data.log_position = (log.file_id(), log.end_offset(), lsn)
+                data.mark_saved(entries)
+        if conflicts:
+            raise ConcurrentUpdateError(conflicts)
+
+    @staticmethod
+    def append_changes(changes, filename):
+        """
+        Persist only the changed records of a dictionary by appending them to its write-ahead log.
+
+        Args:
+            changes (list): Changes built with `WriteAheadLog.set_record`, `extend_record` or `delete_record`.
+            filename (str): The path of the data file the changes belong to.
+
+        Returns:
+            None
+        """
+        DataStorage.commit({filename: changes})
+
+    @staticmethod
+    def commit(changes_by_file):
+        """
+        Durably persist the changes of one operation that may touch several data files.
+
+        With group commit enabled, changes submitted by concurrent purchases within
+        `constants.GROUP_COMMIT_WINDOW_SECONDS` are written with one fsync per file and
+        acknowledged together. This call returns once the changes are on disk.
+
+        Args:
+            changes_by_file (dict): Lists of changes keyed by data file path.
+
+        Returns:
+            None
+        """
+        changes_by_file = {filename: changes for filename, changes in changes_by_file.items() if changes}
+        if not changes_by_file:
+            return
+        if constants.GROUP_COMMIT_ENABLED and DataStorage._backend is None:
+            DataStorage.group_committer().submit(changes_by_file).result()
+        else:
+            for filename, changes in changes_by_file.items():
+                DataStorage.write_batches(filename, [changes])
+
+    @staticmethod
+    def group_committer():
+        """
+        Return the shared group committer, starting it on first use.
+
+        Returns:
+            GroupCommitter: The committer configured from `constants`.
+        """
+        with DataStorage._committer_lock:
+            if DataStorage._committer is None:
+                DataStorage._committer = GroupCommitter(
+                    DataStorage.write_batches,
+                    window=constants.GROUP_COMMIT_WINDOW_SECONDS,
+                    max_batch=constants.GROUP_COMMIT_MAX_BATCH
+                )
+            return DataStorage._committer
+
+    @staticmethod
+    def write_batches(filename, batches):
+        """
+        Write several batches of changes for one data file with a single flush.
+
+        Args:
+            filename (str): The path of the data file.
+            batches (list): Lists of changes, one per submitted operation.
+
+        Returns:
+            None
+        """
+        if DataStorage._backend is not None:
+            DataStorage._backend.write_batches(filename, batches)
+            return
+        table = DataStorage.sqlite_table_for(filename)
+        if table:
+            DataStorage.sqlite_storage().apply_changes(table, [change for batch in batches for change in batch])
+        else:
+            WriteAheadLog(filename).append_batches(batches)
+
+    @staticmethod
+    def compact(filename):
+        """
+        Fold a file's write-ahead log into a new snapshot and drop the folded part of the log.
+
+        The snapshot is rebuilt from disk, so in-memory callers are not paused; only the short
+        steps that read the log's end and write the snapshot and cut the log's head hold the log's
+        writer lock. If a full save rewrote the snapshot and the log in between, the fold is
+        stale and is dropped.
+
+        Args:
+            filename (str): The path of the data file to compact.
+
+        Returns:
+            int: The number of changes folded into the snapshot.
+        """
+        if DataStorage._backend is not None:
+            return DataStorage._backend.compact(filename)
+        if DataStorage.sqlite_table_for(filename):
+            return 0
+        log = WriteAheadLog(filename)
+        # Other processes may append at any time in a shared directory, so keep them out throughout
+        with log.lock() if constants.SHARED_DATA_DIRECTORY else contextlib.nullcontext():
+            with log.lock():
+                end = log.end_offset()
+                log_id, base = log.file_id(), log.base_lsn()
+            batches = log.read_batches(end=end)
+            if not batches:
+                return 0
+
+            if os.path.exists(filename):
+                data, trailer = DataStorage._read_snapshot_trailer(filename)
+                checkpoint = trailer.get("checkpoint", 0)
+                versions = trailer.get("versions")
+                if versions is None:
+                    # Written without versions: every record is as new as the snapshot
+                    versions = {key: checkpoint for key in data}
+            else:
+                data, checkpoint, versions = {}, 0, {}
+            folded = 0
+            for lsn, batch in batches:
+                if lsn <= checkpoint:
+                    continue
+                for change in batch:
+                    WriteAheadLog.apply_change(data, change)
+                    WriteAheadLog.record_version(versions, change, lsn)
+                    folded += 1
+                checkpoint = lsn
+            DataStorage._notify_loaded(data, filename)
+
+            with log.lock():
+                if (log.file_id(), log.base_lsn()) != (log_id, base):
+                    print(f"Skipped compacting {filename}: it was saved in the meantime.")
+                    return 0
+                DataStorage.write_snapshot(data, filename, checkpoint, versions)
+                log.truncate_before(end, checkpoint)
+        print(f"Compacted {folded} logged changes into {filename}.")
+        return folded
+
+    @staticmethod
+    def migrate_to_sqlite(db_path=None):
+        """
+        Copy the users, tickets and sales report pickle files into an SQLite database.
+
+        Args:
+            db_path (str): The database to fill. Defaults to `constants.FILE_PATH_DATABASE`.
+
+        Returns:
+            SQLiteStorage: The filled database.
+        """
+        users = DataStorage._load_pickle(constants.FILE_PATH_USERS)
+        tickets = DataStorage._load_pickle(constants.FILE_PATH_TICKETS)
+        sales_reports = DataStorage._load_pickle(constants.FILE_PATH_SALES_REPORTS)
+        storage = SQLiteStorage(db_path or constants.FILE_PATH_DATABASE)
+        storage.import_data(users, tickets, sales_reports)
+        return storage
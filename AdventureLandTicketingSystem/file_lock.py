@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:  # POSIX
+    msvcrt = None
+
+
+class FileLock:
+    """
+    An exclusive advisory lock on a lock file, held by one process at a time.
+
+    Within a process the lock is shared by all threads and is re-entrant, so a thread
+    that already holds it can take it again (e.g. a flush that saves several files).
+    Other processes locking the same path wait until it is released. Uses `fcntl.flock`
+    on POSIX systems and `msvcrt.locking` on Windows.
+    """
+    _locks = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Initialize a lock.
+
+        Args:
+            path (str): The lock file. It is created if it doesn't exist and never deleted.
+        """
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    @staticmethod
+    def for_path(path):
+        """
+        Return the process-wide lock object for a lock file.
+
+        Args:
+            path (str): The lock file.
+
+        Returns:
+            FileLock: The lock shared by every caller in this process.
+        """
+        path = os.path.abspath(path)
+        with FileLock._registry_lock:
+            if path not in FileLock._locks:
+                FileLock._locks[path] = FileLock(path)
+            return FileLock._locks[path]
+
+    def acquire(self):
+        """Block until this thread holds the lock."""
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                self._lock_file()
+            except BaseException:
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+
+    def release(self):
+        """Release one level of the lock; the file lock is dropped with the last one."""
+        self.depth -= 1
+        if self.depth == 0:
+            try:
+                self._unlock_file()
+            finally:
+                self.thread_lock.release()
+        else:
+            self.thread_lock.release()
+
+    def _lock_file(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.file = open(self.path, 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                while True:
+                    self.file.seek(0)
+                    try:
+                        msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.01)  # LK_LOCK gives up after about 10 seconds
+        except BaseException:
+            self.file.close()
+            self.file = None
+            raise
+
+    def _unlock_file(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
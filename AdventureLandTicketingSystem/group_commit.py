@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GroupCommitter:
+    """
+    Batches writes from many concurrent purchases into one durable write per file.
+
+    Callers submit the changes of one purchase (possibly spanning several files) and
+    wait on the returned future. A single writer thread takes the first waiting
+    submission, keeps collecting more for up to `window` seconds or until `max_batch`
+    submissions are gathered, hands every file's batches to `write_batches` in one
+    call, and then acknowledges all of the submissions together.
+    """
+    def __init__(self, write_batches, window=0.002, max_batch=256):
+        """
+        Initialize the committer and start its writer thread.
+
+        Args:
+            write_batches (callable): Called as write_batches(filename, batches) where batches is a
+                list of change lists. It must make all of them durable with a single flush.
+            window (float): Seconds to keep collecting after the first submission of a group.
+            max_batch (int): Maximum number of submissions written as one group.
+        """
+        if max_batch < 1:
+            raise ValueError("Group commit batch size must be at least 1.")
+        self.write_batches = write_batches
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.groups_written = 0
+        self.submissions_written = 0
+        self.thread = threading.Thread(target=self._run, name="GroupCommitter", daemon=True)
+        self.thread.start()
+
+    def submit(self, changes_by_file):
+        """
+        Queue the changes of one purchase for the next group.
+
+        Args:
+            changes_by_file (dict): Lists of changes keyed by data file path.
+
+        Returns:
+            Future: Resolves to None once every change is on disk, or raises the write error.
+        """
+        future = Future()
+        self.pending.put((changes_by_file, future))
+        return future
+
+    def _collect(self):
+        group = [self.pending.get()]
+        deadline = time.monotonic() + self.window
+        while len(group) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    group.append(self.pending.get(timeout=remaining))
+                else:
+                    group.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        while True:
+            group = self._collect()
+            batches_by_file = {}
+            for changes_by_file, _ in group:
+                for filename, changes in changes_by_file.items():
+                    if changes:
+                        batches_by_file.setdefault(filename, []).append(list(changes))
+
+            errors = {}
+            for filename, batches in batches_by_file.items():
+                try:
+                    self.write_batches(filename, batches)
+                except Exception as e:
+                    errors[filename] = e
+
+            self.groups_written += 1
+            self.submissions_written += len(group)
+            for changes_by_file, future in group:
+                failed = [errors[filename] for filename in changes_by_file if filename in errors]
+                if failed:
+                    future.set_exception(failed[0])
+                else:
+                    future.set_result(None)
@@ -9,22 +9,43 @@ reports and manage discounts.
 
 
 
+import threading
 import tkinter as tk
 from tkinter import messagebox, ttk
 from tkinter import scrolledtext
 from data_storage import DataStorage
-from constants import FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS
+from change_tracking import TicketCatalog
+from log_compactor import LogCompactor
+from constants import (FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS, FILE_PATH_INVENTORY, ADULT_TICKET_TYPES,
+                       FILE_PATH_SALES_ROLLUPS, FILE_PATH_IDEMPOTENCY, PAYMENT_POLL_INTERVAL_MS,
+                       SALES_REPORT_PAGE_SIZE)
+from inventory import Inventory, HoldExpirer
+from pricing import PricingEngine
 from user import User
 from admin import Admin
 from ticket import Ticket
+from ticket_block import TicketBlock
 from payment import Payment
+from payment_gateway import PaymentProcessor
+from idempotency import IdempotencyStore
 from sales_report import SalesReport, Transaction
+from sales_index import SalesReportIndex
+from sales_analytics import SalesAnalytics
+from sales_archive import EndOfDayClose
 from utils import Utils
 
 # Load data
-users = DataStorage.load_from_file(FILE_PATH_USERS)
-tickets = DataStorage.load_from_file(FILE_PATH_TICKETS)
-sales_reports = DataStorage.load_from_file(FILE_PATH_SALES_REPORTS)
+users = DataStorage.load_tracked(FILE_PATH_USERS)
+tickets = DataStorage.load_tracked(FILE_PATH_TICKETS, TicketCatalog)
+sales_reports = DataStorage.load_tracked(FILE_PATH_SALES_REPORTS)
+sales_lock = threading.RLock()  # Held while sales_reports is changed, refreshed or saved
+inventory = Inventory(DataStorage.load_tracked(FILE_PATH_INVENTORY), FILE_PATH_INVENTORY)
+sales_rollups = DataStorage.load_tracked(FILE_PATH_SALES_ROLLUPS)
+pricing = PricingEngine(tickets)
+sales_index = SalesReportIndex(sales_reports, sales_rollups)
+analytics = SalesAnalytics(sales_reports)
+payments = PaymentProcessor.from_settings()
+purchases = IdempotencyStore(DataStorage.load_tracked(FILE_PATH_IDEMPOTENCY))
 
 # SalesReport objects have the 'transactions' attribute
 if sales_reports:
@@ -125,7 +146,7 @@ class TicketingApp:
         user_id = Utils.generate_unique_id()
         new_user = User(user_id, name, email, password)
         users[email] = new_user
-        DataStorage.save_to_file(users, FILE_PATH_USERS)
+        DataStorage.flush(users, FILE_PATH_USERS)
         messagebox.showinfo("Success", "Account created successfully!")
         self.create_login_frame()
 
@@ -153,9 +174,10 @@ class TicketingApp:
         email = self.login_email_entry.get()
         password = self.login_password_entry.get()
 
+        DataStorage.refresh(users, FILE_PATH_USERS)  # Accounts may have been created at another kiosk
         user = users.get(email)
         if user and user.password == password:
-            user.load_purchase_history(user.purchase_history)
+            # The purchase history is paged in when it is first needed
             self.current_user = user
             messagebox.showinfo("Success", f"Welcome, {user.name}!")
             self.create_user_dashboard()
@@ -176,6 +198,8 @@ class TicketingApp:
 
     def logout(self):
         """Clear the current user and display the welcome frame again."""
+        if self.current_user:
+            self.current_user.evict_purchase_history(FILE_PATH_USERS)
         self.current_user = None
         self.create_welcome_frame()
 
@@ -205,7 +229,7 @@ class TicketingApp:
                 validity = f"From {ticket.validity_start_date} to {ticket.validity_end_date}"
                 discount_percentage = f"{ticket.discount * 100}%"
                 tree.insert('', tk.END, values=(
-                    ticket.ticket_id,
+                    Utils.format_id(ticket.ticket_id),
                     ticket.ticket_type,
                     ticket.price,
                     validity,
@@ -229,6 +253,7 @@ class TicketingApp:
         ttk.Label(self.purchase_frame, text="Purchase Ticket", style='Header.TLabel').pack(pady=20)
 
         ttk.Label(self.purchase_frame, text="Select Ticket Type:").pack(pady=5)
+        DataStorage.refresh(tickets, FILE_PATH_TICKETS)  # Pick up discounts changed at another kiosk
         ticket_options = list(tickets.keys())
         self.ticket_var = tk.StringVar()
         self.ticket_combobox = ttk.Combobox(self.purchase_frame, textvariable=self.ticket_var, values=ticket_options, state='readonly')
@@ -250,7 +275,10 @@ class TicketingApp:
         self.payment_combobox.set("Select Payment Method")
         self.payment_combobox.pack()
 
-        ttk.Button(self.purchase_frame, text="Purchase", command=self.purchase_ticket).pack(pady=10)
+        # Clicking Purchase again after an error or timeout retries the same purchase
+        self.purchase_key = Utils.format_id(Utils.generate_unique_id())
+        self.purchase_button = ttk.Button(self.purchase_frame, text="Purchase", command=self.purchase_ticket)
+        self.purchase_button.pack(pady=10)
         ttk.Button(self.purchase_frame, text="Back", command=self.create_user_dashboard).pack()
 
     def purchase_ticket(self):
@@ -278,16 +306,28 @@ class TicketingApp:
             messagebox.showerror("Error", "Please select a payment method.")
             return
 
+        reservation = None
+        claimed = None
         try:
+            # A retried purchase shows the receipt of the original one
+            fingerprint = (self.current_user.email, ticket_type, visit_date, num_tickets, payment_method.lower())
+            completed = purchases.begin(self.purchase_key, fingerprint)
+            if completed is not None:
+                messagebox.showinfo("Success", "This purchase was already completed.\n\n" +
+                                    receipt_text(completed.result))
+                self.create_user_dashboard()
+                return
+            claimed = self.purchase_key
+
             ticket_info = tickets.get(ticket_type)
+
+            # Hold the tickets while the purchase is completed; they are given back if it is abandoned
+            reservation = inventory.reserve(visit_date, ticket_type, num_tickets)
             adult_present = True  
 
             # For Child Ticket, ensure an adult ticket is purchased
             if ticket_type == "Child Ticket":
-                adult_present = any(
-                    t.ticket_type in ["Single-Day Pass", "Two-Day Pass", "Annual Membership", "VIP Experience Pass"]
-                    for t in self.current_user.purchase_history
-                )
+                adult_present = self.current_user.count_tickets(*ADULT_TICKET_TYPES) > 0
                 if not adult_present:
                     response = messagebox.askyesno("Adult Ticket Required", "An adult ticket must be purchased with a Child Ticket. Would you like to purchase an adult ticket first?")
                     if response:
@@ -311,61 +351,88 @@ class TicketingApp:
             # Apply discounts and set validity inside ticket
             payment_method_key = payment_method.lower()
             payment_method_key = payment_method_key.replace(" ", " ")
-            ticket.apply_discounts(self.current_user, num_tickets, payment_method_key)
+            pricing.price_ticket(ticket, self.current_user, num_tickets, payment_method_key)
             ticket.set_validity_dates(self.current_user)
 
             # Validate ticket conditions
             ticket.validate(
                 group_size=num_tickets,
                 adult_present=adult_present,
-                tickets_sold_today=0  # Implement tracking if needed
+                tickets_sold_today=inventory.sold(visit_date, ticket_type)
             )
 
             # Calculate total price
             total_price = ticket.price * num_tickets
 
-            # Process payment
-            payment_id = Utils.generate_unique_id()
-            payment = Payment(payment_id, payment_method_key)
-            payment_success = payment.process_payment(total_price)
-            if not payment_success:
-                messagebox.showerror("Error", "Payment failed!")
-                return
+            # Hold the tickets until the purchase is committed or released, so they cannot expire
+            # and be sold to someone else while the customer is being charged
+            inventory.renew(reservation, ttl=None)
 
-            # Update sales report
-            update_sales_report(self.current_user, ticket, num_tickets)
+            # Process payment in the background, so the window keeps responding while the gateway answers
+            payment_id = Utils.generate_unique_id()
+            payment_key = IdempotencyStore.derive_key(claimed, "payment", fingerprint, round(total_price, 2))
+            payment = Payment(payment_id, payment_method_key, idempotency_key=payment_key)
+            self.purchase_button.config(state=tk.DISABLED)
+            self.wait_for_payment(payments.submit(payment, total_price), self.complete_purchase, reservation,
+                                  claimed, fingerprint, payment, ticket, num_tickets, payment_method_key, total_price)
+            reservation = claimed = None  # Completed or released by complete_purchase
 
-            # Add tickets to user's purchase history
-            for _ in range(num_tickets):
-                individual_ticket_id = Utils.generate_unique_id()
-                individual_ticket = Ticket(
-                    individual_ticket_id,
-                    ticket.ticket_type,
-                    ticket.price,
-                    ticket.validity,
-                    ticket.visit_date
-                )
-                individual_ticket.discount = ticket.discount
-                individual_ticket.validity_start_date = ticket.validity_start_date
-                individual_ticket.validity_end_date = ticket.validity_end_date
-                self.current_user.purchase_ticket(individual_ticket)
+        except Exception as e:
+            messagebox.showerror("Error", str(e))
+        finally:
+            if reservation is not None:
+                inventory.release(reservation)  # Does nothing once the purchase was committed
+            if claimed is not None:
+                purchases.end(claimed)
+
+    def wait_for_payment(self, outcome, on_done, *args):
+        """Call on_done(outcome, *args) once a submitted payment is settled, checking from the Tkinter main loop."""
+        if not outcome.done():
+            self.root.after(PAYMENT_POLL_INTERVAL_MS, self.wait_for_payment, outcome, on_done, *args)
+            return
+        on_done(outcome, *args)
 
-            # Save data
-            DataStorage.save_to_file(users, FILE_PATH_USERS)
+    def complete_purchase(self, outcome, reservation, idempotency_key, fingerprint, payment, ticket, num_tickets,
+                          payment_method_key, total_price):
+        """Record the purchase and its receipt once its payment is approved, or give the held tickets back."""
+        try:
+            if not outcome.result():
+                # Nothing was taken, so trying again is a new payment rather than a retry of this one
+                self.purchase_key = Utils.format_id(Utils.generate_unique_id())
+                messagebox.showerror("Error", "Payment failed!")
+                return
+            inventory.commit(reservation)
+
+            # The end-of-day close must not replace or save the sales reports in between
+            with sales_lock:
+                # Update sales report
+                transaction = update_sales_report(self.current_user, ticket, num_tickets, payment_method_key)
+
+                # Add the tickets to user's purchase history as one block
+                block = TicketBlock(ticket, num_tickets)
+                self.current_user.purchase_block(block)
+
+                # Save the sale, the new tickets, the sold count and the receipt in one commit
+                receipt = purchase_receipt(block, total_price, payment, transaction)
+                purchases.record(idempotency_key, receipt, fingerprint)
+                DataStorage.flush_all({
+                    FILE_PATH_SALES_REPORTS: sales_reports,
+                    FILE_PATH_USERS: users,
+                    FILE_PATH_INVENTORY: inventory.sales,
+                    FILE_PATH_IDEMPOTENCY: purchases.records
+                })
 
             # Show success message with details
-            discount_percentage = ticket.discount * 100
-            messagebox.showinfo(
-                "Success",
-                f"Ticket purchased successfully!\n\n"
-                f"Discount Applied: {discount_percentage}%\n"
-                f"Total Price: {total_price} DHS\n"
-                f"Validity: From {ticket.validity_start_date} to {ticket.validity_end_date}"
-            )
+            messagebox.showinfo("Success", "Ticket purchased successfully!\n\n" + receipt_text(receipt))
             self.create_user_dashboard()
 
         except Exception as e:
             messagebox.showerror("Error", str(e))
+        finally:
+            inventory.release(reservation)  # Does nothing once the purchase was committed
+            purchases.end(idempotency_key)
+            if self.purchase_button.winfo_exists():
+                self.purchase_button.config(state=tk.NORMAL)
 
     def create_admin_login_frame(self):
         """Display the admin login frame for admin authentication."""
@@ -405,23 +472,49 @@ class TicketingApp:
         ttk.Label(self.admin_dashboard, text="Admin Dashboard", style='Header.TLabel').pack(pady=20)
 
         ttk.Button(self.admin_dashboard, text="View Sales Reports", command=self.view_sales_reports, width=25).pack(pady=10)
+        ttk.Button(self.admin_dashboard, text="Period Report", command=self.period_report_frame, width=25).pack(pady=10)
+        ttk.Button(self.admin_dashboard, text="Sales Analytics", command=self.sales_analytics_frame, width=25).pack(pady=10)
         ttk.Button(self.admin_dashboard, text="Manage Discounts", command=self.manage_discounts_frame, width=25).pack(pady=10)
         ttk.Button(self.admin_dashboard, text="Logout", command=self.create_welcome_frame, width=25).pack(pady=10)
 
     def view_sales_reports(self):
-        """Display the sales reports for admin to view sales data."""
+        """Display the sales totals read from the sales rollups, with each day's transactions loaded when it is expanded."""
         self.clear_frames()
         self.reports_frame = ttk.Frame(self.root)
         self.reports_frame.pack(fill=tk.BOTH, expand=True)
 
         ttk.Label(self.reports_frame, text="Sales Reports", style='Header.TLabel').pack(pady=20)
 
+        refresh_sales_reports()  # Include sales made at other kiosks
+        DataStorage.refresh(sales_rollups, FILE_PATH_SALES_ROLLUPS)
         if not sales_reports:
             ttk.Label(self.reports_frame, text="No sales reports available.").pack()
         else:
+            # Totals come from the period and report rollups, without walking the transactions
+            rollup = sales_index.rollup()
+            total = rollup.totals()
+            ttk.Label(self.reports_frame, text=f"Revenue: {total.revenue:.2f} DHS, Tickets: {total.quantity}, "
+                                               f"Transactions: {total.count}").pack(pady=5)
+            summary = ttk.Treeview(self.reports_frame, columns=('group', 'revenue', 'quantity', 'count'),
+                                   show='headings', height=8)
+            summary.pack(fill=tk.X)
+            summary.heading('group', text='Group')
+            summary.heading('revenue', text='Revenue (DHS)')
+            summary.heading('quantity', text='Tickets')
+            summary.heading('count', text='Transactions')
+            for dimension in ('day', 'ticket_type', 'payment_method'):
+                for key, totals in sorted(rollup.breakdown(dimension).items(), key=lambda item: str(item[0])):
+                    summary.insert('', tk.END, values=(
+                        key if key is not None else "Unknown",
+                        f"{totals.revenue:.2f}",
+                        totals.quantity,
+                        totals.count
+                    ))
+
             # Create a Treeview
             columns = ('date', 'transaction_id', 'customer_name', 'ticket_type', 'quantity', 'total_price', 'date_of_purchase')
-            tree = ttk.Treeview(self.reports_frame, columns=columns, show='headings')
+            tree = ttk.Treeview(self.reports_frame, columns=columns, show='tree headings')
+            tree.column('#0', width=30, stretch=False)
             tree.pack(fill=tk.BOTH, expand=True)
 
             tree.heading('date', text='Date')
@@ -432,17 +525,43 @@ class TicketingApp:
             tree.heading('total_price', text='Total Price')
             tree.heading('date_of_purchase', text='Date of Purchase')
 
-            for report_date, report in sales_reports.items():
-                for transaction in report.transactions:
-                    tree.insert('', tk.END, values=(
+            # One row per day with its totals; the transactions are read a page at a time once it is expanded
+            pending = {}  # Placeholder row -> (day, offset of the next page)
+            loaded = {}  # Day -> its transactions, read once
+            for report_date, totals in sales_index.daily_totals():
+                day = tree.insert('', tk.END, values=(report_date, "", "", "", totals.quantity,
+                                                      f"{totals.revenue:.2f}", f"{totals.count} transactions"))
+                pending[tree.insert(day, tk.END, values=("Loading...",))] = (report_date, 0)
+
+            def load_page(event):
+                opened = tree.focus()
+                placeholders = [row for row in tree.get_children(opened) if row in pending]
+                if not placeholders:
+                    return
+                report_date, offset = pending.pop(placeholders[0])
+                tree.delete(placeholders[0])
+                day = tree.parent(opened) or opened
+                if day != opened:
+                    tree.delete(opened)  # The "more" row, replaced by the page it stood for
+                if report_date not in loaded:
+                    loaded[report_date] = sales_reports[report_date].transactions
+                transactions = loaded[report_date]
+                for transaction in transactions[offset:offset + SALES_REPORT_PAGE_SIZE]:
+                    tree.insert(day, tk.END, values=(
                         report_date,
-                        transaction.transaction_id,
+                        Utils.format_id(transaction.transaction_id),
                         transaction.customer_name,
                         transaction.ticket_type,
                         transaction.quantity,
                         transaction.total_price,
                         transaction.date_of_purchase
                     ))
+                offset += SALES_REPORT_PAGE_SIZE
+                if offset < len(transactions):
+                    more = tree.insert(day, tk.END, values=(f"{len(transactions) - offset} more...",))
+                    pending[tree.insert(more, tk.END, values=("Loading...",))] = (report_date, offset)
+
+            tree.bind('<<TreeviewOpen>>', load_page)
 
             # Add vertical scrollbar
             scrollbar = ttk.Scrollbar(self.reports_frame, orient=tk.VERTICAL, command=tree.yview)
@@ -451,6 +570,126 @@ class TicketingApp:
 
         ttk.Button(self.reports_frame, text="Back", command=self.create_admin_dashboard).pack(pady=10)
 
+    def period_report_frame(self):
+        """Display the sales totals of a date range, optionally for one ticket type."""
+        self.clear_frames()
+        self.period_frame = ttk.Frame(self.root)
+        self.period_frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(self.period_frame, text="Period Report", style='Header.TLabel').pack(pady=20)
+
+        ttk.Label(self.period_frame, text="Start Date (YYYY-MM-DD, blank for the first sale):").pack()
+        start_entry = ttk.Entry(self.period_frame)
+        start_entry.pack()
+        ttk.Label(self.period_frame, text="End Date (YYYY-MM-DD, blank for the last sale):").pack()
+        end_entry = ttk.Entry(self.period_frame)
+        end_entry.pack()
+        ttk.Label(self.period_frame, text="Ticket Type:").pack()
+        type_var = tk.StringVar(value="All Ticket Types")
+        ttk.Combobox(self.period_frame, textvariable=type_var, state='readonly',
+                     values=["All Ticket Types"] + list(tickets.keys())).pack()
+
+        total_label = ttk.Label(self.period_frame, text="")
+        customers_label = ttk.Label(self.period_frame, text="", justify=tk.LEFT)
+        summary = ttk.Treeview(self.period_frame, columns=('group', 'revenue', 'quantity', 'count'),
+                               show='headings', height=12)
+        summary.heading('group', text='Group')
+        summary.heading('revenue', text='Revenue (DHS)')
+        summary.heading('quantity', text='Tickets')
+        summary.heading('count', text='Transactions')
+
+        def run_report():
+            start = start_entry.get().strip() or None
+            end = end_entry.get().strip() or None
+            ticket_type = type_var.get() if type_var.get() != "All Ticket Types" else None
+            refresh_sales_reports()  # Include sales made at other kiosks
+            DataStorage.refresh(sales_rollups, FILE_PATH_SALES_ROLLUPS)
+            try:
+                reports = sales_index.reports_between(start, end)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            summary.delete(*summary.get_children())
+            customers_label.config(text="")
+            if not reports:
+                total_label.config(text="No sales in this period.")
+                return
+            total = sales_index.totals(start, end, ticket_type)
+            total_label.config(text=f"{reports[0].date} to {reports[-1].date} - Revenue: {total.revenue:.2f} DHS, "
+                                    f"Tickets: {total.quantity}, Transactions: {total.count}")
+            if ticket_type is None:
+                rollup = sales_index.rollup(start, end)
+                customers_label.config(text="\n".join(rollup.customer_lines()))
+                groups = [(key, totals) for dimension in ('day', 'ticket_type', 'payment_method')
+                          for key, totals in sorted(rollup.breakdown(dimension).items(), key=lambda item: str(item[0]))]
+            else:
+                groups = [(report.date, report.rollup.totals('ticket_type', ticket_type)) for report in reports]
+            for key, totals in groups:
+                if totals.count:
+                    summary.insert('', tk.END, values=(
+                        key if key is not None else "Unknown",
+                        f"{totals.revenue:.2f}",
+                        totals.quantity,
+                        totals.count
+                    ))
+
+        ttk.Button(self.period_frame, text="Run Report", command=run_report).pack(pady=10)
+        total_label.pack(pady=5)
+        customers_label.pack(pady=5)
+        summary.pack(fill=tk.BOTH, expand=True)
+        ttk.Button(self.period_frame, text="Back", command=self.create_admin_dashboard).pack(pady=10)
+
+    def sales_analytics_frame(self):
+        """Display revenue per ticket type per day, the average basket and week-over-week changes."""
+        self.clear_frames()
+        self.analytics_frame = ttk.Frame(self.root)
+        self.analytics_frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(self.analytics_frame, text="Sales Analytics", style='Header.TLabel').pack(pady=20)
+
+        refresh_sales_reports()  # Include sales made at other kiosks
+        try:
+            pivot = analytics.revenue_by_type_by_day()
+            basket = analytics.average_basket()
+            weekly = analytics.week_over_week()
+        except ImportError as e:
+            ttk.Label(self.analytics_frame, text=str(e)).pack()
+            pivot = None
+        if pivot is not None and not len(pivot.days):
+            ttk.Label(self.analytics_frame, text="No sales reports available.").pack()
+        elif pivot is not None:
+            ttk.Label(self.analytics_frame, text=f"Average Basket: {basket.tickets:.2f} tickets, {basket.revenue:.2f} DHS "
+                                                 f"({basket.transactions} transactions, {basket.customers} customers)").pack(pady=5)
+
+            columns = ['date'] + [f'type{column}' for column in range(len(pivot.ticket_types))]
+            tree = ttk.Treeview(self.analytics_frame, columns=columns, show='headings', height=10)
+            tree.pack(fill=tk.BOTH, expand=True)
+            tree.heading('date', text='Date')
+            for column, ticket_type in zip(columns[1:], pivot.ticket_types):
+                tree.heading(column, text=ticket_type)
+            for day, revenue in zip(pivot.days, pivot.revenue):
+                tree.insert('', tk.END, values=[str(day)] + [f"{value:.2f}" for value in revenue])
+
+            weeks = ttk.Treeview(self.analytics_frame, columns=('week', 'revenue', 'quantity', 'change'),
+                                 show='headings', height=6)
+            weeks.pack(fill=tk.X)
+            weeks.heading('week', text='Week of')
+            weeks.heading('revenue', text='Revenue (DHS)')
+            weeks.heading('quantity', text='Tickets')
+            weeks.heading('change', text='Change')
+            for week_start, revenue, quantity, change, ratio in zip(weekly.week_start, weekly.revenue, weekly.quantity,
+                                                                    weekly.revenue_change, weekly.revenue_change_ratio):
+                if not revenue and not change:
+                    continue  # Only the first of a run of weeks without sales is shown
+                weeks.insert('', tk.END, values=(
+                    str(week_start),
+                    f"{revenue:.2f}",
+                    quantity,
+                    f"{ratio:+.1%}" if ratio == ratio else ""  # NaN for the first week
+                ))
+
+        ttk.Button(self.analytics_frame, text="Back", command=self.create_admin_dashboard).pack(pady=10)
+
     def manage_discounts_frame(self):
         """Display the discounts management frame for admin to manage discounts."""
         self.clear_frames()
@@ -489,13 +728,21 @@ class TicketingApp:
             messagebox.showerror("Error", "Discount must be a decimal between 0 and 1.")
             return
 
-        tickets[ticket_type]['discount'] = discount
-        DataStorage.save_to_file(tickets, FILE_PATH_TICKETS)
+        tickets.set_discount(ticket_type, discount)
+        DataStorage.flush(tickets, FILE_PATH_TICKETS)
         messagebox.showinfo("Success", f"Discount updated for {ticket_type}.")
         self.create_admin_dashboard()
 
-def update_sales_report(user, ticket, quantity):
-    """Update the daily sales report with the transaction."""
+def refresh_sales_reports():
+    """Read back the sales saved at other kiosks, while the end-of-day close is not rewriting them."""
+    with sales_lock:
+        DataStorage.refresh(sales_reports, FILE_PATH_SALES_REPORTS)
+
+def update_sales_report(user, ticket, quantity, payment_method=None):
+    """
+    Update the daily sales report and its rollup with the transaction, and return the transaction.
+    The caller flushes sales_reports.
+    """
     today = Utils.get_today_date()
     report = sales_reports.get(today)
     if not report:
@@ -511,14 +758,41 @@ def update_sales_report(user, ticket, quantity):
         ticket_type=ticket.ticket_type,
         quantity=quantity,
         total_price=ticket.price * quantity,
-        date_of_purchase=today
+        date_of_purchase=today,
+        payment_method=payment_method
     )
 
     # Add the transaction to the report
     report.add_transaction(transaction)
-    DataStorage.save_to_file(sales_reports, FILE_PATH_SALES_REPORTS)
+    return transaction
+
+def purchase_receipt(block, total_price, payment, transaction):
+    """Summarize a completed purchase, as returned to retries of it."""
+    return {
+        "ticket_type": block.ticket_type,
+        "first_ticket_id": block.ticket_id,
+        "quantity": block.quantity,
+        "discount": block.discount,
+        "total_price": total_price,
+        "validity_start_date": block.validity_start_date,
+        "validity_end_date": block.validity_end_date,
+        "payment_reference": payment.reference,
+        "transaction_id": transaction.transaction_id,
+    }
+
+def receipt_text(receipt):
+    """Format the discount, total and validity of a purchase for a message box."""
+    return (f"Discount Applied: {receipt['discount'] * 100}%\n"
+            f"Total Price: {receipt['total_price']} DHS\n"
+            f"Validity: From {receipt['validity_start_date']} to {receipt['validity_end_date']}")
 
 if __name__ == "__main__":
+    if purchases.purge():
+        DataStorage.flush(purchases.records, FILE_PATH_IDEMPOTENCY)
+    LogCompactor([FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS, FILE_PATH_INVENTORY,
+                  FILE_PATH_SALES_ROLLUPS, FILE_PATH_IDEMPOTENCY]).start()
+    HoldExpirer(inventory).start()
+    EndOfDayClose(sales_reports, sales_rollups, lock=sales_lock).start()
     root = tk.Tk()
     app = TicketingApp(root)
     root.mainloop()
@@ -0,0 +1,264 @@
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:  # POSIX
+    msvcrt = None
+
+from constants import DIRECTORY_PATH_NODE_LEASES, ID_EPOCH_MS, ID_NODE_BITS, ID_SEQUENCE_BITS, ID_LEASE_WINDOW_MS
+
+TIMESTAMP_SHIFT = ID_NODE_BITS + ID_SEQUENCE_BITS
+TIMESTAMP_LIMIT = 1 << (63 - TIMESTAMP_SHIFT)  # IDs stay positive signed 64-bit integers
+NODE_COUNT = 1 << ID_NODE_BITS
+SEQUENCE_COUNT = 1 << ID_SEQUENCE_BITS
+
+
+class NodeLease:
+    """
+    The exclusive use of one node ID by this process, among all processes sharing the lease folder.
+
+    Every node ID has a lease file that its holder keeps locked for as long as it runs. The
+    operating system drops the lock when the process exits, even if it crashes, so leases are
+    never left stale. The file also holds a high-water mark: the timestamp up to which the
+    holder may have issued IDs. The next holder of the node starts after it, even if the
+    clock went back in between.
+    """
+    HIGH_WATER = struct.Struct("<q")
+
+    def __init__(self, node_id, file):
+        """
+        Initialize a lease on a locked lease file.
+
+        Args:
+            node_id (int): The leased node ID.
+            file: The lease file, opened for reading and writing and locked by this process.
+        """
+        self.node_id = node_id
+        self.file = file
+        file.seek(0)
+        raw = file.read(NodeLease.HIGH_WATER.size)
+        self.high_water = NodeLease.HIGH_WATER.unpack(raw)[0] if len(raw) == NodeLease.HIGH_WATER.size else 0
+
+    @staticmethod
+    def acquire(directory=DIRECTORY_PATH_NODE_LEASES):
+        """
+        Lease the first node ID that no running process holds.
+
+        Args:
+            directory (str): The folder of the lease files, shared by every kiosk that issues IDs.
+
+        Returns:
+            NodeLease: The lease.
+
+        Raises:
+            RuntimeError: If every node ID is leased.
+        """
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        first = os.getpid() % NODE_COUNT  # Spread processes that start together over the node IDs
+        for step in range(NODE_COUNT):
+            node_id = (first + step) % NODE_COUNT
+            path = os.path.join(directory, f"node-{node_id}.lease")
+            file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+            if NodeLease._try_lock(file):
+                return NodeLease(node_id, file)
+            file.close()
+        raise RuntimeError(f"Every node ID in {directory} is leased by a running process.")
+
+    @staticmethod
+    def _try_lock(file):
+        try:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def raise_high_water(self, timestamp):
+        """
+        Record that IDs may be issued up to a timestamp, before issuing them.
+
+        Args:
+            timestamp (int): Milliseconds since `ID_EPOCH_MS`.
+
+        Returns:
+            None
+        """
+        self.file.seek(0)
+        self.file.write(NodeLease.HIGH_WATER.pack(timestamp))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.high_water = timestamp
+
+    def release(self):
+        """Give the node ID back."""
+        if self.file is not None:
+            self.file.close()  # Closing the file drops the lock
+            self.file = None
+
+
+class SnowflakeIdGenerator:
+    """
+    Time-sortable 64-bit integer IDs for tickets, payments, transactions, reports and users.
+
+    An ID packs the milliseconds since `ID_EPOCH_MS`, the node ID of the issuing process and
+    a sequence number within the millisecond, from the most significant bits down. IDs of one
+    node always increase, and IDs of all nodes sort by the time they were issued, so they can
+    be kept in integer arrays and scanned by time range (see `first_id_at`).
+
+    The node ID comes from a `NodeLease`, so processes sharing the data folder never issue the
+    same ID. When the sequence runs out, or the clock goes back, the generator moves on to the
+    next millisecond instead of waiting for the clock. Use `Utils.format_id` to show an ID.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, lease, clock=time.time):
+        """
+        Initialize a generator.
+
+        Args:
+            lease (NodeLease): The lease of the node ID to issue IDs for.
+            clock (callable): Returns the current time in seconds since the Unix epoch.
+        """
+        self.lease = lease
+        self.node_id = lease.node_id
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Start after the last millisecond the previous holder of the node may have used
+        self.last_timestamp = lease.high_water
+        self.sequence = SEQUENCE_COUNT - 1
+
+    @staticmethod
+    def default():
+        """
+        Return the generator of this process, leasing a node ID on first use.
+
+        Returns:
+            SnowflakeIdGenerator: The process-wide generator.
+        """
+        with SnowflakeIdGenerator._default_lock:
+            if SnowflakeIdGenerator._default is None:
+                SnowflakeIdGenerator._default = SnowflakeIdGenerator(NodeLease.acquire())
+            return SnowflakeIdGenerator._default
+
+    @staticmethod
+    def _forget_default():
+        # A forked child shares the parent's lease: it leases a node ID of its own on first use
+        generator = SnowflakeIdGenerator._default
+        SnowflakeIdGenerator._default = None
+        SnowflakeIdGenerator._default_lock = threading.Lock()
+        if generator is not None and generator.lease.file is not None:
+            generator.lease.file.close()  # The parent still holds the lock through its own descriptor
+            generator.lease.file = None
+
+    def next_id(self):
+        """
+        Issue one ID.
+
+        Returns:
+            int: The ID.
+        """
+        return self.reserve(1)
+
+    def reserve(self, count):
+        """
+        Issue `count` consecutive IDs, e.g. for a block of tickets.
+
+        Args:
+            count (int): The number of IDs.
+
+        Returns:
+            int: The first ID. The others are `offset_id(first_id, 1)` to `offset_id(first_id, count - 1)`.
+        """
+        if count <= 0:
+            raise ValueError("The number of IDs must be greater than 0.")
+        with self.lock:
+            timestamp = max(int(self.clock() * 1000) - ID_EPOCH_MS, self.last_timestamp)
+            sequence = self.sequence + 1 if timestamp == self.last_timestamp else 0
+            if sequence == SEQUENCE_COUNT:
+                timestamp += 1
+                sequence = 0
+            last_timestamp, last_sequence = divmod(timestamp * SEQUENCE_COUNT + sequence + count - 1, SEQUENCE_COUNT)
+            if last_timestamp >= TIMESTAMP_LIMIT:
+                raise ValueError("The ID timestamp is out of range; check the system clock.")
+            if last_timestamp >= self.lease.high_water:
+                self.lease.raise_high_water(last_timestamp + ID_LEASE_WINDOW_MS)
+            self.last_timestamp = last_timestamp
+            self.sequence = last_sequence
+            return SnowflakeIdGenerator.make_id(timestamp, self.node_id, sequence)
+
+    @staticmethod
+    def make_id(timestamp, node_id, sequence):
+        """Pack a timestamp (milliseconds since `ID_EPOCH_MS`), node ID and sequence number into an ID."""
+        return (timestamp << TIMESTAMP_SHIFT) | (node_id << ID_SEQUENCE_BITS) | sequence
+
+    @staticmethod
+    def offset_id(first_id, offset):
+        """
+        Return the ID `offset` places after `first_id` in a range issued by `reserve`.
+
+        Args:
+            first_id (int): The first ID of the range.
+            offset (int): The position in the range.
+
+        Returns:
+            int: The ID.
+        """
+        if not offset:
+            return first_id
+        timestamp = first_id >> TIMESTAMP_SHIFT
+        node_id = (first_id >> ID_SEQUENCE_BITS) & (NODE_COUNT - 1)
+        carry, sequence = divmod((first_id & (SEQUENCE_COUNT - 1)) + offset, SEQUENCE_COUNT)
+        return SnowflakeIdGenerator.make_id(timestamp + carry, node_id, sequence)
+
+    @staticmethod
+    def timestamp_of(identifier):
+        """
+        Return when an ID was issued.
+
+        Args:
+            identifier (int): The ID.
+
+        Returns:
+            datetime: The time, in UTC, to the millisecond.
+        """
+        milliseconds = (identifier >> TIMESTAMP_SHIFT) + ID_EPOCH_MS
+        return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc)
+
+    @staticmethod
+    def node_of(identifier):
+        """Return the node ID that issued an ID."""
+        return (identifier >> ID_SEQUENCE_BITS) & (NODE_COUNT - 1)
+
+    @staticmethod
+    def first_id_at(moment):
+        """
+        Return the smallest ID that can be issued at or after a time, to scan IDs by time range.
+
+        The IDs issued from `start` up to (not including) `end` are those from `first_id_at(start)`
+        up to (not including) `first_id_at(end)`.
+
+        Args:
+            moment (datetime): The time; naive datetimes are local time.
+
+        Returns:
+            int: The ID bound.
+        """
+        timestamp = max(round(moment.timestamp() * 1000) - ID_EPOCH_MS, 0)
+        return SnowflakeIdGenerator.make_id(timestamp, 0, 0)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=SnowflakeIdGenerator._forget_default)
@@ -0,0 +1,226 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from constants import FILE_PATH_IDEMPOTENCY, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_WAIT_SECONDS
+from data_storage import DataStorage
+
+
+class TTLCache:
+    """
+    A bounded map whose entries expire `ttl` seconds after they were put.
+
+    Lookups and puts are O(1). When full, the entry put longest ago is dropped. Not thread-safe
+    on its own; callers hold their own lock.
+    """
+    def __init__(self, capacity=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL_SECONDS, clock=time.monotonic):
+        """
+        Initialize an empty cache.
+
+        Args:
+            capacity (int): The most entries kept.
+            ttl (float): Seconds an entry is kept.
+            clock (callable): Returns the current time in seconds.
+        """
+        if capacity < 1:
+            raise ValueError("Cache capacity must be at least 1.")
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (expires at, value), oldest first
+
+    def get(self, key, default=None):
+        """Return the value of a key, or `default` if it is missing or expired."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= self.clock():
+            del self.entries[key]
+            return default
+        return entry[1]
+
+    def put(self, key, value):
+        """Store a value, replacing any previous one, and drop the oldest entry if the cache is full."""
+        self.entries.pop(key, None)
+        self.entries[key] = (self.clock() + self.ttl, value)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class IdempotencyRecord:
+    """
+    The saved outcome of a request made with an idempotency key.
+    """
+    __slots__ = ("key", "fingerprint", "result", "created_at")
+
+    def __init__(self, key, fingerprint, result, created_at):
+        """
+        Initialize a record.
+
+        Args:
+            key (str): The idempotency key.
+            fingerprint (tuple): What was requested, to reject the key being reused for something else.
+            result: The outcome returned to the caller.
+            created_at (float): When the request completed, in seconds since the epoch.
+        """
+        self.key = key
+        self.fingerprint = fingerprint
+        self.result = result
+        self.created_at = created_at
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in IdempotencyRecord.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class IdempotencyStore:
+    """
+    Remembers the outcome of requests made with an idempotency key, so a retry returns the
+    original outcome instead of doing the work again.
+
+    A request calls `begin` with its key. The first call claims the key and returns None; the
+    caller does the work, calls `record` with its outcome, saves `records` together with the
+    rest of its changes, and calls `end`. Later calls with the key return the recorded outcome.
+    A call made while the key is claimed by another thread waits for it to end, so two
+    concurrent retries never both do the work; if the work failed without recording an outcome,
+    the waiting call claims the key and tries again.
+
+    Outcomes are looked up in a bounded in-memory `TTLCache`, and saved as `IdempotencyRecord`s
+    in a tracked dictionary, so they survive a restart and are seen by other kiosks sharing the
+    data files. Both expire after `ttl` seconds.
+    """
+    def __init__(self, records, filename=FILE_PATH_IDEMPOTENCY, ttl=IDEMPOTENCY_TTL_SECONDS,
+                 capacity=IDEMPOTENCY_CACHE_SIZE, wait=IDEMPOTENCY_WAIT_SECONDS):
+        """
+        Initialize the store.
+
+        Args:
+            records (TrackedDict): The saved records, keyed by idempotency key.
+            filename (str): The data file of the records.
+            ttl (float): Seconds an outcome is remembered.
+            capacity (int): The most outcomes kept in memory.
+            wait (float): Seconds to wait for another thread working on the same key.
+        """
+        self.records = records
+        self.filename = filename
+        self.ttl = ttl
+        self.wait = wait
+        self.cache = TTLCache(capacity, ttl)
+        self.claims = {}  # Keys being worked on -> Event set when the work ends
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def derive_key(key, *parts):
+        """
+        Return the key of a step of a request (e.g. the payment of a purchase) for what it asks for.
+
+        Retrying with the same parts gives the same key; changing any of them (the quantity, the
+        amount, the payment method) gives another, so the step is never answered with the
+        outcome of a different one.
+
+        Args:
+            key (str): The idempotency key of the request.
+            parts: What the step asks for.
+
+        Returns:
+            str: The step's key.
+        """
+        return f"{key}/{hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:16]}"
+
+    def begin(self, key, fingerprint=None):
+        """
+        Claim a key, or return the outcome recorded for it.
+
+        Args:
+            key (str): The idempotency key.
+            fingerprint (tuple): What is requested; a key recorded with another fingerprint is rejected.
+
+        Returns:
+            IdempotencyRecord: The recorded outcome, or None if the key was claimed (call `end` when done).
+
+        Raises:
+            ValueError: If the key was used for a different request, or is still being worked on
+                after `wait` seconds.
+        """
+        deadline = time.monotonic() + self.wait
+        while True:
+            with self.lock:
+                record = self._lookup(key)
+                if record is not None:
+                    if fingerprint is not None and record.fingerprint != fingerprint:
+                        raise ValueError("This idempotency key was already used for a different request.")
+                    return record
+                claim = self.claims.get(key)
+                if claim is None:
+                    self.claims[key] = threading.Event()
+                    return None
+            if not claim.wait(max(0.0, deadline - time.monotonic())):
+                raise ValueError("A request with this idempotency key is still in progress.")
+
+    def _lookup(self, key):
+        record = self.cache.get(key)
+        if record is None:
+            record = self.records.get(key)
+            if record is None:
+                DataStorage.refresh(self.records, self.filename)  # Completed at another kiosk
+                record = self.records.get(key)
+            if record is None or record.created_at + self.ttl <= time.time():
+                return None
+            self.cache.put(key, record)
+        return record
+
+    def record(self, key, result, fingerprint=None):
+        """
+        Record the outcome of a claimed key. The caller saves `records` with the rest of its changes.
+
+        Args:
+            key (str): The idempotency key.
+            result: The outcome to return to retries.
+            fingerprint (tuple): What was requested (see `begin`).
+
+        Returns:
+            IdempotencyRecord: The record.
+        """
+        record = IdempotencyRecord(key, fingerprint, result, time.time())
+        with self.lock:
+            self.records[key] = record
+        return record
+
+    def end(self, key):
+        """
+        Release a key claimed by `begin`. Outcomes recorded for it become visible to other callers.
+
+        If no outcome was recorded (the work failed), the next call to `begin` claims the key again.
+        """
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None:
+                self.cache.put(key, record)
+            claim = self.claims.pop(key, None)
+        if claim is not None:
+            claim.set()
+
+    def purge(self, now=None):
+        """
+        Forget the saved outcomes older than `ttl`. The caller saves `records`.
+
+        Args:
+            now (float): The current time in seconds since the epoch (defaults to now).
+
+        Returns:
+            int: The number of records removed.
+        """
+        cutoff = (time.time() if now is None else now) - self.ttl
+        with self.lock:
+            expired = [key for key, record in self.records.items()
+                       if record.created_at <= cutoff and key not in self.claims]
+            for key in expired:
+                del self.records[key]
+        return len(expired)
@@ -0,0 +1,374 @@
+import heapq
+import itertools
+import threading
+import time
+
+import constants
+from change_tracking import TrackedRecord
+from constants import FILE_PATH_INVENTORY, DAILY_TICKET_CAPACITY, HOLD_TTL_SECONDS, HOLD_EXPIRY_CHECK_INTERVAL_SECONDS
+from data_storage import DataStorage
+from write_ahead_log import WriteAheadLog
+
+
+class DailySales(TrackedRecord):
+    """
+    The tickets of one type sold for one visit date, kept as one quantity per purchase.
+
+    Purchases are only ever appended, so kiosks sharing a data folder merge their sales
+    instead of overwriting each other's counts. A negative quantity gives back tickets that
+    were recorded for a purchase that then failed.
+    """
+    __slots__ = ("visit_date", "ticket_type", "quantities", "_sold", "_counted")
+    tracked_list = "quantities"
+
+    def __init__(self, visit_date, ticket_type):
+        """
+        Initialize an empty count.
+
+        Args:
+            visit_date (str): The visit date in YYYY-MM-DD format.
+            ticket_type (str): The ticket type.
+        """
+        self.visit_date = visit_date
+        self.ticket_type = ticket_type
+        self.quantities = []
+        self._sold = 0
+        self._counted = 0  # Number of leading quantities included in _sold
+        self._init_tracking()
+
+    @property
+    def sold(self):
+        """The number of tickets sold."""
+        # Purchases read back from the log are appended to the list directly, so count on from there
+        if self._counted != len(self.quantities):
+            self._sold += sum(self.quantities[self._counted:])
+            self._counted = len(self.quantities)
+        return self._sold
+
+    def add(self, quantity):
+        """Record a purchase of `quantity` tickets (or give back -`quantity`)."""
+        self.quantities.append(quantity)
+        self.record_appended([quantity])
+
+    def same_record(self, other):
+        """Counts for the same visit date and ticket type are merged."""
+        return (isinstance(other, DailySales) and other.visit_date == self.visit_date
+                and other.ticket_type == self.ticket_type)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("_sold", None)
+        state.pop("_counted", None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._sold = 0
+        self._counted = 0
+
+
+class Reservation:
+    """Tickets held for a purchase that is still being completed, until `expires_at` (monotonic time)."""
+    __slots__ = ("visit_date", "ticket_type", "quantity", "state", "expires_at", "recorded")
+
+    HELD = "held"
+    COMMITTED = "committed"
+    RELEASED = "released"
+    EXPIRED = "expired"
+
+    def __init__(self, visit_date, ticket_type, quantity, expires_at=None):
+        self.visit_date = visit_date
+        self.ticket_type = ticket_type
+        self.quantity = quantity
+        self.state = Reservation.HELD
+        self.expires_at = expires_at  # None: held until committed or released
+        self.recorded = False  # True once its tickets were saved as sold in a shared data directory
+
+
+class Inventory:
+    """
+    Tickets sold and held per visit date and ticket type, checked against daily capacities.
+
+    A purchase first reserves its tickets, which counts them against the capacity right away,
+    then commits the reservation once paid (or releases it if the purchase fails). Sold counts
+    are `DailySales` records in a tracked collection saved with the rest of the purchase; held
+    tickets only live in memory. Every check is a dictionary lookup, and a lock makes reserving
+    atomic for concurrent purchases in the same process. In a shared data directory, sales
+    saved by other kiosks are read back before each capacity check.
+
+    Holds of other kiosks are not visible, so in a shared data directory a hold of a limited
+    ticket type is checked again and saved as sold, under the inventory file's lock, once it
+    must not fail any more: when it is renewed without expiry right before the payment, or
+    at the latest when it is committed. Releasing it afterwards gives the tickets back.
+
+    Holds expire after a TTL so abandoned purchases give their tickets back. Expiry times are
+    kept in a heap: expiring holds pops only the ones that are due, in O(log n) each, and holds
+    that were committed or released before their time are skipped when they come up.
+    """
+    def __init__(self, sales=None, filename=FILE_PATH_INVENTORY, capacities=None):
+        """
+        Initialize an inventory.
+
+        Args:
+            sales (TrackedDict): `DailySales` keyed by (visit date, ticket type), as returned by `load_tracked`.
+            filename (str): The data file the sales are saved in.
+            capacities (dict): Tickets available per visit date by ticket type; types not listed are unlimited.
+        """
+        self.sales = sales if sales is not None else DataStorage.load_tracked(filename)
+        self.filename = filename
+        self.capacities = dict(DAILY_TICKET_CAPACITY if capacities is None else capacities)
+        self.held = {}  # (visit date, ticket type) -> tickets reserved but not committed yet
+        self.expiries = []  # Heap of (expiry time, sequence number, reservation)
+        self._sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def check_capacity(ticket_type, taken, quantity, day="today", capacities=DAILY_TICKET_CAPACITY):
+        """
+        Check that `quantity` more tickets of a type fit in the daily capacity.
+
+        Args:
+            ticket_type (str): The ticket type.
+            taken (int): The tickets of the type already sold or held for the day.
+            quantity (int): The tickets asked for.
+            day (str): The day, for the error message.
+            capacities (dict): Tickets available per day by ticket type; types not listed are unlimited.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If the tickets would exceed the capacity.
+        """
+        capacity = capacities.get(ticket_type)
+        if capacity is not None and taken + quantity > capacity:
+            raise ValueError(f"{ticket_type} is sold out for {day}.")
+
+    def sold(self, visit_date, ticket_type):
+        """Return the number of tickets of a type sold for a visit date."""
+        record = self.sales.get((visit_date, ticket_type))
+        return record.sold if record is not None else 0
+
+    def taken(self, visit_date, ticket_type):
+        """Return the number of tickets of a type sold or held for a visit date."""
+        return self.sold(visit_date, ticket_type) + self.held.get((visit_date, ticket_type), 0)
+
+    def available(self, visit_date, ticket_type):
+        """
+        Return how many more tickets of a type can be reserved for a visit date.
+
+        Returns:
+            int: The remaining capacity, or None if the ticket type is unlimited.
+        """
+        capacity = self.capacities.get(ticket_type)
+        if capacity is None:
+            return None
+        return max(capacity - self.taken(visit_date, ticket_type), 0)
+
+    def reserve(self, visit_date, ticket_type, quantity, ttl=HOLD_TTL_SECONDS, now=None):
+        """
+        Hold tickets for a purchase.
+
+        Args:
+            visit_date (str): The visit date in YYYY-MM-DD format.
+            ticket_type (str): The ticket type.
+            quantity (int): The number of tickets.
+            ttl (float): Seconds until the hold expires, or None to hold until committed or released.
+            now (float): The current time (defaults to `time.monotonic()`).
+
+        Returns:
+            Reservation: The hold, to pass to `commit` or `release`.
+
+        Raises:
+            ValueError: If the quantity is not positive or the day's capacity would be exceeded.
+        """
+        if quantity <= 0:
+            raise ValueError("The number of tickets must be greater than 0.")
+        now = time.monotonic() if now is None else now
+        reservation = Reservation(visit_date, ticket_type, quantity)
+        with self.lock:
+            self._expire_due(now)
+            self._hold(reservation, ttl, now)
+        return reservation
+
+    def renew(self, reservation, ttl=HOLD_TTL_SECONDS, now=None):
+        """
+        Extend a hold, e.g. right before taking the payment. An expired hold is taken again if the
+        tickets are still available.
+
+        Args:
+            reservation (Reservation): A reservation returned by `reserve`.
+            ttl (float): Seconds from now until the hold expires, or None to hold until committed or
+                released (in a shared data directory this saves the tickets as sold, see `Inventory`).
+            now (float): The current time (defaults to `time.monotonic()`).
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If the reservation was settled, or it expired (or was sold at another
+                kiosk) and the tickets are gone.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self._expire_due(now)
+            if reservation.state == Reservation.HELD:
+                if reservation.recorded:
+                    return  # Saved as sold: it no longer expires
+                reservation.expires_at = None
+                self._schedule(reservation, ttl, now)
+            elif reservation.state == Reservation.EXPIRED:
+                self._hold(reservation, ttl, now)
+            else:
+                raise ValueError(f"Reservation was already {reservation.state}.")
+            if ttl is None and self._shared_limit(reservation):
+                self._record_shared(reservation)
+
+    def commit(self, reservation):
+        """
+        Turn a reservation into sold tickets. The caller saves `sales` along with the purchase.
+
+        A hold that expired in the meantime is taken again if the tickets are still available.
+
+        Args:
+            reservation (Reservation): A reservation returned by `reserve`.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If the reservation was settled, or it expired (or was sold at another
+                kiosk) and the tickets are gone.
+        """
+        with self.lock:
+            if reservation.state == Reservation.EXPIRED:
+                self._hold(reservation, None, time.monotonic())
+            elif reservation.state != Reservation.HELD:
+                raise ValueError(f"Reservation was already {reservation.state}.")
+            if not reservation.recorded and self._shared_limit(reservation):
+                self._record_shared(reservation)
+            if not reservation.recorded:
+                self._add_sale(reservation, reservation.quantity)
+            self._settle(reservation, Reservation.COMMITTED)
+
+    def release(self, reservation):
+        """
+        Give the tickets of a reservation back, e.g. after a failed payment.
+
+        Releasing a reservation that was already committed or released does nothing.
+
+        Args:
+            reservation (Reservation): A reservation returned by `reserve`.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            if reservation.state == Reservation.HELD:
+                self._settle(reservation, Reservation.RELEASED)
+                if reservation.recorded:
+                    self._add_sale(reservation, -reservation.quantity)
+                    DataStorage.flush(self.sales, self.filename)
+
+    def expire_holds(self, now=None):
+        """
+        Give back the tickets of every hold whose TTL has passed.
+
+        Args:
+            now (float): The current time (defaults to `time.monotonic()`).
+
+        Returns:
+            list: The reservations that expired.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return self._expire_due(now)
+
+    def _hold(self, reservation, ttl, now):
+        key = (reservation.visit_date, reservation.ticket_type)
+        if reservation.ticket_type in self.capacities:
+            DataStorage.refresh(self.sales, self.filename)  # Count sales made at other kiosks
+            Inventory.check_capacity(reservation.ticket_type, self.taken(*key), reservation.quantity,
+                                     reservation.visit_date, self.capacities)
+        self.held[key] = self.held.get(key, 0) + reservation.quantity
+        reservation.state = Reservation.HELD
+        reservation.expires_at = None
+        self._schedule(reservation, ttl, now)
+
+    def _schedule(self, reservation, ttl, now):
+        if ttl is not None:
+            reservation.expires_at = now + ttl
+            heapq.heappush(self.expiries, (reservation.expires_at, next(self._sequence), reservation))
+
+    def _expire_due(self, now):
+        expired = []
+        while self.expiries and self.expiries[0][0] <= now:
+            expires_at, _, reservation = heapq.heappop(self.expiries)
+            # Skip entries of holds that were settled or renewed since they were scheduled
+            if reservation.state == Reservation.HELD and reservation.expires_at == expires_at:
+                self._settle(reservation, Reservation.EXPIRED)
+                expired.append(reservation)
+        return expired
+
+    def _shared_limit(self, reservation):
+        return constants.SHARED_DATA_DIRECTORY and reservation.ticket_type in self.capacities
+
+    def _record_shared(self, reservation):
+        # Check the sales of every kiosk and save these tickets as sold before anyone else can
+        key = (reservation.visit_date, reservation.ticket_type)
+        with WriteAheadLog(self.filename).lock():
+            DataStorage.refresh(self.sales, self.filename)
+            Inventory.check_capacity(reservation.ticket_type, self.sold(*key), reservation.quantity,
+                                     reservation.visit_date, self.capacities)
+            self._add_sale(reservation, reservation.quantity)
+            DataStorage.flush(self.sales, self.filename)
+        self._unhold(reservation)  # Counted as sold from now on
+        reservation.recorded = True
+
+    def _add_sale(self, reservation, quantity):
+        key = (reservation.visit_date, reservation.ticket_type)
+        record = self.sales.get(key)
+        if record is None:
+            record = DailySales(*key)
+            self.sales[key] = record
+        record.add(quantity)
+
+    def _unhold(self, reservation):
+        key = (reservation.visit_date, reservation.ticket_type)
+        remaining = self.held.get(key, 0) - reservation.quantity
+        if remaining > 0:
+            self.held[key] = remaining
+        else:
+            self.held.pop(key, None)
+
+    def _settle(self, reservation, state):
+        if reservation.state != Reservation.HELD:
+            raise ValueError(f"Reservation was already {reservation.state}.")
+        if not reservation.recorded:
+            self._unhold(reservation)
+        reservation.state = state
+
+
+class HoldExpirer(threading.Thread):
+    """A background thread that gives back the tickets of abandoned purchases once their holds expire."""
+    def __init__(self, inventory, interval=HOLD_EXPIRY_CHECK_INTERVAL_SECONDS):
+        """
+        Initialize the expirer.
+
+        Args:
+            inventory (Inventory): The inventory whose holds should be expired.
+            interval (float): Seconds between checks.
+        """
+        super().__init__(name="HoldExpirer", daemon=True)
+        self.inventory = inventory
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        """Expire due holds every `interval` seconds until stopped."""
+        while not self.stop_event.wait(self.interval):
+            self.inventory.expire_holds()
+
+    def stop(self):
+        """Stop the thread after its current check."""
+        self.stop_event.set()
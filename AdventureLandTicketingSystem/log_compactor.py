@@ -0,0 +1,81 @@
+import threading
+import time
+
+from data_storage import DataStorage
+from write_ahead_log import WriteAheadLog
+from constants import WAL_COMPACT_MAX_BYTES, WAL_COMPACT_MAX_AGE_SECONDS, WAL_COMPACT_CHECK_INTERVAL_SECONDS
+
+
+class LogCompactor(threading.Thread):
+    """
+    A background thread that folds write-ahead logs into fresh snapshots.
+
+    A log is compacted once it grows past a size threshold or once its oldest
+    pending change is older than an age threshold, which keeps both the log
+    and the time needed to replay it on restart bounded.
+    """
+    def __init__(self, filenames, max_bytes=WAL_COMPACT_MAX_BYTES, max_age=WAL_COMPACT_MAX_AGE_SECONDS,
+                 interval=WAL_COMPACT_CHECK_INTERVAL_SECONDS):
+        """
+        Initialize the compactor.
+
+        Args:
+            filenames (list): The data files whose logs should be watched.
+            max_bytes (int): Compact a log once it holds more than this many bytes.
+            max_age (float): Compact a log once its first pending change is this many seconds old.
+            interval (float): Seconds between checks.
+        """
+        super().__init__(name="LogCompactor", daemon=True)
+        self.filenames = list(filenames)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self.pending_since = {}
+        self.stop_event = threading.Event()
+
+    def is_due(self, filename, now=None):
+        """
+        Check whether a file's log has passed the size or age threshold.
+
+        Args:
+            filename (str): The data file to check.
+            now (float): The current time (defaults to `time.monotonic()`).
+
+        Returns:
+            bool: True if the log should be compacted.
+        """
+        now = time.monotonic() if now is None else now
+        size = WriteAheadLog(filename).size()
+        if size == 0:
+            self.pending_since.pop(filename, None)
+            return False
+        first_seen = self.pending_since.setdefault(filename, now)
+        return size >= self.max_bytes or now - first_seen >= self.max_age
+
+    def compact_due(self, now=None):
+        """
+        Compact every watched log that is due.
+
+        Returns:
+            list: The files that were compacted.
+        """
+        compacted = []
+        for filename in self.filenames:
+            if self.is_due(filename, now):
+                try:
+                    DataStorage.compact(filename)
+                except Exception as e:
+                    print(f"Error: compaction of {filename} failed: {e}")
+                    continue
+                self.pending_since.pop(filename, None)
+                compacted.append(filename)
+        return compacted
+
+    def run(self):
+        """Check the watched logs every `interval` seconds until stopped."""
+        while not self.stop_event.wait(self.interval):
+            self.compact_due()
+
+    def stop(self):
+        """Stop the thread after its current check."""
+        self.stop_event.set()
@@ -1,19 +1,43 @@
 from data_storage import DataStorage
-from constants import FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS
+from change_tracking import TicketCatalog
+from log_compactor import LogCompactor
+from constants import (FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS, FILE_PATH_INVENTORY, ADULT_TICKET_TYPES,
+                       FILE_PATH_SALES_ROLLUPS, FILE_PATH_IDEMPOTENCY, SALES_REPORT_PAGE_SIZE)
+from inventory import Inventory, HoldExpirer
+from pricing import PricingEngine
 from user import User
 from admin import Admin
 from ticket import Ticket
+from ticket_block import TicketBlock
 from payment import Payment
+from payment_gateway import PaymentProcessor
+from idempotency import IdempotencyStore
 from utils import Utils
 import sys
+import threading
 from sales_report import SalesReport, Transaction
+from sales_index import SalesReportIndex
+from sales_export import SalesExporter, EXPORT_FORMATS
+from sales_analytics import SalesAnalytics
+from sales_archive import EndOfDayClose
 
 
 
 # Load data
-users = DataStorage.load_from_file(FILE_PATH_USERS)
-tickets = DataStorage.load_from_file(FILE_PATH_TICKETS)
-sales_reports = DataStorage.load_from_file(FILE_PATH_SALES_REPORTS)
+users = DataStorage.load_tracked(FILE_PATH_USERS)
+tickets = DataStorage.load_tracked(FILE_PATH_TICKETS, TicketCatalog)
+sales_reports = DataStorage.load_tracked(FILE_PATH_SALES_REPORTS)
+sales_lock = threading.RLock()  # Held while sales_reports is changed, refreshed or saved
+inventory = Inventory(DataStorage.load_tracked(FILE_PATH_INVENTORY), FILE_PATH_INVENTORY)
+sales_rollups = DataStorage.load_tracked(FILE_PATH_SALES_ROLLUPS)
+pricing = PricingEngine(tickets)
+sales_index = SalesReportIndex(sales_reports, sales_rollups)
+analytics = SalesAnalytics(sales_reports)
+payments = PaymentProcessor.from_settings()
+purchases = IdempotencyStore(DataStorage.load_tracked(FILE_PATH_IDEMPOTENCY))
+order_keys = {}  # Order (user, tickets, payment method) -> idempotency key, kept until the order completes
+compactor = LogCompactor([FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS, FILE_PATH_INVENTORY,
+                          FILE_PATH_SALES_ROLLUPS, FILE_PATH_IDEMPOTENCY])
 
 def initialize_tickets():
     """Initialize default tickets if tickets.pkl is missing."""
@@ -50,9 +74,16 @@ def main_menu():
                 admin_login()
             elif choice == 4:
                 print("Exiting... Saving data.")
+                # A compaction finishing after the final saves would replace them with an older fold
+                compactor.stop()
+                if compactor.is_alive():
+                    compactor.join()
                 DataStorage.save_to_file(users, FILE_PATH_USERS)
                 DataStorage.save_to_file(tickets, FILE_PATH_TICKETS)
-                DataStorage.save_to_file(sales_reports, FILE_PATH_SALES_REPORTS)
+                with sales_lock:
+                    DataStorage.save_to_file(sales_reports, FILE_PATH_SALES_REPORTS)
+                DataStorage.save_to_file(inventory.sales, FILE_PATH_INVENTORY)
+                DataStorage.save_to_file(sales_rollups, FILE_PATH_SALES_ROLLUPS)
                 sys.exit()
             else:
                 print("Invalid choice! Please enter a valid option.")
@@ -70,7 +101,7 @@ def create_user_account():
         user_id = Utils.generate_unique_id()
         new_user = User(user_id, name, email, password)
         users[email] = new_user
-        DataStorage.save_to_file(users, FILE_PATH_USERS)
+        DataStorage.flush(users, FILE_PATH_USERS)
         print("Account created successfully!")
     except Exception as e:
         print(f"Error: {e}")
@@ -86,7 +117,7 @@ def create_user_account():
         user_id = Utils.generate_unique_id()
         new_user = User(user_id, name, email, password)
         users[email] = new_user
-        DataStorage.save_to_file(users, FILE_PATH_USERS)
+        DataStorage.flush(users, FILE_PATH_USERS)
         print("Account created successfully!")
     except Exception as e:
         print(f"Error: {e}")
@@ -95,11 +126,16 @@ def user_login():
     try:
         email = input("Enter your email: ")
         password = input("Enter your password: ")
+        DataStorage.refresh(users, FILE_PATH_USERS)  # Accounts may have been created at another kiosk
         user = users.get(email)
         if user and user.password == password:
-            user.load_purchase_history(user.purchase_history)
+            # The purchase history is paged in when it is first needed
             print(f"Welcome, {user.name}!")
             user_menu(user)
+            user.evict_purchase_history(FILE_PATH_USERS)
+            # Orders left unfinished are abandoned; ordering again is a new purchase
+            for order in [order for order in order_keys if order[0] == user.email]:
+                del order_keys[order]
         else:
             print("Invalid email or password!")
     except Exception as e:
@@ -127,8 +163,24 @@ def user_menu(user):
         except ValueError:
             print("Invalid input! Please enter a number.")
 
-def purchase_ticket(user):
+def purchase_ticket(user, idempotency_key=None):
+    """
+    Buy tickets for a user.
+
+    Args:
+        user (User): The buyer.
+        idempotency_key (str): Identifies the purchase across retries. A retry with the key of a
+            completed purchase shows its receipt again instead of charging and ticketing twice.
+            Defaults to the key of the user's unfinished order for the same tickets, if any,
+            so retrying after an unknown payment outcome cannot charge twice.
+
+    Returns:
+        dict: The receipt, or None if the purchase was not made.
+    """
+    reservation = None
+    claimed = None
     try:
+        DataStorage.refresh(tickets, FILE_PATH_TICKETS)  # Pick up discounts changed at another kiosk
         print("Available Tickets:")
         for ticket_type, details in tickets.items():
             print(f"{ticket_type}: {details['price']} DHS, Validity: {details['validity']}")
@@ -148,14 +200,14 @@ def purchase_ticket(user):
         if num_tickets <= 0:
             raise ValueError("The number of tickets must be greater than 0.")
 
+        # Hold the tickets while the purchase is completed; they are given back if it is abandoned
+        reservation = inventory.reserve(visit_date, ticket_type, num_tickets)
+
         adult_present = True  # Default assumption
 
         # For Child Ticket, ensure an adult ticket is purchased
         if ticket_type == "Child Ticket":
-            adult_present = any(
-                t.ticket_type in ["Single-Day Pass", "Two-Day Pass", "Annual Membership", "VIP Experience Pass"]
-                for t in user.purchase_history
-            )
+            adult_present = user.count_tickets(*ADULT_TICKET_TYPES) > 0
             if not adult_present:
                 print("An adult ticket must be purchased with a Child Ticket.")
                 # Ask if the user wants to purchase an adult ticket
@@ -186,6 +238,18 @@ def purchase_ticket(user):
         if not payment_method:
             raise ValueError("Invalid payment method selected.")
 
+        # A retried purchase returns the receipt of the original one
+        fingerprint = (user.email, ticket_type, visit_date, num_tickets, payment_method)
+        if idempotency_key is None:
+            idempotency_key = order_keys.setdefault(fingerprint, Utils.format_id(Utils.generate_unique_id()))
+        completed = purchases.begin(idempotency_key, fingerprint)
+        if completed is not None:
+            order_keys.pop(fingerprint, None)
+            print("This purchase was already completed.")
+            show_receipt(completed.result)
+            return completed.result
+        claimed = idempotency_key
+
         # Create the ticket instance with default discount from admin
         ticket_id = Utils.generate_unique_id()
         ticket = Ticket(
@@ -198,54 +262,85 @@ def purchase_ticket(user):
         )
 
         # Apply discounts and set validity inside ticket
-        ticket.apply_discounts(user, num_tickets, payment_method)
+        pricing.price_ticket(ticket, user, num_tickets, payment_method)
         ticket.set_validity_dates(user)
 
         # Validate ticket conditions
         ticket.validate(
             group_size=num_tickets,
             adult_present=adult_present,
-            tickets_sold_today=0  # Implement tracking of tickets sold today if needed
+            tickets_sold_today=inventory.sold(visit_date, ticket_type)
         )
 
         # Calculate total price
         total_price = ticket.price * num_tickets
 
+        # Hold the tickets until the purchase is committed or released, so they cannot expire
+        # and be sold to someone else while the customer is being charged
+        inventory.renew(reservation, ttl=None)
+
         # Process payment
         payment_id = Utils.generate_unique_id()
-        payment = Payment(payment_id, payment_method)
-        payment_success = payment.process_payment(total_price)
+        payment_key = IdempotencyStore.derive_key(idempotency_key, "payment", fingerprint, round(total_price, 2))
+        payment = Payment(payment_id, payment_method, idempotency_key=payment_key)
+        payment_success = payments.process(payment, total_price)
         if not payment_success:
+            # Nothing was taken, so trying again is a new payment rather than a retry of this one
+            order_keys.pop(fingerprint, None)
             raise ValueError("Payment failed!")
+        inventory.commit(reservation)
 
-        # Update sales report
-        update_sales_report(user, ticket, num_tickets)
+        # The end-of-day close must not replace or save the sales reports in between
+        with sales_lock:
+            # Update sales report
+            transaction = update_sales_report(user, ticket, num_tickets, payment_method)
 
+            # Add the tickets to user's purchase history as one block
+            block = TicketBlock(ticket, num_tickets)
+            user.purchase_block(block)
 
-        # Add tickets to user's purchase history
-        for _ in range(num_tickets):
-            individual_ticket_id = Utils.generate_unique_id()
-            individual_ticket = Ticket(
-                individual_ticket_id,
-                ticket.ticket_type,
-                ticket.price,
-                ticket.validity,
-                ticket.visit_date
-            )
-            individual_ticket.discount = ticket.discount
-            individual_ticket.validity_start_date = ticket.validity_start_date
-            individual_ticket.validity_end_date = ticket.validity_end_date
-            user.purchase_ticket(individual_ticket)
+            # Save the sale, the new tickets, the sold count and the receipt in one commit
+            receipt = purchase_receipt(block, total_price, payment, transaction)
+            purchases.record(idempotency_key, receipt, fingerprint)
+            DataStorage.flush_all({
+                FILE_PATH_SALES_REPORTS: sales_reports,
+                FILE_PATH_USERS: users,
+                FILE_PATH_INVENTORY: inventory.sales,
+                FILE_PATH_IDEMPOTENCY: purchases.records
+            })
 
-        # Save data
-        DataStorage.save_to_file(users, FILE_PATH_USERS)
+        order_keys.pop(fingerprint, None)
 
         # Show discount applied and validity
-        print(f"Discount Applied: {ticket.discount * 100}%, Total Price: {total_price} DHS")
-        print(f"Ticket Validity: From {ticket.validity_start_date} to {ticket.validity_end_date}")
+        show_receipt(receipt)
+        return receipt
 
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        if reservation is not None:
+            inventory.release(reservation)  # Does nothing once the purchase was committed
+        if claimed is not None:
+            purchases.end(claimed)
+
+def purchase_receipt(block, total_price, payment, transaction):
+    """Summarize a completed purchase, as returned to retries of it."""
+    return {
+        "ticket_type": block.ticket_type,
+        "first_ticket_id": block.ticket_id,
+        "quantity": block.quantity,
+        "discount": block.discount,
+        "total_price": total_price,
+        "validity_start_date": block.validity_start_date,
+        "validity_end_date": block.validity_end_date,
+        "payment_reference": payment.reference,
+        "transaction_id": transaction.transaction_id,
+    }
+
+def show_receipt(receipt):
+    """Print the discount, total and validity of a purchase."""
+    print(f"Discount Applied: {receipt['discount'] * 100}%, Total Price: {receipt['total_price']} DHS")
+    print(f"Ticket Validity: From {receipt['validity_start_date']} to {receipt['validity_end_date']}")
 
 # Admin Management
 def admin_login():
@@ -266,8 +361,12 @@ def admin_menu():
     while True:
         print("\nAdmin Menu:")
         print("1. View Sales Reports")
-        print("2. Manage Discounts")
-        print("3. Logout")
+        print("2. Period Sales Report")
+        print("3. View Transactions")
+        print("4. Export Sales")
+        print("5. Sales Analytics")
+        print("6. Manage Discounts")
+        print("7. Logout")
         
         try:
             choice = int(input("Enter your choice: "))
@@ -275,8 +374,16 @@ def admin_menu():
             if choice == 1:
                 view_sales_reports()
             elif choice == 2:
-                manage_discounts()
+                period_sales_report()
             elif choice == 3:
+                view_transactions()
+            elif choice == 4:
+                export_sales()
+            elif choice == 5:
+                sales_analytics_report()
+            elif choice == 6:
+                manage_discounts()
+            elif choice == 7:
                 print("Logging out...")
                 break
             else:
@@ -286,19 +393,107 @@ def admin_menu():
 
 # Sales Reports
 def view_sales_reports():
-    """Display all sales reports with transaction details."""
+    """Display the sales totals of every day, read from the sales rollups without reading any transaction."""
     try:
+        refresh_sales_reports()  # Include sales made at other kiosks
+        DataStorage.refresh(sales_rollups, FILE_PATH_SALES_ROLLUPS)
         if not sales_reports:
             print("No sales reports available.")
             return
 
-        for report in sales_reports.values():
-            print(report)
+        print("\nSales by Day:")
+        for report_date, totals in sales_index.daily_totals():
+            print(f"  {report_date}: {totals.revenue:.2f} DHS, {totals.quantity} tickets, {totals.count} transactions")
+        print("All Days:")
+        print("\n".join(sales_index.rollup().summary_lines()))
     except Exception as e:
         print(f"Error: {e}")
 
-def update_sales_report(user, ticket, quantity):
-    """Update the daily sales report with the transaction."""
+def prompt_period():
+    """Ask for the first and last day of a period; blank answers leave that end open."""
+    start = input("Enter start date (YYYY-MM-DD, blank for the first sale): ").strip() or None
+    end = input("Enter end date (YYYY-MM-DD, blank for the last sale): ").strip() or None
+    return start, end
+
+def view_transactions():
+    """Display the transactions of a period a page at a time."""
+    try:
+        refresh_sales_reports()  # Include sales made at other kiosks
+        start, end = prompt_period()
+        reports = sales_index.reports_between(start, end)
+        if not reports:
+            print("No sales in this period.")
+            return
+        lines = (line for report in reports for line in report.iter_lines())
+        SalesExporter.page(lines, SALES_REPORT_PAGE_SIZE, sys.stdout)
+    except ValueError as e:
+        print(f"Error: {e}")
+
+def export_sales():
+    """Write the transactions of a period to a CSV, JSON Lines or text file, or to the screen."""
+    try:
+        refresh_sales_reports()  # Include sales made at other kiosks
+        start, end = prompt_period()
+        export_format = input(f"Enter format ({', '.join(EXPORT_FORMATS)}): ").strip().lower() or "csv"
+        path = input("Enter file path (blank to print): ").strip()
+        reports = sales_index.reports_between(start, end)
+        if not path:
+            SalesExporter.write(reports, sys.stdout, export_format)
+        else:
+            count = SalesExporter.export(reports, path, export_format)
+            print(f"Exported {count} transactions to {path}.")
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+
+def sales_analytics_report():
+    """Display revenue per ticket type per day, the average basket and week-over-week changes of a period."""
+    try:
+        refresh_sales_reports()  # Include sales made at other kiosks
+        start, end = prompt_period()
+        print("\n" + "\n".join(analytics.report_lines(start, end)))
+    except (ValueError, ImportError) as e:
+        print(f"Error: {e}")
+
+def period_sales_report():
+    """Display the sales totals of a date range, optionally for one ticket type."""
+    try:
+        refresh_sales_reports()  # Include sales made at other kiosks
+        DataStorage.refresh(sales_rollups, FILE_PATH_SALES_ROLLUPS)
+        start, end = prompt_period()
+        ticket_type = input("Enter ticket type (blank for all types): ").strip() or None
+        if ticket_type is not None and ticket_type not in tickets:
+            raise ValueError("Invalid ticket type!")
+
+        days = sales_index.dates_between(start, end)
+        if not days:
+            print("No sales in this period.")
+            return
+        print(f"\nSales Report - {days[0]} to {days[-1]}" + (f" - {ticket_type}" if ticket_type else ""))
+        if ticket_type is None:
+            rollup = sales_index.rollup(start, end)
+            print("\n".join(rollup.summary_lines(("day", "ticket_type", "payment_method")) + rollup.customer_lines()))
+            return
+        total = sales_index.totals(start, end, ticket_type)
+        print(f"Revenue: {total.revenue:.2f} DHS, Tickets: {total.quantity}, Transactions: {total.count}")
+        print("By Day:")
+        for report in sales_index.reports_between(start, end):
+            totals = report.rollup.totals("ticket_type", ticket_type)
+            if totals.count:
+                print(f"  {report.date}: {totals.revenue:.2f} DHS, {totals.quantity} tickets, "
+                      f"{totals.count} transactions")
+    except ValueError as e:
+        print(f"Error: {e}")
+
+def refresh_sales_reports():
+    """Read back the sales saved at other kiosks, while the end-of-day close is not rewriting them."""
+    with sales_lock:
+        DataStorage.refresh(sales_reports, FILE_PATH_SALES_REPORTS)
+
+def update_sales_report(user, ticket, quantity, payment_method=None):
+    """
+    Update the daily sales report and its rollup with the transaction, and return the transaction.
+    The caller flushes sales_reports.
+    """
     today = Utils.get_today_date()
     report = sales_reports.get(today)
     if not report:
@@ -314,12 +509,13 @@ def update_sales_report(user, ticket, quantity):
         ticket_type=ticket.ticket_type,
         quantity=quantity,
         total_price=ticket.price * quantity,
-        date_of_purchase=today
+        date_of_purchase=today,
+        payment_method=payment_method
     )
 
     # Add the transaction to the report
     report.add_transaction(transaction)
-    DataStorage.save_to_file(sales_reports, FILE_PATH_SALES_REPORTS)
+    return transaction
 
 # Discounts Management
 def manage_discounts():
@@ -339,13 +535,17 @@ def manage_discounts():
         if not (0 <= discount <= 1):
             raise ValueError("Discount must be between 0 and 1.")
 
-        tickets[ticket_type]['discount'] = discount
-        DataStorage.save_to_file(tickets, FILE_PATH_TICKETS)
+        tickets.set_discount(ticket_type, discount)
+        DataStorage.flush(tickets, FILE_PATH_TICKETS)
         print(f"Discount updated for {ticket_type}.")
 
     except Exception as e:
         print(f"Error: {e}")
 
 if __name__ == "__main__":
-    
+    if purchases.purge():
+        DataStorage.flush(purchases.records, FILE_PATH_IDEMPOTENCY)
+    compactor.start()
+    HoldExpirer(inventory).start()
+    EndOfDayClose(sales_reports, sales_rollups, lock=sales_lock).start()
     main_menu()
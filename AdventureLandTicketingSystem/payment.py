@@ -1,27 +1,34 @@
 
 
 
+from utils import Utils
+
+
 class Payment:
     """
     Represents a payment transaction in the Adventure Land Theme Park Ticketing System.
 
     Handles payment processing using various payment methods and maintains the status of the payment.
     """
-    def __init__(self, payment_id, payment_method):
+    def __init__(self, payment_id, payment_method, idempotency_key=None):
         """
         Initialize a Payment object with basic details.
 
         Args:
-            payment_id (str): Unique identifier for the payment.
+            payment_id (int): Unique identifier for the payment.
             payment_method (str): Chosen payment method (e.g., "credit card", "cash").
+            idempotency_key (str): Identifies the payment to the gateway across retries, so a retried
+                payment is only taken once. Defaults to the payment ID.
         """
         self.payment_id = payment_id
+        self.idempotency_key = idempotency_key if idempotency_key is not None else Utils.format_id(payment_id)
         self.payment_method = payment_method.lower()
         self.status = "Pending"
+        self.reference = None  # The payment gateway's reference, for payments settled by a gateway
 
     def process_payment(self, amount):
         """
-        Process the payment based on the selected payment method.
+        Process the payment based on the selected payment method, at the kiosk.
 
         Args:
             amount (float): The amount to be paid.
@@ -30,6 +37,44 @@ class Payment:
             bool: True if payment is successful, False otherwise.
         """
         print(f"Processing payment of {amount} DHS using {self.payment_method.capitalize()}...")
+        return self.settle_locally(amount)
+
+    async def process_payment_async(self, amount, gateway):
+        """
+        Process the payment through a payment gateway, without blocking the event loop.
+
+        Args:
+            amount (float): The amount to be paid.
+            gateway (GatewayAdapter): The adapter that settles this payment method.
+
+        Returns:
+            bool: True if payment is successful, False otherwise.
+
+        Raises:
+            GatewayUnavailableError: If the gateway could not be reached.
+        """
+        print(f"Processing payment of {amount} DHS using {self.payment_method.capitalize()}...")
+        try:
+            result = await gateway.authorize(self, amount)
+        except Exception:
+            self.status = "Failed"
+            raise
+        if result.message:
+            print(result.message)
+        self.status = "Success" if result.approved else "Failed"
+        self.reference = result.reference
+        return result.approved
+
+    def settle_locally(self, amount):
+        """
+        Settle the payment with the kiosk's own rules for its payment method.
+
+        Args:
+            amount (float): The amount to be paid.
+
+        Returns:
+            bool: True if payment is successful, False otherwise.
+        """
         if self.payment_method == "net banking":
             return self._process_net_banking(amount)
         elif self.payment_method == "credit card":
@@ -132,4 +177,4 @@ class Payment:
         Returns:
             str: Payment details as a formatted string.
         """
-        return f"Payment ID: {self.payment_id}, Method: {self.payment_method.capitalize()}, Status: {self.status}"
+        return f"Payment ID: {Utils.format_id(self.payment_id)}, Method: {self.payment_method.capitalize()}, Status: {self.status}"
@@ -0,0 +1,510 @@
+import asyncio
+import itertools
+import json
+import random
+import threading
+from collections import namedtuple
+
+from constants import (PAYMENT_METHODS, ONLINE_PAYMENT_METHODS, PAYMENT_GATEWAY_ADDRESS, PAYMENT_GATEWAY_POOL_SIZE,
+                       PAYMENT_GATEWAY_TIMEOUT_SECONDS, PAYMENT_GATEWAY_RETRIES, SIMULATED_GATEWAY_LATENCY_SECONDS,
+                       SIMULATED_GATEWAY_FAILURE_RATE, SIMULATED_GATEWAY_DECLINE_RATE, SIMULATED_GATEWAY_LOST_REPLY_RATE)
+from idempotency import TTLCache
+from record_format import FILS_PER_DHS
+from utils import Utils
+
+# The outcome of a payment: whether it was approved, the gateway's reference for it, and a message for the buyer
+GatewayResult = namedtuple("GatewayResult", ["approved", "reference", "message"])
+
+
+class GatewayUnavailableError(ValueError):
+    """
+    Raised when the payment gateway cannot be reached, or stops answering, after all retries.
+
+    If the gateway stopped answering after the request was sent, the payment may or may not
+    have been taken; the message says so.
+    """
+
+
+class GatewayAdapter:
+    """
+    Settles payments of some payment methods. Subclasses connect one kind of gateway.
+    """
+    async def authorize(self, payment, amount):
+        """
+        Settle a payment.
+
+        Args:
+            payment (Payment): The payment.
+            amount (float): The amount in DHS.
+
+        Returns:
+            GatewayResult: The outcome.
+
+        Raises:
+            GatewayUnavailableError: If the gateway could not be reached.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Release the adapter's connections."""
+
+
+class LocalAdapter(GatewayAdapter):
+    """
+    Payments settled at the kiosk itself (cash, coupons), with the rules of `Payment.settle_locally`.
+    """
+    async def authorize(self, payment, amount):
+        approved = payment.settle_locally(amount)
+        return GatewayResult(approved, None, "")  # settle_locally prints its own messages
+
+
+class ConnectionPool:
+    """
+    Open connections to one gateway, reused across payments.
+
+    At most `size` connections are in use at once; further payments wait for one to be released.
+    A connection that failed is closed rather than returned to the pool. Use it from a single
+    event loop.
+    """
+    def __init__(self, host, port, size=PAYMENT_GATEWAY_POOL_SIZE, timeout=PAYMENT_GATEWAY_TIMEOUT_SECONDS):
+        """
+        Initialize an empty pool.
+
+        Args:
+            host (str): The gateway host.
+            port (int): The gateway port.
+            size (int): The most connections open at once.
+            timeout (float): Seconds to wait for a connection to open.
+        """
+        if size < 1:
+            raise ValueError("Connection pool size must be at least 1.")
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle = []  # (reader, writer) pairs ready for reuse
+        self.slots = asyncio.Semaphore(size)
+        self.opened = 0  # Connections opened so far
+
+    async def acquire(self):
+        """
+        Take an idle connection, or open one.
+
+        Returns:
+            tuple: A (reader, writer) pair. Give it back with `release`.
+        """
+        await self.slots.acquire()
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        try:
+            connection = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.opened += 1
+        return connection
+
+    def release(self, connection, reusable=True):
+        """
+        Give a connection back.
+
+        Args:
+            connection (tuple): The (reader, writer) pair from `acquire`.
+            reusable (bool): False to close it, e.g. after an error left it in an unknown state.
+        """
+        reader, writer = connection
+        if reusable and not writer.is_closing():
+            self.idle.append(connection)
+        else:
+            writer.close()
+        self.slots.release()
+
+    async def close(self):
+        """Close every idle connection."""
+        idle, self.idle = self.idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+class NetworkGatewayAdapter(GatewayAdapter):
+    """
+    Settles card, bank and wallet payments with a gateway over TCP, through a `ConnectionPool`.
+
+    Each request and reply is one line of JSON. A request is
+    {"payment_id", "idempotency_key", "method", "amount_fils"}; the reply has the same
+    "payment_id", a "status" of "approved", "declined" or "unavailable", a "reference" and a
+    "message".
+
+    Failed requests, replies of "unavailable" and requests left unanswered are retried with
+    backoff. The gateway answers a request whose idempotency key it has already settled with
+    the original reply, so a retry never charges twice.
+    """
+    def __init__(self, host, port, pool_size=PAYMENT_GATEWAY_POOL_SIZE, timeout=PAYMENT_GATEWAY_TIMEOUT_SECONDS,
+                 retries=PAYMENT_GATEWAY_RETRIES):
+        """
+        Initialize the adapter. Connections are opened on first use.
+
+        Args:
+            host (str): The gateway host.
+            port (int): The gateway port.
+            pool_size (int): The most connections open at once.
+            timeout (float): Seconds to wait for a connection or a reply.
+            retries (int): Extra attempts for requests the gateway did not settle.
+        """
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = None  # Created in the event loop that uses it
+
+    async def authorize(self, payment, amount):
+        if self.pool is None:
+            self.pool = ConnectionPool(self.host, self.port, self.pool_size, self.timeout)
+        request = json.dumps({
+            "payment_id": Utils.format_id(payment.payment_id),
+            "idempotency_key": payment.idempotency_key,
+            "method": payment.payment_method,
+            "amount_fils": round(amount * FILS_PER_DHS),
+        }).encode("utf-8") + b"\n"
+        unanswered = False
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(min(1.0, 0.05 * 2 ** (attempt - 1)))
+            try:
+                connection = await self.pool.acquire()
+            except (OSError, asyncio.TimeoutError):
+                continue  # Nothing was sent
+            sent, reply = await self._exchange(connection, request)
+            unanswered = unanswered or (sent and reply is None)
+            if reply is not None and reply.get("status") == "conflict":
+                raise ValueError(reply.get("message", "Idempotency key reused for a different payment."))
+            if reply is not None and reply.get("status") != "unavailable":
+                return GatewayResult(reply.get("status") == "approved", reply.get("reference"),
+                                     reply.get("message", ""))
+        if unanswered:
+            raise GatewayUnavailableError(f"The payment gateway at {self.host}:{self.port} did not answer. The "
+                                          f"payment may have been taken; retry it with the same idempotency key.")
+        raise GatewayUnavailableError(f"The payment gateway at {self.host}:{self.port} is unavailable. "
+                                      f"No payment was taken.")
+
+    async def _exchange(self, connection, request):
+        # Returns whether the request was sent, and the reply or None
+        reader, writer = connection
+        sent = False
+        try:
+            writer.write(request)
+            await writer.drain()
+            sent = True
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            line = b""
+        except BaseException:
+            self.pool.release(connection, reusable=False)
+            raise
+        if not line:
+            self.pool.release(connection, reusable=False)
+            return sent, None
+        self.pool.release(connection)
+        return sent, json.loads(line)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+
+class SimulatedGatewayServer:
+    """
+    A stand-in payment gateway on a local port, speaking the protocol of `NetworkGatewayAdapter`.
+
+    Each request waits a random latency, then is answered "unavailable" with probability
+    `failure_rate`, declined with probability `decline_rate`, and approved otherwise. With
+    probability `lost_reply_rate` the payment is settled but the connection drops before the
+    reply is sent, as with a network timeout. Settled replies are remembered by idempotency key
+    and sent again for a repeated key, without charging again; a repeated key with another
+    amount or method is answered "conflict". It runs its own event loop in a
+    background thread, so tests and kiosks without a real gateway can use it from synchronous
+    code.
+    """
+    MESSAGES = {
+        "net banking": "Net banking transaction successful.",
+        "credit card": "Credit card transaction approved.",
+        "digital wallet": "Digital wallet payment successful.",
+    }
+
+    def __init__(self, host="127.0.0.1", port=0, latency=SIMULATED_GATEWAY_LATENCY_SECONDS,
+                 failure_rate=SIMULATED_GATEWAY_FAILURE_RATE, decline_rate=SIMULATED_GATEWAY_DECLINE_RATE,
+                 lost_reply_rate=SIMULATED_GATEWAY_LOST_REPLY_RATE, seed=None):
+        """
+        Initialize the server. Call `start` to listen.
+
+        Args:
+            host (str): The address to listen on.
+            port (int): The port to listen on; 0 picks a free one.
+            latency (tuple): The (min, max) seconds each request takes.
+            failure_rate (float): The share of requests answered "unavailable".
+            decline_rate (float): The share of requests declined.
+            lost_reply_rate (float): The share of settled requests whose reply is lost.
+            seed (int): Seeds the random outcomes, for repeatable tests.
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.decline_rate = decline_rate
+        self.lost_reply_rate = lost_reply_rate
+        self.random = random.Random(seed)
+        self.references = itertools.count(1)
+        self.replies = TTLCache()  # Idempotency key -> (method, amount in fils, reply) of settled requests
+        self.connections_accepted = 0
+        self.requests_handled = 0
+        self.charges = 0  # Payments approved, not counting repeated requests
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """
+        Start listening in a background thread.
+
+        Returns:
+            tuple: The (host, port) the server listens on.
+        """
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="SimulatedGateway", daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self.host, self.port
+
+    def stop(self):
+        """Stop listening and close the open connections."""
+        if self.loop is None:
+            return
+
+        async def shutdown():
+            self.server.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def _serve(self, reader, writer):
+        self.connections_accepted += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                await asyncio.sleep(self.random.uniform(*self.latency))
+                reply = self._reply(request)
+                if self.random.random() < self.lost_reply_rate:
+                    break  # Settled, but the kiosk never hears back
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (OSError, ValueError):
+            pass  # A broken connection or request only ends this connection
+        finally:
+            writer.close()
+
+    def _reply(self, request):
+        self.requests_handled += 1
+        key = request.get("idempotency_key")
+        settled = self.replies.get(key) if key else None
+        if settled is not None:
+            method, amount_fils, reply = settled
+            if (method, amount_fils) == (request.get("method"), request.get("amount_fils")):
+                return reply
+            return {"payment_id": request.get("payment_id"), "reference": None, "status": "conflict",
+                    "message": "This idempotency key was already used for a payment of a different amount or method."}
+        reply = {"payment_id": request.get("payment_id"), "reference": None}
+        roll = self.random.random()
+        if roll < self.failure_rate:
+            reply.update(status="unavailable", message="The gateway is busy. Please try again.")
+        elif roll < self.failure_rate + self.decline_rate:
+            reply.update(status="declined", message="Payment declined by the gateway.")
+        else:
+            reply.update(status="approved", reference=f"SIM-{next(self.references):08d}",
+                         message=self.MESSAGES.get(request.get("method"), "Payment approved."))
+            self.charges += 1
+        if key and reply["status"] != "unavailable":
+            self.replies.put(key, (request.get("method"), request.get("amount_fils"), reply))
+        return reply
+
+
+class PaymentProcessor:
+    """
+    Settles payments through the adapter of their payment method, on an asyncio event loop.
+
+    The loop runs in a background thread, started on first use, so synchronous callers (the
+    command line, the Tkinter main loop) submit payments and get a `concurrent.futures.Future`
+    back instead of blocking while the gateway answers. Many payments can be in flight at
+    once; they share the adapters' pooled connections.
+    """
+    def __init__(self, adapters):
+        """
+        Initialize the processor.
+
+        Args:
+            adapters (dict): Payment method -> GatewayAdapter.
+        """
+        self.adapters = adapters
+        self.loop = None
+        self.thread = None
+        self.server = None  # The SimulatedGatewayServer started by `from_settings`, if any
+        self.requested = TTLCache()  # Idempotency key -> (method, amount in fils) of payments submitted
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_settings():
+        """
+        Build the processor configured in constants.
+
+        Cash and coupons are settled locally. Online payment methods go to the gateway at
+        `PAYMENT_GATEWAY_ADDRESS`; when none is set, a `SimulatedGatewayServer` is started on
+        a local port when the processor is first used.
+
+        Returns:
+            PaymentProcessor: The processor.
+        """
+        local = LocalAdapter()
+        processor = PaymentProcessor({method: local for method in PAYMENT_METHODS})
+        if PAYMENT_GATEWAY_ADDRESS is None:
+            processor.server = SimulatedGatewayServer()
+            gateway = None
+        else:
+            gateway = NetworkGatewayAdapter(*PAYMENT_GATEWAY_ADDRESS)
+        for method in ONLINE_PAYMENT_METHODS:
+            processor.adapters[method] = gateway
+        return processor
+
+    def start(self):
+        """Start the event loop thread (and the simulated gateway, if any), unless already started."""
+        with self.lock:
+            if self.loop is not None:
+                return
+            if self.server is not None:
+                address = self.server.start()
+                gateway = NetworkGatewayAdapter(*address)
+                for method, adapter in self.adapters.items():
+                    if adapter is None:
+                        self.adapters[method] = gateway
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="PaymentProcessor", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Close the adapters' connections and stop the event loop thread and simulated gateway."""
+        with self.lock:
+            if self.loop is None:
+                return
+
+            async def close_adapters():
+                for adapter in set(self.adapters.values()):
+                    await adapter.close()
+
+            asyncio.run_coroutine_threadsafe(close_adapters(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            if self.server is not None:
+                self.server.stop()
+
+    async def authorize(self, payment, amount):
+        """
+        Settle a payment from the processor's event loop.
+
+        Args:
+            payment (Payment): The payment.
+            amount (float): The amount in DHS.
+
+        Returns:
+            bool: True if the payment was approved.
+
+        Raises:
+            ValueError: If the payment's idempotency key was used for a different amount or method.
+        """
+        # Only touched from the event loop thread
+        request = (payment.payment_method, round(amount * FILS_PER_DHS))
+        known = self.requested.get(payment.idempotency_key)
+        if known is not None and known != request:
+            payment.status = "Failed"
+            raise ValueError("This idempotency key was already used for a payment of a different amount or method.")
+        self.requested.put(payment.idempotency_key, request)
+        adapter = self.adapters.get(payment.payment_method)
+        if adapter is None:
+            print("Invalid payment method!")
+            payment.status = "Failed"
+            return False
+        return await payment.process_payment_async(amount, adapter)
+
+    async def authorize_many(self, payments):
+        """
+        Settle several payments concurrently.
+
+        Args:
+            payments (iterable): (Payment, amount) pairs.
+
+        Returns:
+            list: For each payment, True if approved, False if declined, or the
+                GatewayUnavailableError that stopped it.
+        """
+        return await asyncio.gather(*(self.authorize(payment, amount) for payment, amount in payments),
+                                    return_exceptions=True)
+
+    def submit(self, payment, amount):
+        """
+        Start settling a payment in the background.
+
+        Returns:
+            Future: Resolves to True if the payment was approved, or raises GatewayUnavailableError.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.authorize(payment, amount), self.loop)
+
+    def submit_many(self, payments):
+        """
+        Start settling several payments concurrently in the background (see `authorize_many`).
+
+        Returns:
+            Future: Resolves to the list of outcomes.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.authorize_many(list(payments)), self.loop)
+
+    def process(self, payment, amount):
+        """
+        Settle a payment and wait for the outcome.
+
+        Returns:
+            bool: True if the payment was approved.
+
+        Raises:
+            GatewayUnavailableError: If the gateway could not be reached.
+        """
+        return self.submit(payment, amount).result()
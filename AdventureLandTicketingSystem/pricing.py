@@ -0,0 +1,238 @@
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for batch quotes
+    np = None
+
+from constants import (DISCOUNT_ON_TWO_DAY_PASS, DISCOUNT_ON_GROUP_TICKET, DISCOUNT_ON_ANNUAL_RENEWAL,
+                       MIN_GROUP_SIZE_FOR_DISCOUNT, TICKET_VALIDITY_DAYS, ONLINE_PAYMENT_METHODS)
+from record_format import TICKET_TYPE_CODES
+
+# The unit price of a ticket and the total discount it includes
+Quote = namedtuple("Quote", ["price", "discount"])
+
+# Column arrays with one entry per order line of a batch quote
+BatchQuote = namedtuple("BatchQuote", ["prices", "discounts", "totals", "validity_start", "validity_end"])
+
+
+class PricingEngine:
+    """
+    Precomputed ticket prices for every combination of the conditions that affect them.
+
+    The table is keyed by ticket type, payment method class (online or not), group size
+    bracket (below or at least `MIN_GROUP_SIZE_FOR_DISCOUNT`) and whether the purchase renews
+    an Annual Membership, so a quote is a single dictionary lookup. The table is rebuilt when
+    the catalog changes: a `TicketCatalog` bumps its `revision` on every change (including
+    discounts changed at another kiosk and read back by `DataStorage.refresh`); for a plain
+    dictionary, call `rebuild` after editing it.
+
+    With NumPy installed, `quote_batch` prices whole columns of order lines at once from the
+    same table, laid out as arrays indexed by ticket type code.
+    """
+    ONLINE_PAYMENT_METHODS = ONLINE_PAYMENT_METHODS
+
+    def __init__(self, catalog):
+        """
+        Initialize the engine.
+
+        Args:
+            catalog (dict): The ticket catalog (ticket type -> price, validity and admin discount).
+        """
+        self.catalog = catalog
+        self.table = {}
+        self.revision = None
+        self.rebuild()
+
+    @staticmethod
+    def discounts(ticket_type, default_discount, online, large_group, renewal):
+        """
+        List the discounts that apply to a ticket, in the order they are added up.
+
+        Args:
+            ticket_type (str): The ticket type.
+            default_discount (float): The discount set by the admin for the ticket type.
+            online (bool): Whether the payment method is an online one.
+            large_group (bool): Whether the group has at least `MIN_GROUP_SIZE_FOR_DISCOUNT` tickets.
+            renewal (bool): Whether the buyer already has an Annual Membership.
+
+        Returns:
+            list: The discounts (e.g., 0.10 for 10%).
+        """
+        discounts = []
+        if default_discount > 0:
+            discounts.append(default_discount)
+        # Two-Day Pass bought online
+        if ticket_type == "Two-Day Pass" and online:
+            discounts.append(DISCOUNT_ON_TWO_DAY_PASS)
+        # Group Ticket (10+) for groups of 20 or more
+        if ticket_type == "Group Ticket (10+)" and large_group:
+            discounts.append(DISCOUNT_ON_GROUP_TICKET)
+        # Annual Membership renewal
+        if ticket_type == "Annual Membership" and renewal:
+            discounts.append(DISCOUNT_ON_ANNUAL_RENEWAL)
+        return discounts
+
+    @staticmethod
+    def price_after(base_price, discounts):
+        """
+        Apply discounts to a base price the way `Ticket.apply_discount` accumulates them.
+
+        Returns:
+            Quote: The unit price, rounded to 2 decimals, and the total discount.
+        """
+        total = 0.0
+        for discount in discounts:
+            if not (0 <= discount <= 1):
+                raise ValueError("Discount percentage must be between 0 and 1.")
+            total += discount
+        return Quote(round(base_price * (1 - total), 2), total)
+
+    def rebuild(self):
+        """Recompute the price table from the catalog."""
+        table = {}
+        for ticket_type, details in self.catalog.items():
+            default_discount = details.get('discount', 0.0)
+            for online in (False, True):
+                for large_group in (False, True):
+                    for renewal in (False, True):
+                        discounts = PricingEngine.discounts(ticket_type, default_discount, online, large_group, renewal)
+                        table[ticket_type, online, large_group, renewal] = PricingEngine.price_after(
+                            details['price'], discounts
+                        )
+        self.table = table
+        self.revision = getattr(self.catalog, "revision", None)
+        self.arrays = None  # Built on the first batch quote
+
+    def lookup(self, ticket_type, payment_method, group_size=1, renewal=False):
+        """
+        Look up the price of a ticket.
+
+        Args:
+            ticket_type (str): The ticket type.
+            payment_method (str): The payment method (e.g., "credit card").
+            group_size (int): The number of tickets bought together.
+            renewal (bool): Whether the buyer already has an Annual Membership.
+
+        Returns:
+            Quote: The unit price and the total discount.
+
+        Raises:
+            ValueError: If the ticket type is not in the catalog.
+        """
+        if getattr(self.catalog, "revision", None) != self.revision:
+            self.rebuild()
+        quote = self.table.get((ticket_type, payment_method in PricingEngine.ONLINE_PAYMENT_METHODS,
+                                group_size >= MIN_GROUP_SIZE_FOR_DISCOUNT, bool(renewal)))
+        if quote is None:
+            raise ValueError("Invalid ticket type!")
+        return quote
+
+    def quote(self, ticket_type, payment_method, group_size=1, renewal=False):
+        """
+        Return the final unit price of a ticket; see `lookup` for the arguments.
+
+        Returns:
+            float: The unit price in DHS.
+        """
+        return self.lookup(ticket_type, payment_method, group_size, renewal).price
+
+    def quote_batch(self, ticket_types, quantities, payment_methods, visit_dates, renewals=None,
+                    membership_ends=None):
+        """
+        Price many order lines at once with vectorized NumPy operations.
+
+        Gives the same prices and validity dates as pricing each line with `Ticket.apply_discounts`
+        and `Ticket.set_validity_dates`.
+
+        Args:
+            ticket_types (array-like): Ticket type codes (see `record_format.TICKET_TYPE_CODES`).
+            quantities (array-like): The number of tickets on each line.
+            payment_methods (array-like): The payment method of each line (e.g., "credit card").
+            visit_dates (array-like): Visit dates as YYYY-MM-DD strings or `datetime64[D]` values.
+            renewals (array-like): Whether each line renews an Annual Membership the buyer already has.
+                Defaults to lines that have a membership end date.
+            membership_ends (array-like): The end date of the buyer's latest Annual Membership on each
+                line, NaT if none. Renewed memberships start the day after it.
+
+        Returns:
+            BatchQuote: Unit prices, total discounts, line totals, and validity start and end dates.
+
+        Raises:
+            ImportError: If NumPy is not installed.
+            ValueError: If a ticket type code is not in the catalog.
+        """
+        if np is None:
+            raise ImportError("Batch quotes require NumPy.")
+        if getattr(self.catalog, "revision", None) != self.revision:
+            self.rebuild()
+        if self.arrays is None:
+            self.arrays = self._build_arrays()
+        prices, discounts, validity_days = self.arrays
+
+        codes = np.asarray(ticket_types, dtype=np.intp)
+        quantities = np.asarray(quantities)
+        online = np.isin(np.asarray(payment_methods), list(PricingEngine.ONLINE_PAYMENT_METHODS))
+        large_group = quantities >= MIN_GROUP_SIZE_FOR_DISCOUNT
+        starts = np.asarray(visit_dates, dtype="datetime64[D]")
+        if membership_ends is not None:
+            membership_ends = np.asarray(membership_ends, dtype="datetime64[D]")
+        if renewals is None:
+            renewals = ~np.isnat(membership_ends) if membership_ends is not None else np.zeros(codes.shape, bool)
+        renewals = np.asarray(renewals, dtype=bool)
+
+        if codes.size and (codes.min() < 0 or codes.max() >= len(prices)):
+            raise ValueError("Invalid ticket type!")
+        index = (codes, online.astype(np.intp), large_group.astype(np.intp), renewals.astype(np.intp))
+        unit_prices = prices[index]
+        if np.isnan(unit_prices).any():
+            raise ValueError("Invalid ticket type!")
+
+        annual = codes == TICKET_TYPE_CODES["Annual Membership"]
+        if membership_ends is not None:
+            renewed = annual & ~np.isnat(membership_ends)
+            starts = np.where(renewed, membership_ends + np.timedelta64(1, "D"), starts)
+        return BatchQuote(
+            prices=unit_prices,
+            discounts=discounts[index],
+            totals=unit_prices * quantities,
+            validity_start=starts,
+            validity_end=starts + validity_days[codes],
+        )
+
+    def _build_arrays(self):
+        size = max(TICKET_TYPE_CODES.values()) + 1
+        prices = np.full((size, 2, 2, 2), np.nan)
+        discounts = np.zeros((size, 2, 2, 2))
+        validity_days = np.zeros(size, dtype="timedelta64[D]")
+        for (ticket_type, online, large_group, renewal), quote in self.table.items():
+            code = TICKET_TYPE_CODES.get(ticket_type)
+            if code is not None:
+                prices[code, int(online), int(large_group), int(renewal)] = quote.price
+                discounts[code, int(online), int(large_group), int(renewal)] = quote.discount
+                validity_days[code] = TICKET_VALIDITY_DAYS.get(ticket_type, 0)
+        return prices, discounts, validity_days
+
+    @staticmethod
+    def is_renewal(user, ticket_type):
+        """Return True if buying `ticket_type` renews an Annual Membership the user already has."""
+        return ticket_type == "Annual Membership" and user.count_tickets("Annual Membership") > 0
+
+    def price_ticket(self, ticket, user, group_size, payment_method):
+        """
+        Set the price and discount of a ticket created from the catalog.
+
+        Args:
+            ticket (Ticket): The ticket to price.
+            user (User): The buyer, whose purchase history decides renewals.
+            group_size (int): The number of tickets bought together.
+            payment_method (str): The payment method (e.g., "credit card").
+
+        Returns:
+            Quote: The unit price and the total discount.
+        """
+        quote = self.lookup(ticket.ticket_type, payment_method, group_size,
+                            PricingEngine.is_renewal(user, ticket.ticket_type))
+        ticket.discount = quote.discount
+        ticket.price = quote.price
+        return quote
@@ -0,0 +1,318 @@
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence
+from datetime import date
+
+from record_format import TicketRecordFormat, TICKET_TYPE_NAMES, FILS_PER_DHS, PARTS_PER_MILLION
+from constants import TICKET_VALIDITY
+from ticket import Ticket
+from ticket_block import TicketBlock, offset_ticket_id
+
+
+class PurchaseHistory(Sequence):
+    """
+    A user's tickets stored column by column in parallel arrays.
+
+    Each ticket takes the 38 bytes of its binary record (see `TicketRecordFormat`)
+    instead of a Python object per ticket plus one per attribute. Tickets issued
+    before integer IDs keep their UUID in a dictionary by row. Indexing and
+    iteration return `TicketView` objects that read like tickets, so code that only
+    reads purchase histories works unchanged. Tickets the record format cannot
+    represent are kept as objects.
+
+    A `TicketBlock` takes a single row however many tickets it holds. Once a history has a
+    block, it keeps the index of the first ticket of every row so that a ticket can still be
+    found by its position (with a binary search); until then rows and tickets are the same.
+    """
+    def __init__(self, tickets=()):
+        """
+        Initialize a history.
+
+        Args:
+            tickets (iterable): Tickets to add, in purchase order.
+        """
+        self._ids = array('q')  # 64-bit ticket IDs, 0 for tickets with a UUID
+        self._uuids = {}  # row -> UUID bytes of a ticket issued before integer IDs
+        self._types = array('B')
+        self._prices = array('q')  # fils
+        self._base_prices = array('q')  # fils
+        self._discounts = array('q')  # parts per million
+        self._default_discounts = array('q')  # parts per million
+        self._visit_dates = array('i')  # day ordinals, 0 for unknown
+        self._start_dates = array('i')
+        self._end_dates = array('i')
+        self._objects = {}  # row -> ticket that has no record form
+        self._starts = None  # Index of the first ticket of each row, once a block was added
+        self._length = 0  # Number of tickets, once a block was added
+        self.extend(tickets)
+
+    @staticmethod
+    def from_records(records):
+        """
+        Build a history from consecutive binary ticket records.
+
+        Args:
+            records (bytes): The encoded records.
+
+        Returns:
+            PurchaseHistory: The history.
+        """
+        history = PurchaseHistory()
+        history.extend_records(records)
+        return history
+
+    def _append_values(self, values, quantity=1):
+        if self._starts is not None:
+            self._starts.append(self._length)
+            self._length += quantity
+        version, code, raw_id, price, base_price, discount, default_discount, visit, start, end = values
+        if version == 1:
+            self._uuids[len(self._types)] = raw_id
+            raw_id = 0
+        self._ids.append(raw_id)
+        self._types.append(code)
+        self._prices.append(price)
+        self._base_prices.append(base_price)
+        self._discounts.append(discount)
+        self._default_discounts.append(default_discount)
+        self._visit_dates.append(visit)
+        self._start_dates.append(start)
+        self._end_dates.append(end)
+
+    def append(self, ticket):
+        """
+        Add a ticket at the end of the history.
+
+        Args:
+            ticket (Ticket): The ticket, or a `TicketBlock` of tickets.
+        """
+        quantity = 1
+        if isinstance(ticket, TicketBlock):
+            quantity = ticket.quantity
+            if self._starts is None:
+                self._starts = array('q', range(len(self._types)))
+                self._length = len(self._types)
+        try:
+            record = TicketRecordFormat.encode(ticket)
+            values = TicketRecordFormat.LAYOUTS[record[0]].unpack(record)
+        except ValueError:
+            if quantity > 1:
+                # Only single tickets are kept as objects
+                self.extend(list(ticket))
+                return
+            self._objects[len(self._types)] = ticket
+            values = (TicketRecordFormat.VERSION, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self._append_values(values, quantity)
+
+    def extend(self, tickets):
+        """Add several tickets (or ticket blocks) at the end of the history."""
+        if isinstance(tickets, PurchaseHistory):
+            tickets = list(tickets.entries())
+        for ticket in tickets:
+            self.append(ticket)
+
+    def extend_records(self, records):
+        """
+        Add tickets from consecutive binary ticket records.
+
+        Args:
+            records (bytes): The encoded records.
+        """
+        version = records[0] if records else TicketRecordFormat.VERSION
+        layout = TicketRecordFormat.LAYOUTS.get(version)
+        if layout is not None:
+            count, remainder = divmod(len(records), layout.size)
+            if not remainder and records[::layout.size].count(version) == count:
+                # Every record has the same layout: unpack them in one pass
+                for values in layout.iter_unpack(records):
+                    self._append_values(values)
+                return
+        # Versions 1 and 2 differ only in the ID column, so mixed records are read one by one
+        offset = 0
+        while offset < len(records):
+            layout = TicketRecordFormat.LAYOUTS.get(records[offset])
+            if layout is None:
+                raise ValueError(f"Unknown ticket record version {records[offset]}.")
+            self._append_values(layout.unpack_from(records, offset))
+            offset += layout.size
+
+    def to_records(self):
+        """
+        Encode the history as consecutive binary ticket records.
+
+        Returns:
+            bytes: The records.
+
+        Raises:
+            ValueError: If the history holds a ticket the record format cannot represent.
+        """
+        if self._objects:
+            raise ValueError("History holds tickets that have no record form.")
+        return b"".join(
+            self._pack_row(row, offset)
+            for row in range(len(self._types))
+            for offset in range(self._row_quantity(row))
+        )
+
+    def _pack_row(self, row, offset):
+        raw = self._uuids.get(row)
+        if raw is None:
+            version, packed_id = 2, offset_ticket_id(self._ids[row], offset)
+        else:
+            version = 1
+            packed_id = (int.from_bytes(raw, 'big') + offset).to_bytes(16, 'big') if offset else raw
+        return TicketRecordFormat.LAYOUTS[version].pack(
+            version, self._types[row], packed_id, self._prices[row], self._base_prices[row], self._discounts[row],
+            self._default_discounts[row], self._visit_dates[row], self._start_dates[row], self._end_dates[row]
+        )
+
+    def _row_quantity(self, row):
+        if self._starts is None:
+            return 1
+        end = self._starts[row + 1] if row + 1 < len(self._starts) else self._length
+        return end - self._starts[row]
+
+    @property
+    def row_count(self):
+        """The number of rows of the history: a ticket block counts once."""
+        return len(self._types)
+
+    def entries(self, start=0):
+        """
+        Iterate over the rows of the history: ticket blocks as `TicketBlock` and single tickets as tickets.
+
+        Args:
+            start (int): The first row.
+
+        Returns:
+            iterator: The entries, in purchase order.
+        """
+        for row in range(start, len(self._types)):
+            ticket = self._objects.get(row)
+            if ticket is not None:
+                yield ticket
+                continue
+            quantity = self._row_quantity(row)
+            view = TicketView(self, row)
+            yield TicketBlock(view, quantity, view.ticket_id) if quantity > 1 else view
+
+    def row_tickets(self, row):
+        """
+        Return the tickets of a row of the history (see `entries`).
+
+        Args:
+            row (int): The row.
+
+        Returns:
+            list: The tickets, one per ticket of a block.
+        """
+        ticket = self._objects.get(row)
+        if ticket is not None:
+            return [ticket]
+        return [TicketView(self, row, offset) for offset in range(self._row_quantity(row))]
+
+    def __len__(self):
+        return self._length if self._starts is not None else len(self._types)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[row] for row in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("purchase history index out of range")
+        row, offset = index, 0
+        if self._starts is not None:
+            row = bisect_right(self._starts, index) - 1
+            offset = index - self._starts[row]
+        ticket = self._objects.get(row)
+        return ticket if ticket is not None else TicketView(self, row, offset)
+
+    def __iter__(self):
+        for row in range(len(self._types)):
+            ticket = self._objects.get(row)
+            if ticket is not None:
+                yield ticket
+                continue
+            for offset in range(self._row_quantity(row)):
+                yield TicketView(self, row, offset)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __reduce__(self):
+        return (PurchaseHistory, (list(self.entries()),))
+
+
+def _ordinal_to_date(ordinal):
+    return date.fromordinal(ordinal) if ordinal else None
+
+
+class TicketView:
+    """A read-only ticket backed by one row of a `PurchaseHistory` (and its position within a ticket block)."""
+    __slots__ = ("_history", "_row", "_offset")
+
+    def __init__(self, history, row, offset=0):
+        self._history = history
+        self._row = row
+        self._offset = offset
+
+    @property
+    def ticket_id(self):
+        raw = self._history._uuids.get(self._row)
+        if raw is None:
+            return offset_ticket_id(self._history._ids[self._row], self._offset)
+        digits = raw.hex()
+        first_id = f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+        return offset_ticket_id(first_id, self._offset)
+
+    @property
+    def ticket_type(self):
+        return TICKET_TYPE_NAMES[self._history._types[self._row]]
+
+    @property
+    def validity(self):
+        return TICKET_VALIDITY[self.ticket_type]
+
+    @property
+    def price(self):
+        return self._history._prices[self._row] / FILS_PER_DHS
+
+    @property
+    def base_price(self):
+        return self._history._base_prices[self._row] / FILS_PER_DHS
+
+    @property
+    def discount(self):
+        return self._history._discounts[self._row] / PARTS_PER_MILLION
+
+    @property
+    def default_discount(self):
+        return self._history._default_discounts[self._row] / PARTS_PER_MILLION
+
+    @property
+    def visit_date(self):
+        visit = self._history._visit_dates[self._row]
+        return date.fromordinal(visit).isoformat() if visit else "Unknown"
+
+    @property
+    def validity_start_date(self):
+        return _ordinal_to_date(self._history._start_dates[self._row])
+
+    @property
+    def validity_end_date(self):
+        return _ordinal_to_date(self._history._end_dates[self._row])
+
+    def to_ticket(self):
+        """
+        Copy the row into a standalone ticket.
+
+        Returns:
+            Ticket: The ticket.
+        """
+        return Ticket.from_record(TicketRecordFormat.encode(self))
+
+    __str__ = Ticket.__str__
+
+    def __reduce__(self):
+        return (Ticket.from_record, (TicketRecordFormat.encode(self),))
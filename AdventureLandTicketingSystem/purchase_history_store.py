@@ -0,0 +1,141 @@
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from purchase_history import PurchaseHistory
+from record_format import TicketRecordFormat
+from ticket import Ticket
+
+
+class PurchaseHistoryStore:
+    """
+    An append-only file of purchase history segments that sits next to the users file.
+
+    Each segment holds a run of one user's tickets. The users file only keeps the
+    (offset, length) of each segment, so loading it stays small and fast no matter
+    how many tickets were ever sold; a user's tickets are read on first access.
+
+    Segments are written as binary ticket records (see `TicketRecordFormat`). A segment
+    with a ticket the format cannot represent is pickled instead; both kinds are read back.
+    """
+    HEADER = struct.Struct("<II")  # payload length, CRC32 of payload
+    RECORDS_MARKER = b"T"  # Payloads starting with this hold ticket records; others are pickles
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Initialize a store.
+
+        Args:
+            path (str): The path of the segment file.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def for_users_file(filename):
+        """
+        Return the shared store that belongs to a users file ('<filename>.history').
+
+        Args:
+            filename (str): The path of the users file.
+
+        Returns:
+            PurchaseHistoryStore: The store.
+        """
+        path = f"{filename}.history"
+        with PurchaseHistoryStore._stores_lock:
+            if path not in PurchaseHistoryStore._stores:
+                PurchaseHistoryStore._stores[path] = PurchaseHistoryStore(path)
+            return PurchaseHistoryStore._stores[path]
+
+    def append(self, tickets):
+        """
+        Write a segment of tickets at the end of the store. Call `sync` before relying on it.
+
+        Args:
+            tickets (list): The tickets to write.
+
+        Returns:
+            tuple: The (offset, length) of the segment.
+        """
+        payload = PurchaseHistoryStore.encode_segment(tickets)
+        record = PurchaseHistoryStore.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.path, 'ab') as file:
+                offset = file.tell()
+                file.write(record)
+        return (offset, len(record))
+
+    def sync(self):
+        """Flush every appended segment to disk."""
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb+') as file:
+                    os.fsync(file.fileno())
+
+    def read(self, segments, tickets=None):
+        """
+        Read the tickets of several segments, in order.
+
+        Args:
+            segments (list): (offset, length) pairs returned by `append`.
+            tickets (list or PurchaseHistory): Where to add the tickets (defaults to a new list).
+
+        Returns:
+            list or PurchaseHistory: The tickets.
+        """
+        tickets = [] if tickets is None else tickets
+        if not segments:
+            return tickets
+        with open(self.path, 'rb') as file:
+            for offset, length in segments:
+                file.seek(offset)
+                record = file.read(length)
+                size, checksum = PurchaseHistoryStore.HEADER.unpack_from(record)
+                payload = record[PurchaseHistoryStore.HEADER.size:]
+                if len(payload) != size or zlib.crc32(payload) != checksum:
+                    raise ValueError(f"Corrupted purchase history segment at offset {offset} of {self.path}.")
+                if isinstance(tickets, PurchaseHistory) and payload[:1] == PurchaseHistoryStore.RECORDS_MARKER:
+                    tickets.extend_records(payload[1:])
+                else:
+                    tickets.extend(PurchaseHistoryStore.decode_segment(payload))
+        return tickets
+
+    @staticmethod
+    def encode_segment(tickets):
+        """
+        Encode tickets as a segment payload.
+
+        Args:
+            tickets (list): The tickets to encode.
+
+        Returns:
+            bytes: Binary ticket records, or a pickle if a ticket cannot be stored as a record.
+        """
+        try:
+            return PurchaseHistoryStore.RECORDS_MARKER + TicketRecordFormat.encode_many(tickets)
+        except ValueError:
+            return pickle.dumps(list(tickets), protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode_segment(payload):
+        """
+        Decode a segment payload written by `encode_segment`.
+
+        Args:
+            payload (bytes): The payload.
+
+        Returns:
+            list: The tickets.
+        """
+        if payload[:1] == PurchaseHistoryStore.RECORDS_MARKER:
+            return Ticket.from_records(payload[1:])
+        return pickle.loads(payload)
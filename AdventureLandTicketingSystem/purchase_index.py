@@ -0,0 +1,61 @@
+from itertools import islice
+
+from purchase_history import PurchaseHistory
+
+
+class PurchaseIndex:
+    """
+    Secondary indexes over a user's purchase history.
+
+    Purchase histories only grow at the end, so the index remembers how many rows it has
+    seen and indexes just the new ones on each update. A history that got shorter was replaced
+    and is indexed again from the start. A ticket block is indexed once, as one row, however
+    many tickets it holds.
+
+    Attributes:
+        size (int): Number of leading rows of the history that are indexed.
+        type_counts (dict): Number of tickets per ticket type.
+        latest_membership_end (date): The latest validity end date of an Annual Membership, or None.
+        rows_by_visit_date (dict): Rows of the history holding the tickets for each visit date.
+    """
+    __slots__ = ("size", "type_counts", "latest_membership_end", "rows_by_visit_date")
+
+    def __init__(self):
+        """Initialize an empty index."""
+        self.clear()
+
+    def clear(self):
+        """Forget every indexed ticket."""
+        self.size = 0
+        self.type_counts = {}
+        self.latest_membership_end = None
+        self.rows_by_visit_date = {}
+
+    def update(self, history):
+        """
+        Index the rows appended to a history since the last update.
+
+        Args:
+            history (sequence): The purchase history (a list or a `PurchaseHistory`, whose rows
+                are its entries).
+
+        Returns:
+            None
+        """
+        columnar = isinstance(history, PurchaseHistory)
+        rows = history.row_count if columnar else len(history)
+        if rows < self.size:
+            self.clear()
+        entries = history.entries(self.size) if columnar else islice(history, self.size, None)
+        for row, ticket in enumerate(entries, self.size):
+            quantity = getattr(ticket, "quantity", 1)
+            self.type_counts[ticket.ticket_type] = self.type_counts.get(ticket.ticket_type, 0) + quantity
+            if ticket.ticket_type == "Annual Membership" and ticket.validity_end_date is not None:
+                if self.latest_membership_end is None or ticket.validity_end_date > self.latest_membership_end:
+                    self.latest_membership_end = ticket.validity_end_date
+            self.rows_by_visit_date.setdefault(ticket.visit_date, []).append(row)
+        self.size = rows
+
+    def count(self, *ticket_types):
+        """Return the number of tickets of the given types."""
+        return sum(self.type_counts.get(ticket_type, 0) for ticket_type in ticket_types)
@@ -0,0 +1,345 @@
+import struct
+import uuid
+from datetime import date
+from functools import lru_cache
+
+from constants import TICKET_PRICES, TICKET_VALIDITY, PAYMENT_METHODS
+
+# Ticket types are stored as small integer codes, in catalog order (0 is never used)
+TICKET_TYPE_CODES = {ticket_type: code for code, ticket_type in enumerate(TICKET_PRICES, start=1)}
+TICKET_TYPE_NAMES = {code: ticket_type for ticket_type, code in TICKET_TYPE_CODES.items()}
+
+# Payment methods are stored the same way; 0 means the payment method was not recorded
+PAYMENT_METHOD_CODES = {method: code for code, method in enumerate(PAYMENT_METHODS, start=1)}
+PAYMENT_METHOD_NAMES = {code: method for method, code in PAYMENT_METHOD_CODES.items()}
+
+FILS_PER_DHS = 100
+PARTS_PER_MILLION = 1_000_000
+
+
+def _to_fils(amount):
+    fils = round(amount * FILS_PER_DHS)
+    if abs(fils - amount * FILS_PER_DHS) > 1e-6:
+        raise ValueError(f"Price {amount} cannot be stored in whole fils.")
+    return fils
+
+
+def _to_ppm(fraction):
+    ppm = round(fraction * PARTS_PER_MILLION)
+    if abs(ppm - fraction * PARTS_PER_MILLION) > 1e-6:
+        raise ValueError(f"Discount {fraction} cannot be stored in parts per million.")
+    return ppm
+
+
+def _id_to_bytes(identifier):
+    try:
+        return uuid.UUID(identifier).bytes
+    except (ValueError, AttributeError, TypeError):
+        raise ValueError(f"ID {identifier!r} cannot be stored as a binary UUID.")
+
+
+def _bytes_to_id(raw):
+    # Same text as str(uuid.UUID(bytes=raw)), several times faster
+    digits = raw.hex()
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+
+def _id_version(identifier):
+    """Return the record version that stores an ID: 2 for 64-bit integer IDs, 1 for UUID strings."""
+    if isinstance(identifier, int):
+        if not 0 < identifier < 2 ** 63:
+            raise ValueError(f"ID {identifier!r} cannot be stored as a 64-bit integer.")
+        return 2
+    return 1
+
+
+def _packed_id(identifier, version):
+    return identifier if version == 2 else _id_to_bytes(identifier)
+
+
+def _unpacked_id(value):
+    return value if isinstance(value, int) else _bytes_to_id(value)
+
+
+def _date_to_ordinal(value):
+    """Store a date (or an ISO date string) as a day ordinal; 0 means unknown."""
+    if value is None or value == "Unknown":
+        return 0
+    if isinstance(value, str):
+        try:
+            value = date.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Date {value!r} cannot be stored as a day ordinal.")
+    return value.toordinal()
+
+
+@lru_cache(maxsize=4096)
+def _ordinal_to_date(ordinal):
+    return date.fromordinal(ordinal) if ordinal else None
+
+
+@lru_cache(maxsize=4096)
+def _ordinal_to_text(ordinal):
+    return date.fromordinal(ordinal).isoformat() if ordinal else "Unknown"
+
+
+def _type_code(ticket_type):
+    code = TICKET_TYPE_CODES.get(ticket_type)
+    if code is None:
+        raise ValueError(f"Ticket type {ticket_type!r} has no record code.")
+    return code
+
+
+class TicketRecordFormat:
+    """
+    Versioned, fixed-width binary records for tickets.
+
+    Layout of version 2 (38 bytes, little endian):
+        version (B), ticket type code (B), ticket ID as a 64-bit integer (Q),
+        price and base price in fils (i, i), discount and default discount in
+        parts per million (I, I), visit date, validity start and validity end as
+        day ordinals with 0 for unknown (i, i, i).
+
+    Version 1 (46 bytes) is the same with the ticket ID as UUID bytes (16s). Tickets
+    issued before integer IDs keep their UUID, so they are still written as version 1.
+
+    The validity string and VIP availability limit are derived from the ticket type
+    and are not stored. Older versions are decoded with their own layout and then
+    passed through the upgraders in `UPGRADERS` until they reach `VERSION`.
+    """
+    VERSION = 2
+    LAYOUTS = {
+        1: struct.Struct("<BB16siiIIiii"),
+        2: struct.Struct("<BBQiiIIiii"),
+    }
+    UPGRADERS = {
+        1: dict,  # Version 2 only adds integer IDs: UUID IDs are kept as they are
+    }  # version -> function turning that version's fields into the next version's
+
+    @staticmethod
+    def encode(ticket):
+        """
+        Encode a ticket as one record of the current version (version 1 for UUID IDs).
+
+        Args:
+            ticket (Ticket): The ticket to encode.
+
+        Returns:
+            bytes: The record.
+
+        Raises:
+            ValueError: If the ticket has a field the format cannot represent exactly.
+        """
+        code = _type_code(ticket.ticket_type)
+        if ticket.validity != TICKET_VALIDITY[ticket.ticket_type]:
+            raise ValueError(f"Validity {ticket.validity!r} does not match the ticket type.")
+        version = _id_version(ticket.ticket_id)
+        return TicketRecordFormat.LAYOUTS[version].pack(
+            version,
+            code,
+            _packed_id(ticket.ticket_id, version),
+            _to_fils(ticket.price),
+            _to_fils(ticket.base_price),
+            _to_ppm(ticket.discount),
+            _to_ppm(ticket.default_discount),
+            _date_to_ordinal(ticket.visit_date),
+            _date_to_ordinal(ticket.validity_start_date),
+            _date_to_ordinal(ticket.validity_end_date),
+        )
+
+    @staticmethod
+    def decode(buffer, offset=0):
+        """
+        Decode one record of any known version.
+
+        Args:
+            buffer (bytes): The buffer holding the record.
+            offset (int): Where the record starts.
+
+        Returns:
+            tuple: (fields, record size) where fields is a dictionary of ticket attributes.
+        """
+        version = buffer[offset]
+        layout = TicketRecordFormat.LAYOUTS.get(version)
+        if layout is None:
+            raise ValueError(f"Unknown ticket record version {version}.")
+        values = layout.unpack_from(buffer, offset)
+        fields = TicketRecordFormat._DECODERS[version](values)
+        while version < TicketRecordFormat.VERSION:
+            fields = TicketRecordFormat.UPGRADERS[version](fields)
+            version += 1
+        return fields, layout.size
+
+    @staticmethod
+    def _decode_fields(values):
+        # Versions 1 and 2 only differ in how the ID is packed
+        _, code, raw_id, price, base_price, discount, default_discount, visit, start, end = values
+        ticket_type = TICKET_TYPE_NAMES[code]
+        return {
+            "ticket_id": _unpacked_id(raw_id),
+            "ticket_type": ticket_type,
+            "price": price / FILS_PER_DHS,
+            "base_price": base_price / FILS_PER_DHS,
+            "validity": TICKET_VALIDITY[ticket_type],
+            "visit_date": _ordinal_to_text(visit),
+            "discount": discount / PARTS_PER_MILLION,
+            "default_discount": default_discount / PARTS_PER_MILLION,
+            "validity_start_date": _ordinal_to_date(start),
+            "validity_end_date": _ordinal_to_date(end),
+        }
+
+    @staticmethod
+    def encode_many(tickets):
+        """Encode tickets as consecutive records."""
+        return b"".join(TicketRecordFormat.encode(ticket) for ticket in tickets)
+
+    @staticmethod
+    def decode_many(buffer):
+        """Decode consecutive records into a list of field dictionaries."""
+        version = buffer[0] if buffer else TicketRecordFormat.VERSION
+        layout = TicketRecordFormat.LAYOUTS.get(version)
+        if layout is not None:
+            count, remainder = divmod(len(buffer), layout.size)
+            if not remainder and buffer[::layout.size].count(version) == count:
+                # Every record has the same layout: unpack them in one pass
+                records = [TicketRecordFormat._DECODERS[version](values) for values in layout.iter_unpack(buffer)]
+                for older in range(version, TicketRecordFormat.VERSION):
+                    records = [TicketRecordFormat.UPGRADERS[older](fields) for fields in records]
+                return records
+        records = []
+        offset = 0
+        while offset < len(buffer):
+            fields, size = TicketRecordFormat.decode(buffer, offset)
+            records.append(fields)
+            offset += size
+        return records
+
+    @staticmethod
+    def upgrade_legacy_state(state):
+        """
+        Upgrade the attribute dictionary of a ticket pickled as a plain object (before record versions).
+
+        Fills in fields that older tickets did not have and drops ones that are now derived.
+
+        Args:
+            state (dict): The pickled attributes.
+
+        Returns:
+            dict: The attributes of a current ticket.
+        """
+        state = dict(state)
+        state.setdefault("visit_date", "Unknown")
+        state.setdefault("base_price", state.get("price"))
+        state.setdefault("discount", 0.0)
+        state.setdefault("default_discount", 0.0)
+        state.setdefault("validity_start_date", None)
+        state.setdefault("validity_end_date", None)
+        state.pop("limited_availability", None)
+        return state
+
+
+TicketRecordFormat._DECODERS = {1: TicketRecordFormat._decode_fields, 2: TicketRecordFormat._decode_fields}
+
+
+class TransactionRecordFormat:
+    """
+    Versioned binary records for sales transactions.
+
+    Layout of version 3: a fixed-width 29-byte header, version (B), transaction ID
+    as a 64-bit integer (Q), ticket type code (B), payment method code with 0 for
+    none (B), quantity (I), total price in fils (q), date of purchase as a day
+    ordinal (i), customer name length (H), followed by the UTF-8 customer name.
+
+    Version 2 has no payment method. Version 1 has neither a payment method nor an
+    integer ID (the transaction ID is UUID bytes, 16s); it is still written for
+    transactions with a UUID ID and no payment method.
+    """
+    VERSION = 3
+    LAYOUTS = {
+        1: struct.Struct("<B16sBIqiH"),
+        2: struct.Struct("<BQBIqiH"),
+        3: struct.Struct("<BQBBIqiH"),
+    }
+    UPGRADERS = {
+        1: dict,  # Version 2 only adds integer IDs
+        2: lambda fields: {**fields, "payment_method": None},
+    }
+
+    @staticmethod
+    def encode(transaction):
+        """
+        Encode a transaction as one record of the current version.
+
+        Raises:
+            ValueError: If the transaction has a field the format cannot represent exactly.
+        """
+        name = (transaction.customer_name or "").encode("utf-8")
+        if len(name) > 0xFFFF:
+            raise ValueError("Customer name is too long for a transaction record.")
+        payment_code = 0
+        if transaction.payment_method is not None:
+            payment_code = PAYMENT_METHOD_CODES.get(transaction.payment_method)
+            if payment_code is None:
+                raise ValueError(f"Payment method {transaction.payment_method!r} has no record code.")
+        fields = [
+            _type_code(transaction.ticket_type),
+            transaction.quantity,
+            _to_fils(transaction.total_price),
+            _date_to_ordinal(transaction.date_of_purchase),
+            len(name),
+        ]
+        if _id_version(transaction.transaction_id) == 1:
+            if payment_code:
+                raise ValueError("Only transactions with an integer ID record a payment method.")
+            version, packed_id = 1, _id_to_bytes(transaction.transaction_id)
+        else:
+            version, packed_id = 3, transaction.transaction_id
+            fields.insert(1, payment_code)
+        return TransactionRecordFormat.LAYOUTS[version].pack(version, packed_id, *fields) + name
+
+    @staticmethod
+    def decode(buffer, offset=0):
+        """
+        Decode one record of any known version.
+
+        Returns:
+            tuple: (fields, record size) where fields is a dictionary of transaction attributes.
+        """
+        version = buffer[offset]
+        layout = TransactionRecordFormat.LAYOUTS.get(version)
+        if layout is None:
+            raise ValueError(f"Unknown transaction record version {version}.")
+        values = list(layout.unpack_from(buffer, offset))
+        payment_code = values.pop(3) if version >= 3 else 0
+        _, raw_id, code, quantity, total, purchased, name_length = values
+        name_start = offset + layout.size
+        fields = {
+            "transaction_id": _unpacked_id(raw_id),
+            "customer_name": bytes(buffer[name_start:name_start + name_length]).decode("utf-8"),
+            "ticket_type": TICKET_TYPE_NAMES[code],
+            "quantity": quantity,
+            "total_price": total / FILS_PER_DHS,
+            "date_of_purchase": _ordinal_to_text(purchased),
+        }
+        if version >= 3:
+            fields["payment_method"] = PAYMENT_METHOD_NAMES.get(payment_code)
+        while version < TransactionRecordFormat.VERSION:
+            fields = TransactionRecordFormat.UPGRADERS[version](fields)
+            version += 1
+        return fields, layout.size + name_length
+
+    @staticmethod
+    def encode_many(transactions):
+        """Encode transactions as consecutive records."""
+        return b"".join(TransactionRecordFormat.encode(transaction) for transaction in transactions)
+
+    @staticmethod
+    def decode_many(buffer):
+        """Decode consecutive records of any known versions into a list of field dictionaries."""
+        records = []
+        offset = 0
+        while offset < len(buffer):
+            fields, size = TransactionRecordFormat.decode(buffer, offset)
+            records.append(fields)
+            offset += size
+        return records
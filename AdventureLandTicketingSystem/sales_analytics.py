@@ -0,0 +1,272 @@
+from collections import namedtuple
+from datetime import date
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for sales analytics
+    np = None
+
+from record_format import FILS_PER_DHS, TICKET_TYPE_CODES, TICKET_TYPE_NAMES
+from sales_index import SalesReportIndex
+
+# Revenue in DHS of each ticket type (columns) on each day (rows)
+RevenuePivot = namedtuple("RevenuePivot", ["days", "ticket_types", "revenue"])
+
+# Average transaction of a period
+Basket = namedtuple("Basket", ["transactions", "customers", "tickets", "revenue"])
+
+# Column arrays with one entry per week (Monday to Sunday) from the first to the last week with sales
+WeeklySales = namedtuple("WeeklySales", ["week_start", "revenue", "quantity", "revenue_change", "revenue_change_ratio"])
+
+
+class SalesColumns:
+    """
+    The transactions of a sales report as NumPy column arrays.
+
+    Attributes:
+        size (int): Number of leading transactions of the report that are loaded.
+        day (ndarray): The proleptic Gregorian ordinal of the report date.
+        type_code (ndarray): The ticket type code (see `TICKET_TYPE_CODES`), 0 for unknown types.
+        quantity (ndarray): Tickets sold.
+        revenue (ndarray): Total price in fils.
+        customer (ndarray): The customer's code (see `SalesAnalytics.customers`).
+    """
+    __slots__ = ("size", "day", "type_code", "quantity", "revenue", "customer")
+    COLUMNS = ("day", "type_code", "quantity", "revenue", "customer")
+    DTYPES = ("int32", "int16", "int32", "int64", "int32")
+
+    @staticmethod
+    def empty():
+        """Return columns with no transactions."""
+        columns = SalesColumns()
+        columns.size = 0
+        for name, dtype in zip(SalesColumns.COLUMNS, SalesColumns.DTYPES):
+            setattr(columns, name, np.zeros(0, dtype=dtype))
+        return columns
+
+
+class SalesAnalytics:
+    """
+    Vectorized sales queries over every transaction, loaded into NumPy column arrays.
+
+    Each report is loaded into its own columns once. Reports only grow, so later loads convert
+    just the transactions appended since, and the columns of all reports are concatenated
+    in date order. Group-bys are then a `bincount` over the whole store rather than a Python
+    loop over transactions. Revenue is kept in whole fils, like the rollups, and only
+    converted to DHS in the results.
+    """
+    def __init__(self, reports):
+        """
+        Initialize the analytics of a sales report collection.
+
+        Args:
+            reports (dict): Sales reports keyed by ISO date (a dictionary, tracked dictionary or SQLite table).
+        """
+        self.index = SalesReportIndex(reports)
+        self.customers = []  # Customer names, by code
+        self.customer_codes = {}
+        self.loaded = {}  # Report date -> (report, SalesColumns)
+        self.columns = None  # SalesColumns of every report, or None when a report changed since
+        self.type_count = max(TICKET_TYPE_CODES.values()) + 1
+
+    def _customer_code(self, name):
+        code = self.customer_codes.get(name)
+        if code is None:
+            code = self.customer_codes[name] = len(self.customers)
+            self.customers.append(name)
+        return code
+
+    def _load_report(self, report_date, report):
+        # Returns True if the report's columns changed
+        entry = self.loaded.get(report_date)
+        if entry is not None and entry[0] is report and entry[1].size <= report.transaction_count:
+            columns = entry[1]
+            if columns.size == report.transaction_count:
+                return False
+        else:
+            columns = SalesColumns.empty()  # A new report, or one replaced by a reload
+
+        transactions = report.transactions  # Closed days are read back from the archive
+        new = transactions[columns.size:]
+        count = len(new)
+        day = date.fromisoformat(report.date).toordinal()
+        fresh = {
+            "day": np.full(count, day, dtype="int32"),
+            "type_code": np.fromiter((TICKET_TYPE_CODES.get(t.ticket_type, 0) for t in new), "int16", count),
+            "quantity": np.fromiter((t.quantity for t in new), "int32", count),
+            "revenue": np.fromiter((round(t.total_price * FILS_PER_DHS) for t in new), "int64", count),
+            "customer": np.fromiter((self._customer_code(t.customer_name) for t in new), "int32", count),
+        }
+        for name, values in fresh.items():
+            setattr(columns, name, np.concatenate((getattr(columns, name), values)))
+        columns.size = len(transactions)
+        self.loaded[report_date] = (report, columns)
+        return True
+
+    def refresh(self):
+        """
+        Load the transactions recorded since the last query.
+
+        Returns:
+            SalesColumns: The columns of every transaction, in report date order.
+
+        Raises:
+            ImportError: If NumPy is not installed.
+        """
+        if np is None:
+            raise ImportError("Sales analytics require NumPy.")
+        dates = self.index.dates_between()
+        changed = len(dates) != len(self.loaded)
+        for report_date in dates:
+            changed = self._load_report(report_date, self.index.reports[report_date]) or changed
+        if changed or self.columns is None:
+            if len(self.loaded) != len(dates):
+                self.loaded = {report_date: self.loaded[report_date] for report_date in dates}
+            chunks = [self.loaded[report_date][1] for report_date in dates]
+            columns = SalesColumns.empty()
+            if chunks:
+                columns.size = sum(chunk.size for chunk in chunks)
+                for name in SalesColumns.COLUMNS:
+                    setattr(columns, name, np.concatenate([getattr(chunk, name) for chunk in chunks]))
+            self.columns = columns
+        return self.columns
+
+    def _window(self, start, end, ticket_type=None):
+        # The rows of a period, as a slice when no type is asked for, since days are sorted
+        columns = self.refresh()
+        low = 0 if start is None else np.searchsorted(columns.day, SalesAnalytics._ordinal(start), "left")
+        high = columns.size if end is None else np.searchsorted(columns.day, SalesAnalytics._ordinal(end), "right")
+        rows = slice(low, high)
+        if ticket_type is not None:
+            if ticket_type not in TICKET_TYPE_CODES:
+                raise ValueError("Invalid ticket type!")
+            rows = low + np.flatnonzero(columns.type_code[rows] == TICKET_TYPE_CODES[ticket_type])
+        return columns, rows
+
+    @staticmethod
+    def _ordinal(value):
+        if isinstance(value, date):
+            return value.toordinal()
+        try:
+            return date.fromisoformat(value).toordinal()
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid date '{value}'. Please use YYYY-MM-DD.")
+
+    def revenue_by_type_by_day(self, start=None, end=None):
+        """
+        Pivot the revenue of a period by day and ticket type.
+
+        Args:
+            start (str or date): The first day of the period (YYYY-MM-DD), or None for the first sale.
+            end (str or date): The last day of the period, included, or None for the last sale.
+
+        Returns:
+            RevenuePivot: The days with sales (`datetime64[D]`), the ticket types sold, and a
+                days x ticket types array of revenue in DHS.
+        """
+        columns, rows = self._window(start, end)
+        days = columns.day[rows]
+        if not len(days):
+            return RevenuePivot(np.zeros(0, dtype="datetime64[D]"), [], np.zeros((0, 0)))
+        first = int(days[0])  # The rows are in date order
+        span = int(days[-1]) - first + 1
+        cell_rows = (days - first) * self.type_count + columns.type_code[rows]
+        cells = np.bincount(cell_rows, weights=columns.revenue[rows],
+                            minlength=span * self.type_count).reshape(span, self.type_count)
+        counts = np.bincount(cell_rows, minlength=span * self.type_count).reshape(span, self.type_count)
+        with_sales = np.flatnonzero(counts.any(axis=1))
+        sold = np.flatnonzero(counts.any(axis=0))
+        return RevenuePivot(
+            days=(with_sales + first - date(1970, 1, 1).toordinal()).astype("datetime64[D]"),
+            ticket_types=[TICKET_TYPE_NAMES.get(code, "Unknown") for code in sold],
+            revenue=cells[np.ix_(with_sales, sold)] / FILS_PER_DHS,
+        )
+
+    def average_basket(self, start=None, end=None, ticket_type=None):
+        """
+        Return the average transaction of a period.
+
+        Args:
+            start (str or date): The first day of the period, or None.
+            end (str or date): The last day of the period, included, or None.
+            ticket_type (str): Only count transactions of this ticket type.
+
+        Returns:
+            Basket: The number of transactions and distinct customers, and the average tickets
+                and revenue in DHS per transaction (0 if there were none).
+        """
+        columns, rows = self._window(start, end, ticket_type)
+        quantity = columns.quantity[rows]
+        count = len(quantity)
+        if not count:
+            return Basket(0, 0, 0.0, 0.0)
+        return Basket(
+            transactions=count,
+            customers=int(np.count_nonzero(np.bincount(columns.customer[rows], minlength=len(self.customers)))),
+            tickets=float(quantity.mean()),
+            revenue=round(float(columns.revenue[rows].sum()) / count / FILS_PER_DHS, 2),
+        )
+
+    def week_over_week(self, start=None, end=None, ticket_type=None):
+        """
+        Return the sales of each week of a period and their change from the week before.
+
+        Args:
+            start (str or date): The first day of the period, or None.
+            end (str or date): The last day of the period, included, or None.
+            ticket_type (str): Only count sales of this ticket type.
+
+        Returns:
+            WeeklySales: The Monday of each week (`datetime64[D]`), its revenue in DHS and tickets,
+                the revenue change in DHS and as a ratio of the week before (NaN for the first
+                week and after weeks without sales).
+        """
+        columns, rows = self._window(start, end, ticket_type)
+        weeks = (columns.day[rows] - 1) // 7  # Ordinal 1, 1 January of year 1, was a Monday
+        if not len(weeks):
+            empty = np.zeros(0)
+            return WeeklySales(np.zeros(0, dtype="datetime64[D]"), empty, np.zeros(0, dtype="int64"), empty, empty)
+        first = weeks.min()
+        offsets = weeks - first
+        size = int(offsets.max()) + 1
+        revenue = np.bincount(offsets, weights=columns.revenue[rows], minlength=size) / FILS_PER_DHS
+        quantity = np.bincount(offsets, weights=columns.quantity[rows], minlength=size).astype("int64")
+        change = np.concatenate(([np.nan], np.diff(revenue)))
+        previous = np.concatenate(([np.nan], revenue[:-1]))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(previous > 0, change / previous, np.nan)
+        mondays = (first + np.arange(size)) * 7 + 1 - date(1970, 1, 1).toordinal()
+        return WeeklySales(mondays.astype("datetime64[D]"), revenue, quantity, change, ratio)
+
+    def report_lines(self, start=None, end=None):
+        """
+        Format the revenue pivot, average basket and weekly changes of a period for display.
+
+        Args:
+            start (str or date): The first day of the period, or None.
+            end (str or date): The last day of the period, included, or None.
+
+        Returns:
+            list: The lines of text.
+        """
+        pivot = self.revenue_by_type_by_day(start, end)
+        if not len(pivot.days):
+            return ["No sales in this period."]
+        lines = ["Revenue per Ticket Type per Day (DHS):",
+                 "  " + " | ".join(["Date"] + pivot.ticket_types)]
+        for day, revenue in zip(pivot.days, pivot.revenue):
+            lines.append("  " + " | ".join([str(day)] + [f"{value:.2f}" for value in revenue]))
+        basket = self.average_basket(start, end)
+        lines.append(f"Average Basket: {basket.tickets:.2f} tickets, {basket.revenue:.2f} DHS "
+                     f"({basket.transactions} transactions, {basket.customers} customers)")
+        lines.append("Week over Week:")
+        weekly = self.week_over_week(start, end)
+        for week_start, revenue, change, ratio in zip(weekly.week_start, weekly.revenue,
+                                                      weekly.revenue_change, weekly.revenue_change_ratio):
+            if not revenue and not change:
+                continue  # Only the first of a run of weeks without sales is shown
+            delta = "" if np.isnan(change) else f", {change:+.2f} DHS"
+            if not np.isnan(ratio):
+                delta += f" ({ratio:+.1%})"
+            lines.append(f"  Week of {week_start}: {revenue:.2f} DHS{delta}")
+        return lines
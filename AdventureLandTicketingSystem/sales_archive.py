@@ -0,0 +1,328 @@
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from constants import FILE_PATH_SALES_REPORTS, FILE_PATH_SALES_ROLLUPS, SALES_CLOSE_CHECK_INTERVAL_SECONDS
+from data_storage import DataStorage, ConcurrentUpdateError
+from record_format import TransactionRecordFormat
+from sales_report import SalesReport, Transaction
+from sales_rollup import SalesRollup, PeriodRollup
+from utils import Utils
+
+
+class SalesArchive:
+    """
+    An append-only file of the raw transactions of closed days, next to the sales reports file.
+
+    Each segment holds the transactions of one day. The closed report only keeps the
+    (offset, length) of its segment, so closed days cost almost nothing to load, and their
+    transactions are only read when someone asks for them (an export, a transaction listing).
+
+    Segments are written as binary transaction records (see `TransactionRecordFormat`). A
+    segment with a transaction the format cannot represent is pickled instead.
+    """
+    HEADER = struct.Struct("<II")  # payload length, CRC32 of payload
+    RECORDS_MARKER = b"R"  # Payloads starting with this hold transaction records; others are pickles
+
+    _archives = {}
+    _archives_lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Initialize an archive.
+
+        Args:
+            path (str): The path of the archive file.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def for_reports_file(filename):
+        """
+        Return the shared archive that belongs to a sales reports file ('<filename>.archive').
+
+        Args:
+            filename (str): The path of the sales reports file.
+
+        Returns:
+            SalesArchive: The archive.
+        """
+        path = f"{filename}.archive"
+        with SalesArchive._archives_lock:
+            if path not in SalesArchive._archives:
+                SalesArchive._archives[path] = SalesArchive(path)
+            return SalesArchive._archives[path]
+
+    def append(self, transactions):
+        """
+        Write a segment of transactions at the end of the archive. Call `sync` before relying on it.
+
+        Args:
+            transactions (list): The transactions to write.
+
+        Returns:
+            tuple: The (offset, length) of the segment.
+        """
+        payload = SalesArchive.encode_segment(transactions)
+        record = SalesArchive.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.path, 'ab') as file:
+                offset = file.tell()
+                file.write(record)
+        return (offset, len(record))
+
+    def sync(self):
+        """Flush every appended segment to disk."""
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb+') as file:
+                    os.fsync(file.fileno())
+
+    def read(self, segment):
+        """
+        Read the transactions of a segment.
+
+        Args:
+            segment (tuple): The (offset, length) returned by `append`.
+
+        Returns:
+            list: The transactions.
+        """
+        offset, length = segment
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            record = file.read(length)
+        size, checksum = SalesArchive.HEADER.unpack_from(record)
+        payload = record[SalesArchive.HEADER.size:]
+        if len(payload) != size or zlib.crc32(payload) != checksum:
+            raise ValueError(f"Corrupted sales archive segment at offset {offset} of {self.path}.")
+        return SalesArchive.decode_segment(payload)
+
+    @staticmethod
+    def encode_segment(transactions):
+        """
+        Encode transactions as a segment payload.
+
+        Args:
+            transactions (list): The transactions to encode.
+
+        Returns:
+            bytes: Binary transaction records, or a pickle if a transaction cannot be stored as a record.
+        """
+        try:
+            return SalesArchive.RECORDS_MARKER + TransactionRecordFormat.encode_many(transactions)
+        except ValueError:
+            return pickle.dumps(list(transactions), protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode_segment(payload):
+        """
+        Decode a segment payload written by `encode_segment`.
+
+        Args:
+            payload (bytes): The payload.
+
+        Returns:
+            list: The transactions.
+        """
+        if payload[:1] == SalesArchive.RECORDS_MARKER:
+            return Transaction.from_records(payload[1:])
+        return pickle.loads(payload)
+
+
+class ClosedSalesReport(SalesReport):
+    """
+    The sealed summary of a day whose sales are closed.
+
+    It keeps the report's ID, date and rollup. The transactions were moved to a segment of
+    the `SalesArchive` and are read back from it each time they are asked for, so a closed
+    day takes a few hundred bytes in memory however many sales it had. It takes no new
+    transactions.
+    """
+    closed = True
+
+    def __init__(self, report, archive, archive_segment):
+        """
+        Seal a sales report whose transactions were written to the archive.
+
+        Args:
+            report (SalesReport): The report of the day.
+            archive (SalesArchive): The archive holding its transactions.
+            archive_segment (tuple): The (offset, length) of their segment.
+        """
+        self.report_id = report.report_id
+        self.date = report.date
+        self._rollup = report.rollup.copy()
+        self._rolled_up = report.transaction_count
+        self._type_rows = {}
+        self._type_rows_size = 0
+        self.archive_segment = archive_segment
+        self._archive = archive
+        self._init_tracking()
+
+    @property
+    def transactions(self):
+        """The day's transactions, read from the archive."""
+        if self._archive is None:
+            raise ValueError(f"The sales archive of {self.date} is not available.")
+        return self._archive.read(self.archive_segment)
+
+    @property
+    def rollup(self):
+        """The `SalesRollup` of the day, sealed with the report."""
+        if not self._rollup.sketched:  # Closed before rollups sketched customers
+            self._rollup = SalesRollup.from_transactions(self.transactions)
+        return self._rollup
+
+    @property
+    def transaction_count(self):
+        """The number of transactions of the day, without reading the archive."""
+        return self._rolled_up
+
+    def transactions_of_type(self, ticket_type):
+        """Return the day's transactions of one ticket type, read from the archive."""
+        return [transaction for transaction in self.transactions if transaction.ticket_type == ticket_type]
+
+    def add_transaction(self, transaction):
+        """Closed days take no new sales."""
+        raise ValueError(f"The sales report of {self.date} is closed.")
+
+    def same_record(self, other):
+        """A closed report is never merged with another copy."""
+        return False
+
+    def after_load(self, filename):
+        """Attach the sales archive of the reports file this report was loaded from."""
+        self._archive = SalesArchive.for_reports_file(filename)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("_archive", None)
+        return state
+
+    def __setstate__(self, state):
+        rollup = state["_rollup"]
+        super().__setstate__(state)
+        self._rollup, self._rolled_up = rollup, state["_rolled_up"]  # The sealed totals, even from before sketches
+        self._archive = None
+
+
+class EndOfDayClose(threading.Thread):
+    """
+    The end-of-day close: a background thread that closes the sales reports of past days.
+
+    Closing a day moves its transactions into the `SalesArchive`, replaces its report with a
+    `ClosedSalesReport` and folds its rollup into the rollups of its month and year (kept in
+    `FILE_PATH_SALES_ROLLUPS`). Long-period queries read those instead of one report per day.
+
+    Each step can be repeated safely, so a close cut short by a crash is finished by the next
+    one. The close holds `lock` throughout; code that adds sales to the reports, refreshes or
+    saves them holds it too, so a sale is never appended to a report being sealed, nor its
+    changes written twice by two concurrent flushes. With the SQLite engine the transactions stay in the database, which already keeps
+    them on disk; only the period rollups are built.
+    """
+    def __init__(self, reports, period_rollups, reports_file=FILE_PATH_SALES_REPORTS,
+                 rollups_file=FILE_PATH_SALES_ROLLUPS, interval=SALES_CLOSE_CHECK_INTERVAL_SECONDS, lock=None):
+        """
+        Initialize the close job.
+
+        Args:
+            reports (ChangeTracker): The tracked sales reports, keyed by ISO date.
+            period_rollups (TrackedDict): The tracked `PeriodRollup`s, keyed by month or year.
+            reports_file (str): The data file of the reports.
+            rollups_file (str): The data file of the period rollups.
+            interval (float): Seconds between checks.
+            lock (RLock): Guards the reports against the purchases of this process.
+        """
+        super().__init__(name="EndOfDayClose", daemon=True)
+        self.reports = reports
+        self.period_rollups = period_rollups
+        self.reports_file = reports_file
+        self.rollups_file = rollups_file
+        self.interval = interval
+        self.archive = None if DataStorage.sqlite_table_for(reports_file) else SalesArchive.for_reports_file(reports_file)
+        self.stop_event = threading.Event()
+        self.lock = lock if lock is not None else threading.RLock()
+
+    @staticmethod
+    def close_days(reports, period_rollups, archive, before):
+        """
+        Close every day before a date that is not closed yet. The caller flushes both collections.
+
+        Args:
+            reports (dict): The sales reports, keyed by ISO date.
+            period_rollups (dict): The `PeriodRollup`s, keyed by month (YYYY-MM) or year (YYYY).
+            archive (SalesArchive): Where the transactions of closed days go, or None to keep them
+                in their reports and only fold their rollups.
+            before (str): The ISO date of the first day to leave open (usually today).
+
+        Returns:
+            list: The dates that were closed.
+        """
+        due = []
+        for report_date in list(reports):
+            if report_date >= before:
+                continue
+            folded = all(period in period_rollups and report_date in period_rollups[period]
+                         for period in PeriodRollup.periods_of(report_date))
+            if not folded or (archive is not None and not reports[report_date].closed):
+                due.append(report_date)
+        due.sort()
+
+        if archive is not None:
+            sealed = {}
+            for report_date in due:
+                report = reports[report_date]
+                if not report.closed:
+                    sealed[report_date] = ClosedSalesReport(report, archive, archive.append(report.transactions))
+            if sealed:
+                archive.sync()  # The transactions must be on disk before the reports stop holding them
+            for report_date, report in sealed.items():
+                reports[report_date] = report
+
+        for report_date in due:
+            rollup = reports[report_date].rollup
+            for period in PeriodRollup.periods_of(report_date):
+                period_rollup = period_rollups.get(period) or PeriodRollup(period)
+                if period_rollup.fold(report_date, rollup):
+                    period_rollups[period] = period_rollup
+        return due
+
+    def close_due(self, today=None):
+        """
+        Close the days before today and save the result.
+
+        Args:
+            today (str): The ISO date of the first day to leave open (defaults to today).
+
+        Returns:
+            list: The dates that were closed.
+        """
+        with self.lock:
+            DataStorage.refresh(self.reports, self.reports_file)  # Include sales made at other kiosks
+            DataStorage.refresh(self.period_rollups, self.rollups_file)
+            closed = EndOfDayClose.close_days(self.reports, self.period_rollups, self.archive,
+                                              today or Utils.get_today_date())
+            if closed:
+                DataStorage.flush_all({self.reports_file: self.reports, self.rollups_file: self.period_rollups})
+            return closed
+
+    def run(self):
+        """Close past days every `interval` seconds until stopped."""
+        while True:
+            try:
+                self.close_due()
+            except (ConcurrentUpdateError, OSError, ValueError) as e:
+                print(f"Error: end-of-day close failed: {e}")  # Tried again at the next check
+            if self.stop_event.wait(self.interval):
+                return
+
+    def stop(self):
+        """Stop the thread after its current check."""
+        self.stop_event.set()
@@ -0,0 +1,174 @@
+import csv
+import json
+
+from utils import Utils
+
+EXPORT_FORMATS = ("csv", "jsonl", "text")
+
+
+class SalesExporter:
+    """
+    Writes sales reports to a file or stdout one line at a time.
+
+    Every writer takes an iterable of reports and writes each transaction as soon as it is
+    read, so exporting a year of sales never builds the whole text in memory.
+    """
+    FIELDS = ("report_date", "transaction_id", "customer_name", "ticket_type", "quantity", "total_price",
+              "payment_method", "date_of_purchase", "purchased_at")
+
+    @staticmethod
+    def transaction_row(transaction, report_date):
+        """
+        Flatten a transaction into the exported fields.
+
+        Args:
+            transaction (Transaction): The transaction.
+            report_date (str): The date of the report the transaction belongs to.
+
+        Returns:
+            dict: Field name -> value, in `FIELDS` order.
+        """
+        purchased_at = transaction.purchased_at
+        return {
+            "report_date": report_date,
+            "transaction_id": Utils.format_id(transaction.transaction_id),
+            "customer_name": transaction.customer_name,
+            "ticket_type": transaction.ticket_type,
+            "quantity": transaction.quantity,
+            "total_price": round(transaction.total_price, 2),
+            "payment_method": transaction.payment_method,
+            "date_of_purchase": transaction.date_of_purchase,
+            "purchased_at": purchased_at.isoformat(timespec="seconds") if purchased_at is not None else None,
+        }
+
+    @staticmethod
+    def rows(reports):
+        """
+        Iterate over the exported rows of every transaction of some reports.
+
+        Args:
+            reports (iterable): The sales reports.
+
+        Returns:
+            iterator: One dictionary per transaction (see `transaction_row`).
+        """
+        for report in reports:
+            for transaction in report.transactions:
+                yield SalesExporter.transaction_row(transaction, report.date)
+
+    @staticmethod
+    def write_csv(reports, file):
+        """
+        Write the transactions of some reports as CSV with a header row.
+
+        Args:
+            reports (iterable): The sales reports.
+            file: A text file opened with newline='' (or sys.stdout).
+
+        Returns:
+            int: The number of transactions written.
+        """
+        writer = csv.DictWriter(file, fieldnames=SalesExporter.FIELDS)
+        writer.writeheader()
+        count = 0
+        for row in SalesExporter.rows(reports):
+            writer.writerow(row)
+            count += 1
+        return count
+
+    @staticmethod
+    def write_jsonl(reports, file):
+        """
+        Write the transactions of some reports as JSON Lines, one object per transaction.
+
+        Args:
+            reports (iterable): The sales reports.
+            file: A text file (or sys.stdout).
+
+        Returns:
+            int: The number of transactions written.
+        """
+        count = 0
+        for row in SalesExporter.rows(reports):
+            file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+        return count
+
+    @staticmethod
+    def write_text(reports, file):
+        """
+        Write some reports as they are displayed (see `SalesReport.iter_lines`).
+
+        Args:
+            reports (iterable): The sales reports.
+            file: A text file (or sys.stdout).
+
+        Returns:
+            int: The number of transactions written.
+        """
+        count = 0
+        for report in reports:
+            file.writelines(report.iter_lines())
+            count += report.transaction_count
+        return count
+
+    @staticmethod
+    def write(reports, file, export_format="csv"):
+        """
+        Write the transactions of some reports in one of `EXPORT_FORMATS`.
+
+        Args:
+            reports (iterable): The sales reports.
+            file: A text file (or sys.stdout).
+            export_format (str): One of `EXPORT_FORMATS`.
+
+        Returns:
+            int: The number of transactions written.
+
+        Raises:
+            ValueError: If the format is not supported.
+        """
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format '{export_format}'. Choose one of: {', '.join(EXPORT_FORMATS)}.")
+        return getattr(SalesExporter, f"write_{export_format}")(reports, file)
+
+    @staticmethod
+    def export(reports, path, export_format="csv"):
+        """
+        Write the transactions of some reports to a file (see `write`).
+
+        Args:
+            reports (iterable): The sales reports.
+            path (str): The file to write; it is replaced if it exists.
+            export_format (str): One of `EXPORT_FORMATS`.
+
+        Returns:
+            int: The number of transactions written.
+        """
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format '{export_format}'. Choose one of: {', '.join(EXPORT_FORMATS)}.")
+        with open(path, 'w', newline='' if export_format == "csv" else None, encoding='utf-8') as file:
+            return SalesExporter.write(reports, file, export_format)
+
+    @staticmethod
+    def page(lines, page_size, file, prompt=input):
+        """
+        Write lines a page at a time, asking before each next page.
+
+        Args:
+            lines (iterable): The lines, each ending with a newline.
+            page_size (int): The number of lines per page.
+            file: Where to write them (e.g. sys.stdout).
+            prompt (callable): Asks to continue; an answer of 'q' stops.
+
+        Returns:
+            bool: True if every line was written, False if the reader stopped.
+        """
+        written = 0
+        for line in lines:
+            if written and written % page_size == 0:
+                if prompt("-- Press Enter for more, q to stop -- ").strip().lower() == "q":
+                    return False
+            file.write(line)
+            written += 1
+        return True
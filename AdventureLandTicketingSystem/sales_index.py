@@ -0,0 +1,181 @@
+from bisect import bisect_left, bisect_right, insort
+from datetime import date
+
+from sales_rollup import PeriodRollup, SalesRollup, Totals
+
+
+def _day(value):
+    if value is None:
+        return None
+    if isinstance(value, date):
+        return value.isoformat()
+    try:
+        return date.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid date '{value}'. Please use YYYY-MM-DD.")
+
+
+class SalesReportIndex:
+    """
+    A sorted index of the dates of a sales report collection, for date-range queries.
+
+    The dates are kept in a sorted list, so a window of days is found with two binary
+    searches instead of comparing every key. Totals for a window are added up from the
+    rollup of each report in it; transactions of one ticket type are read through each
+    report's index by ticket type. Neither walks the transactions of the whole store.
+
+    Given the monthly and yearly rollups of closed days (see `EndOfDayClose`), totals use them
+    for the whole months and years of a window, so a query over a year reads one rollup
+    instead of one per day.
+
+    Reports are only ever added, one date at a time (by purchases, or by `DataStorage.refresh`
+    reading those of other kiosks), so each query first indexes the dates it has not seen
+    when the collection has grown. Call `rebuild` after removing reports.
+    """
+    def __init__(self, reports, period_rollups=None):
+        """
+        Initialize the index.
+
+        Args:
+            reports (dict): Sales reports keyed by ISO date (a dictionary, tracked dictionary or SQLite table).
+            period_rollups (dict): `PeriodRollup`s of closed days keyed by month or year, or None.
+        """
+        self.reports = reports
+        self.period_rollups = period_rollups
+        self.dates = []
+        self.rebuild()
+
+    def rebuild(self):
+        """Index every date of the collection again."""
+        self.dates = sorted(self.reports)
+
+    def _sync(self):
+        if len(self.reports) < len(self.dates):
+            self.rebuild()
+        elif len(self.reports) > len(self.dates):
+            indexed = set(self.dates)
+            for report_date in self.reports:
+                if report_date not in indexed:
+                    insort(self.dates, report_date)
+
+    def dates_between(self, start=None, end=None):
+        """
+        Return the dates with a sales report in a window.
+
+        Args:
+            start (str or date): The first day of the window (YYYY-MM-DD), or None for no lower bound.
+            end (str or date): The last day of the window, included, or None for no upper bound.
+
+        Returns:
+            list: The ISO dates, in order.
+
+        Raises:
+            ValueError: If a date is not valid.
+        """
+        start, end = _day(start), _day(end)
+        self._sync()
+        low = bisect_left(self.dates, start) if start is not None else 0
+        high = bisect_right(self.dates, end) if end is not None else len(self.dates)
+        return self.dates[low:high]
+
+    def reports_between(self, start=None, end=None):
+        """Return the sales reports of a window (see `dates_between`), in date order."""
+        return [self.reports[report_date] for report_date in self.dates_between(start, end)]
+
+    def transactions(self, start=None, end=None, ticket_type=None):
+        """
+        Iterate over the transactions of a window.
+
+        Args:
+            start (str or date): The first day of the window, or None.
+            end (str or date): The last day of the window, included, or None.
+            ticket_type (str): Only return transactions of this ticket type.
+
+        Returns:
+            iterator: The transactions, in date order.
+        """
+        for report in self.reports_between(start, end):
+            if ticket_type is None:
+                yield from report.transactions
+            else:
+                yield from report.transactions_of_type(ticket_type)
+
+    def rollups_between(self, start=None, end=None):
+        """
+        Return rollups that together cover a window exactly, reading period rollups where they can.
+
+        A month or year is read from its `PeriodRollup` when every day of it with sales is
+        closed and inside the window; the other days are read from their reports.
+
+        Returns:
+            list: The rollups.
+        """
+        dates = self.dates_between(start, end)
+        rollups = []
+        position = 0
+        while position < len(dates):
+            report_date = dates[position]
+            days = 1
+            rollup = None
+            for period in reversed(PeriodRollup.periods_of(report_date)):  # The year first
+                period_rollup = self.period_rollups.get(period) if self.period_rollups is not None else None
+                if period_rollup is None or period_rollup.days[0] != report_date:
+                    continue
+                # Every day of the period with sales is closed and in the window
+                days = bisect_right(self.dates, period + "~") - bisect_left(self.dates, period)
+                if len(period_rollup.days) == days and dates[position + days - 1:position + days] == period_rollup.days[-1:]:
+                    rollup = period_rollup.rollup
+                    break
+                days = 1
+            rollups.append(rollup if rollup is not None else self.reports[report_date].rollup)
+            position += days
+        return rollups
+
+    def rollup(self, start=None, end=None):
+        """
+        Return the combined rollup of a window, to break its totals down by ticket type, payment method or hour.
+
+        Returns:
+            SalesRollup: A new rollup.
+        """
+        return SalesRollup.combine(self.rollups_between(start, end))
+
+    def daily_totals(self, start=None, end=None):
+        """
+        Return the totals of each day of a window with sales, read from rollups alone.
+
+        Days of closed months and years come from the day breakdown of their period rollups,
+        the other days from their reports' rollups; no transaction is read.
+
+        Args:
+            start (str or date): The first day of the window, or None.
+            end (str or date): The last day of the window, included, or None.
+
+        Returns:
+            list: (ISO date, Totals) tuples, in date order.
+        """
+        days = {}
+        for rollup in self.rollups_between(start, end):
+            days.update(rollup.breakdown("day"))
+        return sorted(days.items())
+
+    def totals(self, start=None, end=None, ticket_type=None):
+        """
+        Return the sales totals of a window, read from the reports' rollups.
+
+        Args:
+            start (str or date): The first day of the window, or None.
+            end (str or date): The last day of the window, included, or None.
+            ticket_type (str): Only count sales of this ticket type.
+
+        Returns:
+            Totals: Revenue in DHS, tickets sold and number of transactions.
+        """
+        dimension = "ticket_type" if ticket_type is not None else None
+        revenue, quantity, count = 0.0, 0, 0
+        for rollup in self.rollups_between(start, end):
+            totals = rollup.totals(dimension, ticket_type)
+            revenue += totals.revenue
+            quantity += totals.quantity
+            count += totals.count
+        return Totals(round(revenue, 2), quantity, count)
@@ -1,7 +1,17 @@
 from datetime import datetime
 
+from change_tracking import TrackedRecord
+from id_generator import SnowflakeIdGenerator
+from record_format import TransactionRecordFormat
+from sales_rollup import SalesRollup
+from utils import Utils
+
 class Transaction:
-    def __init__(self, transaction_id, customer_name, ticket_type, quantity, total_price, date_of_purchase):
+    __slots__ = ("transaction_id", "customer_name", "ticket_type", "quantity", "total_price", "date_of_purchase",
+                 "payment_method")
+
+    def __init__(self, transaction_id, customer_name, ticket_type, quantity, total_price, date_of_purchase,
+                 payment_method=None):
         """
         Initialize a Transaction object.
         """
@@ -11,19 +21,78 @@ class Transaction:
         self.quantity = quantity
         self.total_price = total_price
         self.date_of_purchase = date_of_purchase
+        self.payment_method = payment_method
+
+    @property
+    def purchased_at(self):
+        """
+        The local time of the purchase, read from the transaction ID.
+        None for transactions recorded with a UUID ID, which carries no time.
+        """
+        if not isinstance(self.transaction_id, int):
+            return None
+        return SnowflakeIdGenerator.timestamp_of(self.transaction_id).astimezone()
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Rebuild a transaction from its binary record (see `TransactionRecordFormat`).
+        """
+        fields, _ = TransactionRecordFormat.decode(record)
+        return cls._from_fields(fields)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Rebuild transactions from consecutive binary records.
+        """
+        return [cls._from_fields(fields) for fields in TransactionRecordFormat.decode_many(records)]
+
+    @classmethod
+    def _from_fields(cls, fields):
+        transaction = cls.__new__(cls)
+        for name, value in fields.items():
+            setattr(transaction, name, value)
+        return transaction
+
+    def __reduce_ex__(self, protocol):
+        # Pickle as a compact binary record when every field fits the format
+        try:
+            return (Transaction.from_record, (TransactionRecordFormat.encode(self),))
+        except ValueError:
+            return super().__reduce_ex__(protocol)
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Transaction.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        # Transactions pickled before __slots__ carry a plain attribute dictionary
+        state = {"payment_method": None, **state}
+        for name in Transaction.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+
+    def iter_lines(self):
+        """
+        Yield the lines of the transaction's string representation, each ending with a newline.
+        """
+        yield f"Transaction ID: {Utils.format_id(self.transaction_id)}\n"
+        yield f"Customer Name: {self.customer_name}\n"
+        yield f"Ticket Type: {self.ticket_type}\n"
+        yield f"Quantity: {self.quantity}\n"
+        yield f"Total Price: {self.total_price:.2f} DHS\n"
+        yield f"Date of Purchase: {self.date_of_purchase}\n"
 
     def __str__(self):
         """
         String representation of the transaction.
         """
-        return (f"Transaction ID: {self.transaction_id}\n"
-                f"Customer Name: {self.customer_name}\n"
-                f"Ticket Type: {self.ticket_type}\n"
-                f"Quantity: {self.quantity}\n"
-                f"Total Price: {self.total_price:.2f} DHS\n"
-                f"Date of Purchase: {self.date_of_purchase}\n")
+        return "".join(self.iter_lines())
+
+class SalesReport(TrackedRecord):
+    tracked_list = "transactions"
+    closed = False  # True for the sealed reports of closed days (see `ClosedSalesReport`)
 
-class SalesReport: 
     def __init__(self, report_id, date):
         """
         Initialize a sales report.
@@ -31,23 +100,116 @@ class SalesReport:
         self.report_id = report_id
         self.date = date
         self.transactions = []
+        self._rollup = SalesRollup()
+        self._rolled_up = 0  # Number of leading transactions included in _rollup
+        self._type_rows = {}  # Ticket type -> positions of its transactions; not saved
+        self._type_rows_size = 0  # Number of leading transactions included in _type_rows
+        self._init_tracking()
+
+    @property
+    def rollup(self):
+        """The `SalesRollup` of the report's transactions, saved with the report."""
+        self._roll_up()
+        return self._rollup
+
+    @property
+    def transaction_count(self):
+        """The number of transactions in the report."""
+        return len(self.transactions)
+
+    def _roll_up(self):
+        if self._rolled_up > len(self.transactions):
+            self.rebuild_rollup()
+        # Transactions read back from the log are appended to the list directly, so add them from there
+        for transaction in self.transactions[self._rolled_up:]:
+            self._rollup.add(transaction)
+        self._rolled_up = len(self.transactions)
+
+    def transactions_of_type(self, ticket_type):
+        """
+        Return the transactions of one ticket type, in order, without scanning the others.
+
+        The positions of each type's transactions are indexed in memory as transactions are appended.
+
+        Args:
+            ticket_type (str): The ticket type.
+
+        Returns:
+            list: The transactions.
+        """
+        if self._type_rows_size > len(self.transactions):
+            self._type_rows, self._type_rows_size = {}, 0
+        for row in range(self._type_rows_size, len(self.transactions)):
+            self._type_rows.setdefault(self.transactions[row].ticket_type, []).append(row)
+        self._type_rows_size = len(self.transactions)
+        return [self.transactions[row] for row in self._type_rows.get(ticket_type, ())]
+
+    def rebuild_rollup(self):
+        """Recompute the rollup from the raw transactions."""
+        self._rollup = SalesRollup.from_transactions(self.transactions)
+        self._rolled_up = len(self.transactions)
 
     def add_transaction(self, transaction):
         """
-        Add a transaction to the sales report.
+        Add a transaction to the sales report and its rollup.
         """
         self.transactions.append(transaction)
+        self._roll_up()
+        self.record_appended([transaction])
+
+    def same_record(self, other):
+        """
+        Reports for the same date are merged when two processes create them concurrently.
+        A report that was closed in the meantime cannot take the unsaved transactions.
+        """
+        return isinstance(other, SalesReport) and other.date == self.date and not other.closed
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("_type_rows", None)
+        state.pop("_type_rows_size", None)
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        rollup = state.pop("_rollup", None)
+        super().__setstate__(state)
+        # Reports saved before rollups, or before rollups sketched customers, are rolled up from
+        # their transactions on first use
+        current = rollup is not None and rollup.sketched
+        self._rollup = rollup.copy() if current else SalesRollup()
+        self._rolled_up = state.get("_rolled_up", 0) if current else 0
+        self._type_rows = {}
+        self._type_rows_size = 0
+
+    def summary(self):
+        """
+        Summarize the report from its rollup, without reading the transactions.
+
+        Returns:
+            str: Totals for the day and by ticket type, payment method and hour.
+        """
+        lines = [f"Sales Summary - Date: {self.date}"] + self.rollup.summary_lines()
+        return "\n".join(lines) + "\n"
+
+    def iter_lines(self):
+        """
+        Yield the lines of the report's string representation one at a time, each ending with a
+        newline, so a large report can be written or paged without building the whole text.
+        """
+        transactions = self.transactions
+        yield f"Sales Report - Date: {self.date}\n"
+        yield f"Total Transactions: {len(transactions)}\n"
+        yield "Transactions Details:\n"
+        for transaction in transactions:
+            yield from transaction.iter_lines()
+            yield "\n"
 
     def __str__(self):
         """
         String representation of the sales report.
         """
-        report_str = f"Sales Report - Date: {self.date}\n"
-        report_str += f"Total Transactions: {len(self.transactions)}\n"
-        report_str += "Transactions Details:\n"
-        for transaction in self.transactions:
-            report_str += str(transaction) + "\n"
-        return report_str
+        return "".join(self.iter_lines())
 
     @staticmethod
     def generate_report_id(date):
@@ -0,0 +1,347 @@
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+from record_format import FILS_PER_DHS
+from sketches import HyperLogLog, CountMinSketch, SpaceSaving
+
+# Revenue in DHS, tickets sold and number of transactions
+Totals = namedtuple("Totals", ["revenue", "quantity", "count"])
+
+
+class SalesRollup:
+    """
+    Running sales totals, overall and broken down by day, ticket type, payment method and hour.
+
+    Each transaction is added once, when it is recorded, so reading any total is a dictionary
+    lookup however many transactions there were. Revenue is kept in whole fils so totals don't
+    drift with floating-point rounding. A rollup can always be rebuilt from the raw
+    transactions with `from_transactions`.
+
+    Customers are counted in fixed-size sketches (see `sketches`) rather than exactly: the
+    number of distinct customers and the top buyers are estimates, but they merge across days
+    and kiosks like the totals, in the same few kilobytes whatever the number of customers.
+    The Count-Min sketch of tickets per customer is only started once `buyers` holds
+    `SKETCH_TOP_K` customers: until then their counts are exact, and a daily report (saved
+    and logged whole on its first sale) does not carry a sketch sized for a month or a year.
+    """
+    __slots__ = ("counters", "customers", "buyer_tickets", "buyers")
+    DIMENSIONS = ("day", "ticket_type", "payment_method", "hour")
+
+    def __init__(self):
+        """Initialize an empty rollup."""
+        self.counters = {}  # (dimension, key) -> [revenue in fils, quantity, count]; (None, None) is overall
+        self.customers = HyperLogLog()  # Distinct customer names
+        self.buyer_tickets = None  # Count-Min sketch of tickets per customer name, once `buyers` is full
+        self.buyers = SpaceSaving()  # The customers who bought the most tickets
+
+    @staticmethod
+    def from_transactions(transactions):
+        """
+        Build a rollup from raw transactions.
+
+        Args:
+            transactions (iterable): The transactions.
+
+        Returns:
+            SalesRollup: The rollup.
+        """
+        rollup = SalesRollup()
+        for transaction in transactions:
+            rollup.add(transaction)
+        return rollup
+
+    @staticmethod
+    def combine(rollups):
+        """
+        Add up several rollups, e.g. those of the daily reports of a month.
+
+        Args:
+            rollups (iterable): The rollups.
+
+        Returns:
+            SalesRollup: A new rollup with their totals.
+        """
+        combined = SalesRollup()
+        for rollup in rollups:
+            combined.merge(rollup)
+        return combined
+
+    @staticmethod
+    def _keys(transaction):
+        purchased_at = transaction.purchased_at
+        return (
+            (None, None),
+            ("day", transaction.date_of_purchase),
+            ("ticket_type", transaction.ticket_type),
+            ("payment_method", transaction.payment_method),
+            ("hour", purchased_at.hour if purchased_at is not None else None),
+        )
+
+    def add(self, transaction):
+        """
+        Count a transaction in every total it belongs to.
+
+        Args:
+            transaction (Transaction): The transaction.
+
+        Returns:
+            None
+        """
+        revenue = round(transaction.total_price * FILS_PER_DHS)
+        for key in SalesRollup._keys(transaction):
+            counter = self.counters.get(key)
+            if counter is None:
+                self.counters[key] = [revenue, transaction.quantity, 1]
+            else:
+                counter[0] += revenue
+                counter[1] += transaction.quantity
+                counter[2] += 1
+        if self.sketched:
+            self.customers.add(transaction.customer_name)
+            if self.buyer_tickets is None and len(self.buyers.counters) >= self.buyers.capacity:
+                self._start_buyer_tickets()
+            if self.buyer_tickets is not None:
+                self.buyer_tickets.add(transaction.customer_name, transaction.quantity)
+            self.buyers.add(transaction.customer_name, transaction.quantity)
+
+    def merge(self, other):
+        """Add the totals of another rollup to this one."""
+        for key, (revenue, quantity, count) in other.counters.items():
+            counter = self.counters.setdefault(key, [0, 0, 0])
+            counter[0] += revenue
+            counter[1] += quantity
+            counter[2] += count
+        if not other.sketched:
+            self._drop_sketches()  # Customers of the other rollup are unknown, so estimates would be low
+        elif self.sketched:
+            self.customers.merge(other.customers)
+            if (self.buyer_tickets is not None or other.buyer_tickets is not None
+                    or len(self.buyers.counters) + len(other.buyers.counters) >= self.buyers.capacity):
+                if self.buyer_tickets is None:
+                    self._start_buyer_tickets()
+                if other.buyer_tickets is not None:
+                    self.buyer_tickets.merge(other.buyer_tickets)
+                else:
+                    for name, (count, _) in other.buyers.counters.items():
+                        self.buyer_tickets.add(name, count)
+            self.buyers.merge(other.buyers)
+
+    def copy(self):
+        """Return an independent copy of the rollup."""
+        rollup = SalesRollup()
+        rollup.counters = {key: list(counter) for key, counter in self.counters.items()}
+        if self.sketched:
+            rollup.customers = self.customers.copy()
+            rollup.buyer_tickets = self.buyer_tickets.copy() if self.buyer_tickets is not None else None
+            rollup.buyers = self.buyers.copy()
+        else:
+            rollup._drop_sketches()
+        return rollup
+
+    @property
+    def sketched(self):
+        """False for rollups saved before customers were sketched; rebuild them with `from_transactions`."""
+        return self.customers is not None
+
+    def _start_buyer_tickets(self):
+        # `buyers` was never pruned, so its counts are exact
+        self.buyer_tickets = CountMinSketch()
+        for name, (count, _) in self.buyers.counters.items():
+            self.buyer_tickets.add(name, count)
+
+    def _drop_sketches(self):
+        self.customers = self.buyer_tickets = self.buyers = None
+
+    def totals(self, dimension=None, key=None):
+        """
+        Return the totals of one group, or the overall totals.
+
+        Args:
+            dimension (str): One of `DIMENSIONS`, or None for the overall totals.
+            key: The group within the dimension, e.g. a ticket type, a YYYY-MM-DD day or an hour
+                (0-23). Transactions recorded without a payment method or time are grouped under None.
+
+        Returns:
+            Totals: Revenue in DHS, tickets sold and number of transactions (zeros if there were none).
+        """
+        if dimension is not None and dimension not in SalesRollup.DIMENSIONS:
+            raise ValueError(f"Unknown rollup dimension '{dimension}'.")
+        revenue, quantity, count = self.counters.get((dimension, key), (0, 0, 0))
+        return Totals(revenue / FILS_PER_DHS, quantity, count)
+
+    def breakdown(self, dimension):
+        """
+        Return the totals of every group of a dimension.
+
+        Args:
+            dimension (str): One of `DIMENSIONS`.
+
+        Returns:
+            dict: Group -> Totals.
+        """
+        if dimension not in SalesRollup.DIMENSIONS:
+            raise ValueError(f"Unknown rollup dimension '{dimension}'.")
+        return {key: Totals(revenue / FILS_PER_DHS, quantity, count)
+                for (name, key), (revenue, quantity, count) in self.counters.items() if name == dimension}
+
+    def distinct_customers(self):
+        """
+        Return the approximate number of distinct customers (about 2% standard error).
+
+        Returns:
+            int: The estimate, or None if the rollup has no customer sketches.
+        """
+        return self.customers.estimate() if self.sketched else None
+
+    def top_buyers(self, n=10):
+        """
+        Return the customers who bought the most tickets, heaviest first.
+
+        Every customer who bought more than 1/`SKETCH_TOP_K` of the tickets is listed. Counts
+        are estimates that may be slightly high, never low.
+
+        Args:
+            n (int): The number of customers.
+
+        Returns:
+            list: (customer name, estimated tickets) tuples, or an empty list if the rollup has
+                no customer sketches.
+        """
+        if not self.sketched:
+            return []
+        buyers = [(name, count) for name, count, _ in self.buyers.top(len(self.buyers.counters))]
+        if self.buyer_tickets is not None:
+            # Both sketches only overestimate, so the smaller of their counts is the closer one
+            buyers = [(name, min(count, self.buyer_tickets.estimate(name))) for name, count in buyers]
+        return sorted(buyers, key=lambda buyer: (-buyer[1], str(buyer[0])))[:n]
+
+    def customer_tickets(self, customer_name):
+        """
+        Return the approximate number of tickets a customer bought, never below the true number.
+
+        Returns:
+            int: The estimate, or None if the rollup has no customer sketches.
+        """
+        if not self.sketched:
+            return None
+        if self.buyer_tickets is None:
+            counter = self.buyers.counters.get(customer_name)
+            return counter[0] if counter is not None else 0
+        return self.buyer_tickets.estimate(customer_name)
+
+    def top_ticket_types(self, n=10):
+        """
+        Return the ticket types that sold the most tickets, with their totals. These are exact.
+
+        Args:
+            n (int): The number of ticket types.
+
+        Returns:
+            list: (ticket type, Totals) tuples, best-selling first.
+        """
+        groups = self.breakdown("ticket_type")
+        return sorted(groups.items(), key=lambda group: (-group[1].quantity, str(group[0])))[:n]
+
+    def summary_lines(self, dimensions=("ticket_type", "payment_method", "hour")):
+        """
+        Format the overall totals and their breakdown by some dimensions for display.
+
+        Args:
+            dimensions (tuple): The dimensions to break the totals down by.
+
+        Returns:
+            list: The lines of text.
+        """
+        total = self.totals()
+        lines = [f"Revenue: {total.revenue:.2f} DHS, Tickets: {total.quantity}, Transactions: {total.count}"]
+        for dimension in dimensions:
+            lines.append(f"By {dimension.replace('_', ' ').title()}:")
+            groups = self.breakdown(dimension)
+            for key in sorted(groups, key=lambda key: (key is None, key)):
+                totals = groups[key]
+                label = "Unknown" if key is None else (f"{key:02d}:00" if dimension == "hour" else key)
+                lines.append(f"  {label}: {totals.revenue:.2f} DHS, {totals.quantity} tickets, "
+                             f"{totals.count} transactions")
+        return lines
+
+    def customer_lines(self, n=10):
+        """
+        Format the approximate number of distinct customers and the top buyers for display.
+
+        Args:
+            n (int): The number of top buyers.
+
+        Returns:
+            list: The lines of text.
+        """
+        if not self.sketched:
+            return ["Customers: not available for sales recorded before customer sketches."]
+        lines = [f"Distinct Customers: about {self.distinct_customers()}", f"Top {n} Buyers (approximate):"]
+        for name, tickets in self.top_buyers(n):
+            lines.append(f"  {name}: {tickets} tickets")
+        return lines
+
+    def __getstate__(self):
+        return {"counters": self.counters, "customers": self.customers, "buyer_tickets": self.buyer_tickets,
+                "buyers": self.buyers}
+
+    def __setstate__(self, state):
+        self.counters = state["counters"]
+        self.customers = state.get("customers")
+        self.buyer_tickets = state.get("buyer_tickets")
+        self.buyers = state.get("buyers")
+
+
+class PeriodRollup:
+    """
+    The combined rollup of the closed days of a month (YYYY-MM) or a year (YYYY).
+
+    Closed days are folded in once each; the days already folded are listed, so closing a
+    day again (e.g. after a crash between saving the closed report and its period rollups)
+    does not count it twice.
+    """
+    __slots__ = ("period", "rollup", "days")
+
+    def __init__(self, period):
+        """
+        Initialize an empty period rollup.
+
+        Args:
+            period (str): The month (YYYY-MM) or year (YYYY).
+        """
+        self.period = period
+        self.rollup = SalesRollup()
+        self.days = []  # ISO dates folded in, sorted
+
+    @staticmethod
+    def periods_of(report_date):
+        """Return the month and year a YYYY-MM-DD date belongs to."""
+        return report_date[:7], report_date[:4]
+
+    def fold(self, report_date, rollup):
+        """
+        Add the rollup of a closed day, unless it was already added.
+
+        Args:
+            report_date (str): The ISO date of the day.
+            rollup (SalesRollup): The day's rollup.
+
+        Returns:
+            bool: True if the day was added.
+        """
+        if report_date in self:
+            return False
+        insort(self.days, report_date)
+        self.rollup.merge(rollup)
+        return True
+
+    def __contains__(self, report_date):
+        position = bisect_left(self.days, report_date)
+        return position < len(self.days) and self.days[position] == report_date
+
+    def __getstate__(self):
+        return {"period": self.period, "rollup": self.rollup, "days": self.days}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
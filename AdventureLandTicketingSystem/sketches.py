@@ -0,0 +1,222 @@
+import hashlib
+import math
+from array import array
+from functools import lru_cache
+
+from constants import SKETCH_HLL_PRECISION, SKETCH_COUNT_MIN_WIDTH, SKETCH_COUNT_MIN_DEPTH, SKETCH_TOP_K
+
+
+@lru_cache(maxsize=1 << 14)  # The same customers come back through the day
+def _hash64(key):
+    # A hash that is the same in every process, unlike hash(), so sketches can be saved and merged
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct keys seen (e.g. customers), in a fixed 2^precision bytes.
+
+    The standard error is about 1.04 / sqrt(2^precision): 2.3% with the default precision.
+    Two sketches of the same precision merge into the sketch of the union of their keys.
+    """
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision=SKETCH_HLL_PRECISION):
+        """
+        Initialize an empty sketch.
+
+        Args:
+            precision (int): The number of hash bits that pick a register (4 to 16).
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16.")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, key):
+        """Count a key."""
+        value = _hash64(key)
+        rest_bits = 64 - self.precision
+        register = value >> rest_bits
+        rest = value & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1  # Position of the first set bit
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def merge(self, other):
+        """Add the keys counted by another sketch of the same precision."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precisions.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def copy(self):
+        """Return an independent copy of the sketch."""
+        sketch = HyperLogLog(self.precision)
+        sketch.registers = bytearray(self.registers)
+        return sketch
+
+    def estimate(self):
+        """
+        Return the estimated number of distinct keys.
+
+        Returns:
+            int: The estimate.
+        """
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(size / zeros)  # Linear counting is more accurate for few keys
+        return round(estimate)
+
+    def __getstate__(self):
+        return {"precision": self.precision, "registers": bytes(self.registers)}
+
+    def __setstate__(self, state):
+        self.precision = state["precision"]
+        self.registers = bytearray(state["registers"])
+
+
+class CountMinSketch:
+    """
+    Estimates how much was counted for any key (e.g. tickets bought by one customer), in fixed memory.
+
+    An estimate is never below the true count, and exceeds it by at most 2/width of the total
+    count with probability 1 - 2^-depth. Sketches of the same size merge by adding their cells.
+    """
+    __slots__ = ("width", "depth", "cells")
+
+    def __init__(self, width=SKETCH_COUNT_MIN_WIDTH, depth=SKETCH_COUNT_MIN_DEPTH):
+        """
+        Initialize an empty sketch.
+
+        Args:
+            width (int): Cells per row.
+            depth (int): Rows, each indexed by a different hash.
+        """
+        self.width = width
+        self.depth = depth
+        self.cells = array('I', bytes(4 * width * depth))
+
+    def _cells_of(self, key):
+        value = _hash64(key)
+        first, step = value & 0xFFFFFFFF, (value >> 32) | 1
+        return [row * self.width + (first + row * step) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Add `count` to a key."""
+        for cell in self._cells_of(key):
+            self.cells[cell] += count
+
+    def estimate(self, key):
+        """Return the estimated count of a key."""
+        return min(self.cells[cell] for cell in self._cells_of(key))
+
+    def merge(self, other):
+        """Add the counts of another sketch of the same size."""
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Cannot merge Count-Min sketches of different sizes.")
+        self.cells = array('I', map(sum, zip(self.cells, other.cells)))
+
+    def copy(self):
+        """Return an independent copy of the sketch."""
+        sketch = CountMinSketch.__new__(CountMinSketch)
+        sketch.width, sketch.depth, sketch.cells = self.width, self.depth, array('I', self.cells)
+        return sketch
+
+    def __getstate__(self):
+        return {"width": self.width, "depth": self.depth, "cells": self.cells.tobytes()}
+
+    def __setstate__(self, state):
+        self.width = state["width"]
+        self.depth = state["depth"]
+        self.cells = array('I')
+        self.cells.frombytes(state["cells"])
+
+
+class SpaceSaving:
+    """
+    Keeps the heaviest keys seen (e.g. the top buyers) with a bounded number of counters.
+
+    Up to 2 x `capacity` keys are counted; past that, all but the `capacity` heaviest are
+    dropped at once, and the highest count dropped becomes the floor. A key seen again after
+    being dropped (or never seen before) starts from the floor, since it may have been counted
+    up to that much already. Counts are therefore never low, and at most `error` high; a key
+    whose true count is above the floor is always tracked.
+    """
+    __slots__ = ("capacity", "counters", "floor")
+
+    def __init__(self, capacity=SKETCH_TOP_K):
+        """
+        Initialize an empty summary.
+
+        Args:
+            capacity (int): The number of keys kept after each pruning.
+        """
+        self.capacity = capacity
+        self.counters = {}  # key -> [count, possible overcount]
+        self.floor = 0  # Highest count dropped so far
+
+    def add(self, key, count=1):
+        """Add `count` to a key."""
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+            return
+        self.counters[key] = [self.floor + count, self.floor]
+        if len(self.counters) > 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        ranked = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)
+        self.floor = max(self.floor, ranked[self.capacity][1][0])
+        self.counters = dict(ranked[:self.capacity])
+
+    def merge(self, other):
+        """Add the counts of another summary of the same capacity."""
+        if other.capacity != self.capacity:
+            raise ValueError("Cannot merge Space-Saving summaries of different capacities.")
+        # A key missing from one summary may have been counted there up to that summary's floor
+        for key, counter in self.counters.items():
+            if key not in other.counters:
+                counter[0] += other.floor
+                counter[1] += other.floor
+        for key, (count, error) in other.counters.items():
+            counter = self.counters.get(key)
+            if counter is None:
+                self.counters[key] = [count + self.floor, error + self.floor]
+            else:
+                counter[0] += count
+                counter[1] += error
+        self.floor += other.floor
+        if len(self.counters) > 2 * self.capacity:
+            self._prune()
+
+    def copy(self):
+        """Return an independent copy of the summary."""
+        summary = SpaceSaving(self.capacity)
+        summary.counters = {key: list(counter) for key, counter in self.counters.items()}
+        summary.floor = self.floor
+        return summary
+
+    def top(self, n=10):
+        """
+        Return the heaviest keys.
+
+        Args:
+            n (int): The number of keys.
+
+        Returns:
+            list: (key, estimated count, possible overcount) tuples, heaviest first.
+        """
+        heaviest = sorted(self.counters.items(), key=lambda item: (-item[1][0], str(item[0])))[:n]
+        return [(key, count, error) for key, (count, error) in heaviest]
+
+    def __getstate__(self):
+        return {"capacity": self.capacity, "counters": self.counters, "floor": self.floor}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self.counters = state["counters"]
+        self.floor = state["floor"]
@@ -0,0 +1,458 @@
+import os
+import sqlite3
+import threading
+import weakref
+from collections.abc import MutableMapping
+from datetime import date
+
+from user import User
+from ticket import Ticket
+from ticket_block import TicketBlock
+from sales_report import SalesReport, Transaction
+from write_ahead_log import WriteAheadLog
+from change_tracking import ChangeTracker
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    name TEXT NOT NULL,
+    password TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users (email);
+
+CREATE TABLE IF NOT EXISTS tickets (
+    ticket_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users (user_id),
+    ticket_type TEXT NOT NULL,
+    price REAL NOT NULL,
+    base_price REAL NOT NULL,
+    validity TEXT,
+    visit_date TEXT,
+    discount REAL NOT NULL DEFAULT 0,
+    default_discount REAL NOT NULL DEFAULT 0,
+    validity_start_date TEXT,
+    validity_end_date TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tickets_user_id ON tickets (user_id);
+CREATE INDEX IF NOT EXISTS idx_tickets_visit_date ON tickets (visit_date);
+
+CREATE TABLE IF NOT EXISTS ticket_catalog (
+    ticket_type TEXT PRIMARY KEY,
+    price REAL NOT NULL,
+    validity TEXT NOT NULL,
+    discount REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS sales_reports (
+    report_date TEXT PRIMARY KEY,
+    report_id TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    transaction_id TEXT PRIMARY KEY,
+    report_date TEXT NOT NULL REFERENCES sales_reports (report_date),
+    customer_name TEXT,
+    ticket_type TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    total_price REAL NOT NULL,
+    date_of_purchase TEXT NOT NULL,
+    payment_method TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_report_date ON transactions (report_date);
+CREATE INDEX IF NOT EXISTS idx_transactions_date_of_purchase ON transactions (date_of_purchase);
+"""
+
+
+def _date_to_text(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def _text_to_date(value):
+    return date.fromisoformat(value) if value else None
+
+
+def _text_to_id(value):
+    # ID columns are TEXT from the UUID era: integer IDs are stored as their decimal text
+    return int(value) if isinstance(value, str) and value.isdigit() else value
+
+
+class SQLiteStorage:
+    """
+    An SQLite storage engine for users, tickets, the ticket catalog and sales reports.
+
+    Users and sales reports are exposed through dictionary-like tables that read rows and build
+    `User`, `Ticket`, `SalesReport` and `Transaction` objects only when a record is requested,
+    so the park's full history never has to be held in memory.
+    """
+    USERS = "users"
+    CATALOG = "ticket_catalog"
+    SALES_REPORTS = "sales_reports"
+
+    def __init__(self, db_path):
+        """
+        Open (and create if needed) the database.
+
+        Args:
+            db_path (str): The path of the SQLite database file.
+        """
+        folder = os.path.dirname(db_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(transactions)")]
+        if "payment_method" not in columns:
+            # Databases created before transactions recorded their payment method
+            self.connection.execute("ALTER TABLE transactions ADD COLUMN payment_method TEXT")
+        self.connection.commit()
+
+    def close(self):
+        """Close the database connection."""
+        self.connection.close()
+
+    def execute(self, sql, parameters=()):
+        """Run a read query and return all rows."""
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    # Tables
+
+    def table(self, name):
+        """
+        Return the dictionary-like view for a table.
+
+        Args:
+            name (str): One of `SQLiteStorage.USERS`, `CATALOG` or `SALES_REPORTS`.
+
+        Returns:
+            The table view. The catalog is small and returned as a plain dictionary.
+        """
+        if name == SQLiteStorage.USERS:
+            return UserTable(self)
+        if name == SQLiteStorage.SALES_REPORTS:
+            return SalesReportTable(self)
+        if name == SQLiteStorage.CATALOG:
+            return self.load_catalog()
+        raise ValueError(f"Unknown table '{name}'.")
+
+    def apply_changes(self, name, changes):
+        """
+        Apply write-ahead log style changes to a table in one database transaction.
+
+        Args:
+            name (str): The table the changes belong to.
+            changes (list): Changes built with `WriteAheadLog.set_record`, `extend_record` or `delete_record`.
+
+        Returns:
+            None
+        """
+        with self.lock, self.connection:
+            for change in changes:
+                op, key = change[0], change[1]
+                if op == WriteAheadLog.SET:
+                    self._put(name, key, change[2])
+                elif op == WriteAheadLog.EXTEND:
+                    self._extend(name, key, change[2], change[3])
+                elif op == WriteAheadLog.DELETE:
+                    self._delete(name, key)
+                else:
+                    raise ValueError(f"Unknown log operation '{op}'.")
+
+    def replace_all(self, name, data):
+        """
+        Replace the whole content of a table with a dictionary.
+
+        Args:
+            name (str): The table to replace.
+            data (dict): The records keyed the same way as the pickle files.
+
+        Returns:
+            None
+        """
+        with self.lock, self.connection:
+            for key in list(self._keys(name)):
+                self._delete(name, key)
+            for key, value in data.items():
+                self._put(name, key, value)
+
+    def import_data(self, users, tickets, sales_reports):
+        """
+        Load the contents of the pickle files into the database in one go.
+
+        Args:
+            users (dict): Users keyed by email.
+            tickets (dict): The ticket catalog keyed by ticket type.
+            sales_reports (dict): Sales reports keyed by ISO date.
+
+        Returns:
+            None
+        """
+        self.replace_all(SQLiteStorage.USERS, users)
+        self.replace_all(SQLiteStorage.CATALOG, tickets)
+        self.replace_all(SQLiteStorage.SALES_REPORTS, sales_reports)
+        print(f"Migrated {len(users)} users, {len(tickets)} ticket types and "
+              f"{len(sales_reports)} sales reports to {self.db_path}.")
+
+    def _keys(self, name):
+        if name == SQLiteStorage.USERS:
+            return [row[0] for row in self.connection.execute("SELECT email FROM users")]
+        if name == SQLiteStorage.CATALOG:
+            return [row[0] for row in self.connection.execute("SELECT ticket_type FROM ticket_catalog")]
+        if name == SQLiteStorage.SALES_REPORTS:
+            return [row[0] for row in self.connection.execute("SELECT report_date FROM sales_reports")]
+        raise ValueError(f"Unknown table '{name}'.")
+
+    def _put(self, name, key, value):
+        if name == SQLiteStorage.USERS:
+            self._delete(name, key)
+            self.connection.execute(
+                "INSERT INTO users (user_id, email, name, password) VALUES (?, ?, ?, ?)",
+                (value.user_id, key, value.name, value.password)
+            )
+            self._insert_tickets(value.user_id, value.purchase_history)
+        elif name == SQLiteStorage.CATALOG:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO ticket_catalog (ticket_type, price, validity, discount) VALUES (?, ?, ?, ?)",
+                (key, value['price'], value['validity'], value.get('discount', 0.0))
+            )
+        elif name == SQLiteStorage.SALES_REPORTS:
+            self._delete(name, key)
+            self.connection.execute(
+                "INSERT INTO sales_reports (report_date, report_id) VALUES (?, ?)", (key, value.report_id)
+            )
+            self._insert_transactions(key, value.transactions)
+        else:
+            raise ValueError(f"Unknown table '{name}'.")
+
+    def _extend(self, name, key, attribute, items):
+        if name == SQLiteStorage.USERS and attribute == "purchase_history":
+            row = self.connection.execute("SELECT user_id FROM users WHERE email = ?", (key,)).fetchone()
+            if row is None:
+                raise ValueError(f"Cannot extend missing record '{key}'.")
+            self._insert_tickets(row[0], items)
+        elif name == SQLiteStorage.SALES_REPORTS and attribute == "transactions":
+            self._insert_transactions(key, items)
+        else:
+            raise ValueError(f"Cannot extend '{attribute}' of table '{name}'.")
+
+    def _delete(self, name, key):
+        if name == SQLiteStorage.USERS:
+            self.connection.execute(
+                "DELETE FROM tickets WHERE user_id IN (SELECT user_id FROM users WHERE email = ?)", (key,)
+            )
+            self.connection.execute("DELETE FROM users WHERE email = ?", (key,))
+        elif name == SQLiteStorage.CATALOG:
+            self.connection.execute("DELETE FROM ticket_catalog WHERE ticket_type = ?", (key,))
+        elif name == SQLiteStorage.SALES_REPORTS:
+            self.connection.execute("DELETE FROM transactions WHERE report_date = ?", (key,))
+            self.connection.execute("DELETE FROM sales_reports WHERE report_date = ?", (key,))
+        else:
+            raise ValueError(f"Unknown table '{name}'.")
+
+    def _insert_tickets(self, user_id, tickets):
+        # The table keeps one row per ticket, so ticket blocks are stored as their tickets
+        tickets = [ticket for item in tickets for ticket in (item if isinstance(item, TicketBlock) else (item,))]
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO tickets (ticket_id, user_id, ticket_type, price, base_price, validity, "
+            "visit_date, discount, default_discount, validity_start_date, validity_end_date) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (t.ticket_id, user_id, t.ticket_type, t.price, getattr(t, "base_price", t.price), t.validity,
+                 getattr(t, "visit_date", "Unknown"), t.discount, getattr(t, "default_discount", 0.0),
+                 _date_to_text(t.validity_start_date), _date_to_text(t.validity_end_date))
+                for t in tickets
+            ]
+        )
+
+    def _insert_transactions(self, report_date, transactions):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO transactions (transaction_id, report_date, customer_name, ticket_type, "
+            "quantity, total_price, date_of_purchase, payment_method) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (t.transaction_id, report_date, t.customer_name, t.ticket_type, t.quantity, t.total_price,
+                 t.date_of_purchase, getattr(t, "payment_method", None))
+                for t in transactions
+            ]
+        )
+
+    # Hydration
+
+    def load_catalog(self):
+        """Return the ticket catalog as a dictionary keyed by ticket type."""
+        rows = self.execute("SELECT ticket_type, price, validity, discount FROM ticket_catalog ORDER BY rowid")
+        return {
+            ticket_type: {"price": price, "validity": validity, "discount": discount}
+            for ticket_type, price, validity, discount in rows
+        }
+
+    def load_user(self, email):
+        """
+        Build a `User` and its purchase history from the database.
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            User: The user, or None if no user has that email.
+        """
+        row = self.execute("SELECT user_id, name, email, password FROM users WHERE email = ?", (email,))
+        if not row:
+            return None
+        user_id, name, email, password = row[0]
+        user = User(_text_to_id(user_id), name, email, password)
+        user.purchase_history = self.load_tickets(user.user_id)
+        return user
+
+    def load_tickets(self, user_id):
+        """Return the tickets bought by a user in purchase order."""
+        rows = self.execute(
+            "SELECT ticket_id, ticket_type, price, base_price, validity, visit_date, discount, default_discount, "
+            "validity_start_date, validity_end_date FROM tickets WHERE user_id = ? ORDER BY rowid",
+            (user_id,)
+        )
+        tickets = []
+        for (ticket_id, ticket_type, price, base_price, validity, visit_date, discount, default_discount,
+             start_date, end_date) in rows:
+            ticket = Ticket(_text_to_id(ticket_id), ticket_type, price, validity, visit_date,
+                            default_discount=default_discount)
+            ticket.base_price = base_price
+            ticket.discount = discount
+            ticket.validity_start_date = _text_to_date(start_date)
+            ticket.validity_end_date = _text_to_date(end_date)
+            tickets.append(ticket)
+        return tickets
+
+    def load_sales_report(self, report_date):
+        """
+        Build a `SalesReport` and its transactions from the database.
+
+        Args:
+            report_date (str): The ISO date of the report.
+
+        Returns:
+            SalesReport: The report, or None if there were no sales that day.
+        """
+        row = self.execute("SELECT report_id FROM sales_reports WHERE report_date = ?", (report_date,))
+        if not row:
+            return None
+        report = SalesReport(_text_to_id(row[0][0]), report_date)
+        rows = self.execute(
+            "SELECT transaction_id, customer_name, ticket_type, quantity, total_price, date_of_purchase, "
+            "payment_method FROM transactions WHERE report_date = ? ORDER BY rowid",
+            (report_date,)
+        )
+        report.transactions = [Transaction(_text_to_id(transaction_id), *values) for transaction_id, *values in rows]
+        return report
+
+
+class _TrackedTable(ChangeTracker, MutableMapping):
+    """
+    Shared behaviour of the dictionary-like table views.
+
+    Records handed out by a view are cached while in use and report their changes back to it,
+    so `DataStorage.flush` can write only what changed. Records with unsaved changes are kept
+    alive until they are flushed.
+    """
+    table_name = None
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.loaded = weakref.WeakValueDictionary()
+        self.dirty_records = {}
+        self._init_change_tracker()
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def mark_dirty(self, key):
+        super().mark_dirty(key)
+        self.dirty_records[key] = self.loaded.get(key)
+
+    def tracked_record(self, key):
+        record = self.dirty_records.get(key)
+        return record if record is not None else self.loaded.get(key)
+
+    def mark_saved(self, pending):
+        super().mark_saved(pending)
+        for key, _ in pending:
+            if key not in self.dirty_keys:
+                self.dirty_records.pop(key, None)
+
+    def __getitem__(self, key):
+        record = self.tracked_record(key)
+        if record is None:
+            record = self.load(key)
+            if record is None:
+                raise KeyError(key)
+            record.mark_clean()
+            self.track(key, record)
+            self.loaded[key] = record
+        return record
+
+    def __setitem__(self, key, record):
+        self.storage.apply_changes(self.table_name, [WriteAheadLog.set_record(key, record)])
+        record.mark_clean()
+        self.track(key, record)
+        self.loaded[key] = record
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.storage.apply_changes(self.table_name, [WriteAheadLog.delete_record(key)])
+        self.loaded.pop(key, None)
+        self.dirty_records.pop(key, None)
+        self.dirty_keys.pop(key, None)
+
+
+class UserTable(_TrackedTable):
+    """
+    A dictionary-like view of the users table keyed by email.
+
+    Each lookup reads one user and their tickets from the database.
+    """
+    table_name = SQLiteStorage.USERS
+
+    def load(self, email):
+        return self.storage.load_user(email)
+
+    def __contains__(self, email):
+        return bool(self.storage.execute("SELECT 1 FROM users WHERE email = ?", (email,)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.storage.execute("SELECT email FROM users ORDER BY rowid")])
+
+    def __len__(self):
+        return self.storage.execute("SELECT COUNT(*) FROM users")[0][0]
+
+
+class SalesReportTable(_TrackedTable):
+    """
+    A dictionary-like view of the sales reports keyed by ISO date.
+
+    Reports and their transactions are read one day at a time, in date order.
+    """
+    table_name = SQLiteStorage.SALES_REPORTS
+
+    def load(self, report_date):
+        return self.storage.load_sales_report(report_date)
+
+    def __contains__(self, report_date):
+        return bool(self.storage.execute("SELECT 1 FROM sales_reports WHERE report_date = ?", (report_date,)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.storage.execute(
+            "SELECT report_date FROM sales_reports ORDER BY report_date"
+        )])
+
+    def __len__(self):
+        return self.storage.execute("SELECT COUNT(*) FROM sales_reports")[0][0]
+
+
+if __name__ == "__main__":
+    # One-shot migration of the pickle files into the database configured in constants.py
+    from data_storage import DataStorage
+    DataStorage.migrate_to_sqlite()
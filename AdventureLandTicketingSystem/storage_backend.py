@@ -0,0 +1,124 @@
+import pickle
+import threading
+
+from write_ahead_log import WriteAheadLog
+
+
+class StorageBackend:
+    """
+    Interface for the stores `DataStorage` can keep its data files in instead of the data folder.
+
+    A backend holds, for each data file path, a snapshot of the whole collection plus the
+    batches of changes appended since (built with `WriteAheadLog.set_record`, `extend_record`
+    and `delete_record`). Install one with `DataStorage.use_backend`; every `DataStorage`
+    call is then served by it and the pickle files and SQLite database are left alone.
+    """
+    def load(self, filename):
+        """
+        Return a fresh copy of the data saved under a path, with its appended changes applied.
+
+        Args:
+            filename (str): The data file path.
+
+        Returns:
+            Any: The data, or an empty dictionary if nothing was saved under the path.
+        """
+        raise NotImplementedError
+
+    def save(self, data, filename):
+        """
+        Replace the snapshot saved under a path and drop its appended changes.
+
+        Args:
+            data: The data object to be saved.
+            filename (str): The data file path.
+
+        Returns:
+            None
+        """
+        raise NotImplementedError
+
+    def write_batches(self, filename, batches):
+        """
+        Append batches of changes to the data saved under a path.
+
+        Args:
+            filename (str): The data file path.
+            batches (list): Lists of changes, one per submitted operation.
+
+        Returns:
+            None
+        """
+        raise NotImplementedError
+
+    def compact(self, filename):
+        """
+        Fold the appended changes of a path into its snapshot.
+
+        Returns:
+            int: The number of changes folded. Backends that keep no separate changes return 0.
+        """
+        return 0
+
+    def refresh(self, data, filename):
+        """Apply changes saved through other handles of the backend to a tracked collection (none by default)."""
+
+
+class InMemoryBackend(StorageBackend):
+    """
+    A backend that keeps every data file in memory and never touches the disk.
+
+    Snapshots and change batches are kept pickled, so loading returns new objects just as
+    reading a file would, and a test can't pass by accident because it still holds the
+    objects it saved. Each instance is independent: tests, benchmarks and simulations can
+    each use their own and run side by side.
+    """
+    def __init__(self):
+        """Initialize an empty backend."""
+        self.snapshots = {}  # filename -> pickled data
+        self.logs = {}  # filename -> pickled change batches
+        self.lock = threading.Lock()
+
+    def load(self, filename):
+        with self.lock:
+            snapshot = self.snapshots.get(filename)
+            batches = list(self.logs.get(filename, ()))
+        if snapshot is None and not batches:
+            print(f"{filename} not found in memory. Returning empty data.")
+            return {}
+        data = pickle.loads(snapshot) if snapshot is not None else {}
+        for batch in batches:
+            for change in pickle.loads(batch):
+                WriteAheadLog.apply_change(data, change)
+        return data
+
+    def save(self, data, filename):
+        snapshot = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.snapshots[filename] = snapshot
+            self.logs.pop(filename, None)
+
+    def write_batches(self, filename, batches):
+        encoded = [pickle.dumps(list(changes), protocol=pickle.HIGHEST_PROTOCOL) for changes in batches]
+        with self.lock:
+            self.logs.setdefault(filename, []).extend(encoded)
+
+    def compact(self, filename):
+        with self.lock:
+            batches = self.logs.get(filename)
+            if not batches:
+                return 0
+            data = pickle.loads(self.snapshots[filename]) if filename in self.snapshots else {}
+            folded = 0
+            for batch in batches:
+                for change in pickle.loads(batch):
+                    WriteAheadLog.apply_change(data, change)
+                    folded += 1
+            self.snapshots[filename] = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            self.logs.pop(filename)
+        return folded
+
+    def filenames(self):
+        """Return the data file paths that hold data in this backend."""
+        with self.lock:
+            return sorted(set(self.snapshots) | set(self.logs))
@@ -1,29 +1,98 @@
 # test.py
 
 import unittest
+import csv
+import importlib
+import io
+import json
+import multiprocessing
 import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
 
 # Import necessary modules from your codebase
-from data_storage import DataStorage
-from constants import FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS
+import constants
+from data_storage import DataStorage, ConcurrentUpdateError
+from constants import (FILE_PATH_USERS, FILE_PATH_TICKETS, FILE_PATH_SALES_REPORTS, FILE_PATH_INVENTORY, TICKET_PRICES,
+                       TICKET_VALIDITY, ADULT_TICKET_TYPES, IDEMPOTENCY_TTL_SECONDS)
 from user import User
 from ticket import Ticket
+from ticket_block import TicketBlock
 from payment import Payment
+from payment_gateway import (PaymentProcessor, NetworkGatewayAdapter, LocalAdapter, SimulatedGatewayServer,
+                             GatewayUnavailableError)
+from idempotency import TTLCache, IdempotencyStore
 from sales_report import SalesReport, Transaction
+from sales_rollup import SalesRollup
+from sales_index import SalesReportIndex
+from sales_export import SalesExporter
+import sales_analytics
+from sales_analytics import SalesAnalytics
+from sales_archive import EndOfDayClose
+from sketches import HyperLogLog, CountMinSketch, SpaceSaving
 from utils import Utils
+from id_generator import NodeLease, SnowflakeIdGenerator
+from write_ahead_log import WriteAheadLog
+from sqlite_storage import SQLiteStorage
+from log_compactor import LogCompactor
+from group_commit import GroupCommitter
+from change_tracking import TicketCatalog
+from record_format import TicketRecordFormat, TransactionRecordFormat, TICKET_TYPE_CODES
+from purchase_history import PurchaseHistory
+from storage_backend import InMemoryBackend
+from inventory import Inventory
+import pricing
+from pricing import PricingEngine
+
+
+def make_ticket(ticket_type="Two-Day Pass", visit_date="2024-12-25", user=None, payment_method="cash",
+                default_discount=0.0):
+    """Return a ticket at its listed price; given a user, its discounts and validity dates are set as at purchase."""
+    ticket = Ticket(Utils.generate_unique_id(), ticket_type, TICKET_PRICES[ticket_type], TICKET_VALIDITY[ticket_type],
+                    visit_date, default_discount=default_discount)
+    if user is not None:
+        ticket.apply_discounts(user, 1, payment_method)
+        ticket.set_validity_dates(user)
+    return ticket
+
+
+def make_transaction(ticket_type, quantity, total_price, day="2024-12-25", payment_method="cash",
+                     customer_name="Test Customer"):
+    """Return a transaction made on a day."""
+    return Transaction(Utils.generate_unique_id(), customer_name, ticket_type, quantity, total_price, day,
+                       payment_method)
+
+
+def make_reports(transactions):
+    """Return sales reports keyed by day, holding the transactions made on each day."""
+    reports = {}
+    for transaction in transactions:
+        day = transaction.date_of_purchase
+        if day not in reports:
+            reports[day] = SalesReport(Utils.generate_unique_id(), day)
+        reports[day].add_transaction(transaction)
+    return reports
+
 
 class TestTicketingSystem(unittest.TestCase):
     def setUp(self):
-        # Load existing data
+        # Keep the data in memory so the tests never touch the data folder and can run in parallel
+        self.previous_backend = DataStorage.use_backend(InMemoryBackend())
+        DataStorage.save_to_file({
+            ticket_type: {"price": price, "validity": TICKET_VALIDITY[ticket_type], "discount": 0.0}
+            for ticket_type, price in TICKET_PRICES.items()
+        }, FILE_PATH_TICKETS)
+
+        # Load data
         self.users = DataStorage.load_from_file(FILE_PATH_USERS)
         self.tickets = DataStorage.load_from_file(FILE_PATH_TICKETS)
         self.sales_reports = DataStorage.load_from_file(FILE_PATH_SALES_REPORTS)
 
-        # Backup original data to restore after tests
-        self.users_backup = self.users.copy()
-        self.tickets_backup = self.tickets.copy()
-        self.sales_reports_backup = self.sales_reports.copy()
-
         # Create a test user
         self.user_id = Utils.generate_unique_id()
         self.user_name = "Test User"
@@ -34,10 +103,7 @@ class TestTicketingSystem(unittest.TestCase):
         DataStorage.save_to_file(self.users, FILE_PATH_USERS)
 
     def tearDown(self):
-        # Restore original data
-        DataStorage.save_to_file(self.users_backup, FILE_PATH_USERS)
-        DataStorage.save_to_file(self.tickets_backup, FILE_PATH_TICKETS)
-        DataStorage.save_to_file(self.sales_reports_backup, FILE_PATH_SALES_REPORTS)
+        DataStorage.use_backend(self.previous_backend)
 
     def test_valid_account_creation(self):
         # Create a new user account
@@ -112,7 +178,7 @@ class TestTicketingSystem(unittest.TestCase):
         )
 
         # Apply discounts and set validity
-        ticket.apply_discounts(self.user, num_tickets, payment_method)
+        PricingEngine(self.tickets).price_ticket(ticket, self.user, num_tickets, payment_method)
         ticket.set_validity_dates(self.user)
         ticket.validate(group_size=num_tickets)
 
@@ -126,22 +192,10 @@ class TestTicketingSystem(unittest.TestCase):
         self.assertTrue(payment_success)
 
         # Update sales report
-        self.update_sales_report(self.user, ticket, num_tickets)
-
-        # Add tickets to user's purchase history
-        for _ in range(num_tickets):
-            individual_ticket_id = Utils.generate_unique_id()
-            individual_ticket = Ticket(
-                individual_ticket_id,
-                ticket.ticket_type,
-                ticket.price,
-                ticket.validity,
-                ticket.visit_date
-            )
-            individual_ticket.discount = ticket.discount
-            individual_ticket.validity_start_date = ticket.validity_start_date
-            individual_ticket.validity_end_date = ticket.validity_end_date
-            self.user.purchase_ticket(individual_ticket)
+        self.update_sales_report(self.user, ticket, num_tickets, payment_method)
+
+        # Add the tickets to user's purchase history as one block
+        self.user.purchase_block(TicketBlock(ticket, num_tickets))
 
         # Save user data
         self.users[self.user_email] = self.user
@@ -191,10 +245,7 @@ class TestTicketingSystem(unittest.TestCase):
         )
 
         # No adult ticket in purchase history
-        adult_present = any(
-            t.ticket_type in ["Single-Day Pass", "Two-Day Pass", "Annual Membership", "VIP Experience Pass"]
-            for t in self.user.purchase_history
-        )
+        adult_present = self.user.count_tickets(*ADULT_TICKET_TYPES) > 0
 
         with self.assertRaises(ValueError) as context:
             ticket.validate(adult_present=adult_present)
@@ -235,7 +286,7 @@ class TestTicketingSystem(unittest.TestCase):
         self.assertEqual(loaded_user.name, self.user_name)
         self.assertEqual(loaded_user.email, self.user_email)
 
-    def update_sales_report(self, user, ticket, quantity):
+    def update_sales_report(self, user, ticket, quantity, payment_method=None):
         """Update the daily sales report with the transaction."""
         today = Utils.get_today_date()
         report = self.sales_reports.get(today)
@@ -252,7 +303,8 @@ class TestTicketingSystem(unittest.TestCase):
             ticket_type=ticket.ticket_type,
             quantity=quantity,
             total_price=ticket.price * quantity,
-            date_of_purchase=today
+            date_of_purchase=today,
+            payment_method=payment_method
         )
 
         # Add the transaction to the report
@@ -308,6 +360,7 @@ class TestTicketingSystem(unittest.TestCase):
         # Test admin updating discounts for a ticket type
         ticket_type = "Annual Membership"
         new_discount = 0.1  
+        original_discount = self.tickets[ticket_type]['discount']
 
         # Admin updates the discount
         self.tickets[ticket_type]['discount'] = new_discount
@@ -318,10 +371,1533 @@ class TestTicketingSystem(unittest.TestCase):
         self.assertEqual(updated_tickets[ticket_type]['discount'], new_discount, "Discount should be updated.")
 
         # Clean up by restoring the original discount
-        self.tickets[ticket_type]['discount'] = self.tickets_backup[ticket_type]['discount']
+        self.tickets[ticket_type]['discount'] = original_discount
         DataStorage.save_to_file(self.tickets, FILE_PATH_TICKETS)
 
-    
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "users.pkl")
+        self.user = User(Utils.generate_unique_id(), "Log User", "loguser@example.com", "secret")
+        DataStorage.save_to_file({self.user.email: self.user}, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_appended_changes_are_replayed_on_load(self):
+        ticket = make_ticket()
+        new_user = User(Utils.generate_unique_id(), "Second User", "second@example.com", "pw")
+        DataStorage.append_changes([WriteAheadLog.extend_record(self.user.email, "purchase_history", [ticket])], self.filename)
+        DataStorage.append_changes([WriteAheadLog.set_record(new_user.email, new_user)], self.filename)
+
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertEqual(len(loaded_users), 2)
+        self.assertEqual([t.ticket_id for t in loaded_users[self.user.email].purchase_history], [ticket.ticket_id])
+        self.assertEqual(loaded_users[new_user.email].name, "Second User")
+
+    def test_full_save_clears_the_log(self):
+        DataStorage.append_changes([WriteAheadLog.delete_record(self.user.email)], self.filename)
+        self.assertTrue(os.path.exists(WriteAheadLog.log_path(self.filename)))
+
+        DataStorage.save_to_file({}, self.filename)
+        self.assertEqual(WriteAheadLog(self.filename).size(), 0)
+        self.assertEqual(DataStorage.load_from_file(self.filename), {})
+
+    def test_torn_tail_is_discarded(self):
+        ticket = make_ticket()
+        DataStorage.append_changes([WriteAheadLog.extend_record(self.user.email, "purchase_history", [ticket])], self.filename)
+        with open(WriteAheadLog.log_path(self.filename), 'ab') as file:
+            file.write(b"\x10\x00\x00\x00partial")
+
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertEqual(len(loaded_users[self.user.email].purchase_history), 1)
+
+        # Appends after the torn batch must still be visible
+        DataStorage.append_changes([WriteAheadLog.extend_record(self.user.email, "purchase_history", [make_ticket()])], self.filename)
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertEqual(len(loaded_users[self.user.email].purchase_history), 2)
+
+
+class TestSQLiteStorage(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.storage = SQLiteStorage(os.path.join(self.folder, "test.db"))
+        self.user = User(Utils.generate_unique_id(), "Sql User", "sqluser@example.com", "secret")
+        ticket = Ticket(Utils.generate_unique_id(), "Two-Day Pass", 480, "2 Days", "2024-12-25")
+        ticket.apply_discount(0.10)
+        ticket.set_validity_dates(self.user)
+        self.user.purchase_ticket(ticket)
+        report = SalesReport(Utils.generate_unique_id(), "2024-12-01")
+        report.add_transaction(Transaction(Utils.generate_unique_id(), "Sql User", "Two-Day Pass", 1, 432.0, "2024-12-01"))
+        self.storage.import_data(
+            {self.user.email: self.user},
+            {"Two-Day Pass": {"price": 480, "validity": "2 Days", "discount": 0.0}},
+            {"2024-12-01": report}
+        )
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.folder)
+
+    def test_users_are_hydrated_on_demand(self):
+        users = self.storage.table(SQLiteStorage.USERS)
+        self.assertIn(self.user.email, users)
+        self.assertIsNone(users.get("nobody@example.com"))
+
+        loaded_user = users[self.user.email]
+        self.assertEqual(loaded_user.password, "secret")
+        loaded_ticket = loaded_user.purchase_history[0]
+        original_ticket = self.user.purchase_history[0]
+        self.assertEqual(loaded_ticket.price, original_ticket.price)
+        self.assertEqual(loaded_ticket.validity_end_date, original_ticket.validity_end_date)
+
+    def test_logged_changes_are_applied_to_tables(self):
+        ticket = Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2024-12-26")
+        transaction = Transaction(Utils.generate_unique_id(), "Sql User", "Single-Day Pass", 1, 275, "2024-12-01")
+        self.storage.apply_changes(SQLiteStorage.USERS, [WriteAheadLog.extend_record(self.user.email, "purchase_history", [ticket])])
+        self.storage.apply_changes(SQLiteStorage.SALES_REPORTS, [WriteAheadLog.extend_record("2024-12-01", "transactions", [transaction])])
+
+        self.assertEqual(len(self.storage.load_user(self.user.email).purchase_history), 2)
+        self.assertEqual(len(self.storage.load_sales_report("2024-12-01").transactions), 2)
+
+    def test_lookup_columns_are_indexed(self):
+        indexed = {row[0] for row in self.storage.execute(
+            "SELECT m.name || '.' || i.name FROM sqlite_master m, pragma_index_info(m.name) i WHERE m.type = 'index'"
+        )}
+        for column in ("idx_users_email.email", "idx_tickets_user_id.user_id", "idx_tickets_visit_date.visit_date",
+                       "idx_transactions_date_of_purchase.date_of_purchase"):
+            self.assertIn(column, indexed)
+
+    def test_engine_is_selected_from_constants(self):
+        engine, db_path = constants.STORAGE_ENGINE, constants.FILE_PATH_DATABASE
+        constants.STORAGE_ENGINE, constants.FILE_PATH_DATABASE = "sqlite", self.storage.db_path
+        try:
+            users = DataStorage.load_from_file(FILE_PATH_USERS)
+            self.assertEqual(len(users), 1)
+            self.assertEqual(DataStorage.load_from_file(FILE_PATH_TICKETS)["Two-Day Pass"]["price"], 480)
+        finally:
+            constants.STORAGE_ENGINE, constants.FILE_PATH_DATABASE = engine, db_path
+
+
+class TestSnapshotCompaction(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "users.pkl")
+        self.user = User(Utils.generate_unique_id(), "Snapshot User", "snapshot@example.com", "secret")
+        DataStorage.save_to_file({self.user.email: self.user}, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def append_ticket(self):
+        ticket = Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2024-12-25")
+        DataStorage.append_changes([WriteAheadLog.extend_record(self.user.email, "purchase_history", [ticket])], self.filename)
+
+    def test_compaction_folds_log_into_snapshot(self):
+        for _ in range(3):
+            self.append_ticket()
+        self.assertEqual(DataStorage.compact(self.filename), 3)
+        self.assertEqual(WriteAheadLog(self.filename).size(), 0)
+
+        self.append_ticket()
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertEqual(len(loaded_users[self.user.email].purchase_history), 4)
+
+    def test_interrupted_compaction_does_not_replay_twice(self):
+        self.append_ticket()
+        self.append_ticket()
+        # Simulate a crash after the new snapshot is renamed into place but before the log is cut
+        data = DataStorage.load_from_file(self.filename)
+        DataStorage.write_snapshot(data, self.filename, WriteAheadLog(self.filename).last_lsn())
+
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertEqual(len(loaded_users[self.user.email].purchase_history), 2)
+
+    def test_compaction_overtaken_by_a_save_is_dropped(self):
+        self.append_ticket()
+        users = DataStorage.load_tracked(self.filename)
+        users[self.user.email].purchase_ticket(Ticket(Utils.generate_unique_id(), "Two-Day Pass", 480, "2 Days",
+                                                      "2024-12-25"))
+        notify_loaded = DataStorage._notify_loaded
+
+        def save_during_fold(data, filename):
+            notify_loaded(data, filename)
+            DataStorage.save_to_file(users, self.filename)  # E.g. the final save on exit
+            self.append_ticket()
+
+        DataStorage._notify_loaded = save_during_fold
+        try:
+            self.assertEqual(DataStorage.compact(self.filename), 0)
+        finally:
+            DataStorage._notify_loaded = notify_loaded
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertEqual(len(loaded_users[self.user.email].purchase_history), 3)
+
+    def test_failed_save_keeps_previous_snapshot(self):
+        with self.assertRaises(Exception):
+            DataStorage.save_to_file({"broken": lambda: None}, self.filename)
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertIn(self.user.email, loaded_users)
+        self.assertEqual(os.listdir(self.folder), ["users.pkl"])
+
+    def test_compactor_runs_when_log_passes_threshold(self):
+        compactor = LogCompactor([self.filename], max_bytes=1, max_age=3600, interval=3600)
+        self.assertEqual(compactor.compact_due(), [])
+        self.append_ticket()
+        self.assertEqual(compactor.compact_due(), [self.filename])
+        self.assertEqual(WriteAheadLog(self.filename).size(), 0)
+
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "users.pkl")
+        self.user = User(Utils.generate_unique_id(), "Group User", "group@example.com", "secret")
+        DataStorage.save_to_file({self.user.email: self.user}, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_concurrent_purchases_share_writes(self):
+        committer = GroupCommitter(DataStorage.write_batches, window=0.05, max_batch=100)
+
+        def purchase():
+            ticket = Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2024-12-25")
+            change = WriteAheadLog.extend_record(self.user.email, "purchase_history", [ticket])
+            committer.submit({self.filename: [change]}).result()
+
+        threads = [threading.Thread(target=purchase) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(committer.submissions_written, 20)
+        self.assertLess(committer.groups_written, 20)
+        loaded_users = DataStorage.load_from_file(self.filename)
+        self.assertEqual(len(loaded_users[self.user.email].purchase_history), 20)
+
+    def test_group_size_is_capped(self):
+        written = []
+        committer = GroupCommitter(lambda filename, batches: written.append(len(batches)), window=0.05, max_batch=3)
+        futures = [committer.submit({self.filename: [WriteAheadLog.delete_record(n)]}) for n in range(10)]
+        for future in futures:
+            future.result()
+        self.assertEqual(sum(written), 10)
+        self.assertTrue(all(size <= 3 for size in written))
+
+    def test_write_errors_reach_every_waiting_purchase(self):
+        def failing_write(filename, batches):
+            raise OSError("disk full")
+
+        committer = GroupCommitter(failing_write, window=0.01)
+        future = committer.submit({self.filename: [WriteAheadLog.delete_record(self.user.email)]})
+        with self.assertRaises(OSError):
+            future.result()
+
+
+class TestDirtyTracking(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.users_file = os.path.join(self.folder, "users.pkl")
+        self.tickets_file = os.path.join(self.folder, "tickets.pkl")
+        users = {}
+        for n in range(50):
+            user = User(Utils.generate_unique_id(), f"User {n}", f"user{n}@example.com", "pw")
+            users[user.email] = user
+        DataStorage.save_to_file(users, self.users_file)
+        DataStorage.save_to_file({"Two-Day Pass": {"price": 480, "validity": "2 Days", "discount": 0.0}}, self.tickets_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_flush_writes_only_dirty_records(self):
+        users = DataStorage.load_tracked(self.users_file)
+        self.assertEqual(users.pending_changes(), [])
+
+        users["user7@example.com"].purchase_ticket(make_ticket())
+        new_user = User(Utils.generate_unique_id(), "New", "new@example.com", "pw")
+        users[new_user.email] = new_user
+        pending = dict(users.pending_changes())
+        self.assertEqual(set(pending), {"user7@example.com", "new@example.com"})
+        self.assertEqual(pending["user7@example.com"][0][0], WriteAheadLog.EXTEND)
+        self.assertEqual(pending["new@example.com"][0][0], WriteAheadLog.SET)
+
+        DataStorage.flush(users, self.users_file)
+        self.assertEqual(users.pending_changes(), [])
+        loaded_users = DataStorage.load_from_file(self.users_file)
+        self.assertEqual(len(loaded_users), 51)
+        self.assertEqual(len(loaded_users["user7@example.com"].purchase_history), 1)
+
+    def test_changes_made_during_a_flush_stay_pending(self):
+        users = DataStorage.load_tracked(self.users_file)
+        user = users["user1@example.com"]
+        user.purchase_ticket(make_ticket())
+        pending = users.pending_changes()
+        user.purchase_ticket(make_ticket())
+        users.mark_saved(pending)
+
+        remaining = users.pending_changes()
+        self.assertEqual(len(remaining), 1)
+        self.assertEqual(len(remaining[0][1][0][3]), 1)
+
+    def test_catalog_discount_changes_are_tracked(self):
+        tickets = DataStorage.load_tracked(self.tickets_file, TicketCatalog)
+        tickets.set_discount("Two-Day Pass", 0.05)
+        with self.assertRaises(ValueError):
+            tickets.set_discount("Unknown Pass", 0.05)
+        DataStorage.flush(tickets, self.tickets_file)
+        self.assertEqual(DataStorage.load_from_file(self.tickets_file)["Two-Day Pass"]["discount"], 0.05)
+
+    def test_tracking_state_is_not_pickled(self):
+        users = DataStorage.load_tracked(self.users_file)
+        user = users["user2@example.com"]
+        user.purchase_ticket(make_ticket())
+        state = user.__getstate__()
+        self.assertNotIn("_tracker", state)
+        self.assertNotIn("_pending", state)
+
+
+class TestLazyPurchaseHistory(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "users.pkl")
+        self.user = User(Utils.generate_unique_id(), "Lazy User", "lazy@example.com", "secret")
+        for _ in range(30):
+            self.user.purchase_ticket(Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2024-12-25"))
+        DataStorage.save_to_file({self.user.email: self.user}, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_history_is_paged_in_on_first_access(self):
+        loaded_user = DataStorage.load_from_file(self.filename)[self.user.email]
+        self.assertFalse(loaded_user.is_history_loaded())
+        self.assertEqual(loaded_user.password, "secret")
+
+        history = loaded_user.purchase_history
+        self.assertTrue(loaded_user.is_history_loaded())
+        self.assertEqual([t.ticket_id for t in history], [t.ticket_id for t in self.user.purchase_history])
+
+        self.assertTrue(loaded_user.evict_purchase_history())
+        self.assertFalse(loaded_user.is_history_loaded())
+        self.assertEqual(len(loaded_user.purchase_history), 30)
+
+    def test_tickets_bought_this_session_are_spilled_on_eviction(self):
+        users = DataStorage.load_tracked(self.filename)
+        user = users[self.user.email]
+        user.purchase_ticket(Ticket(Utils.generate_unique_id(), "Two-Day Pass", 480, "2 Days", "2024-12-25"))
+        DataStorage.flush(users, self.filename)
+        user.purchase_ticket(Ticket(Utils.generate_unique_id(), "Child Ticket", 185, "1 Day", "2024-12-25"))
+        self.assertTrue(user.evict_purchase_history())
+        self.assertFalse(user.is_history_loaded())
+        self.assertEqual([t.ticket_type for t in user.purchase_history[-2:]], ["Two-Day Pass", "Child Ticket"])
+        self.assertTrue(user.evict_purchase_history())
+
+        # The unsaved ticket is still logged by the next save, and replayed once
+        DataStorage.flush(users, self.filename)
+        self.assertEqual(len(DataStorage.load_from_file(self.filename)[self.user.email].purchase_history), 32)
+        DataStorage.compact(self.filename)
+        reloaded_user = DataStorage.load_from_file(self.filename)[self.user.email]
+        self.assertFalse(reloaded_user.is_history_loaded())
+        self.assertEqual(len(reloaded_user.purchase_history), 32)
+
+    def test_new_user_is_spilled_to_the_store_of_the_users_file(self):
+        user = User(Utils.generate_unique_id(), "New User", "new@example.com", "secret")
+        user.purchase_ticket(Ticket(Utils.generate_unique_id(), "Child Ticket", 185, "1 Day", "2024-12-25"))
+        self.assertFalse(user.evict_purchase_history())  # No users file to spill to
+        self.assertTrue(user.evict_purchase_history(self.filename))
+        self.assertEqual(len(user.purchase_history), 1)
+
+    def test_user_index_stays_small(self):
+        with open(self.filename, 'rb') as file:
+            index_size = len(file.read())
+        self.assertLess(index_size, 1000)
+
+
+class TestRecordFormat(unittest.TestCase):
+    def setUp(self):
+        self.user = User(Utils.generate_unique_id(), "Rec User", "rec@example.com", "pw")
+
+    def test_ticket_record_round_trip(self):
+        ticket = make_ticket("Annual Membership", user=self.user, default_discount=0.05)
+        record = TicketRecordFormat.encode(ticket)
+        self.assertEqual(len(record), TicketRecordFormat.LAYOUTS[TicketRecordFormat.VERSION].size)
+        decoded = Ticket.from_record(record)
+        for name in ("ticket_id", "ticket_type", "price", "base_price", "validity", "visit_date",
+                     "discount", "default_discount", "validity_start_date", "validity_end_date"):
+            self.assertEqual(getattr(decoded, name), getattr(ticket, name))
+
+    def test_pickled_ticket_is_compact(self):
+        ticket = make_ticket("Annual Membership", user=self.user, default_discount=0.05)
+        self.assertNotIn("limited_availability", ticket.__getstate__())
+        restored = pickle.loads(pickle.dumps(ticket))
+        self.assertEqual(restored.price, ticket.price)
+        history = [make_ticket("Annual Membership", user=self.user, default_discount=0.05) for _ in range(100)]
+        self.assertLess(len(pickle.dumps(history)), 100 * 70)
+
+    def test_unrepresentable_ticket_falls_back_to_pickle(self):
+        ticket = Ticket("not-a-uuid", "Child Ticket", 140, "1 Day", "2024-12-25")
+        with self.assertRaises(ValueError):
+            TicketRecordFormat.encode(ticket)
+        restored = pickle.loads(pickle.dumps(ticket))
+        self.assertEqual(restored.ticket_id, "not-a-uuid")
+
+    def test_legacy_ticket_state_is_upgraded(self):
+        ticket = Ticket.__new__(Ticket)
+        ticket.__setstate__({"ticket_id": "old", "ticket_type": "Single-Day Pass", "price": 275,
+                             "validity": "1 Day", "limited_availability": 20})
+        self.assertEqual(ticket.visit_date, "Unknown")
+        self.assertEqual(ticket.base_price, 275)
+        self.assertNotIn("limited_availability", ticket.__getstate__())
+
+    def test_unknown_record_version_is_rejected(self):
+        record = bytearray(TicketRecordFormat.encode(make_ticket("Annual Membership", user=self.user, default_discount=0.05)))
+        record[0] = 99
+        with self.assertRaises(ValueError):
+            TicketRecordFormat.decode(bytes(record))
+
+    def test_inline_history_is_decoded_on_first_access(self):
+        self.user.purchase_history = [make_ticket("Annual Membership", user=self.user, default_discount=0.05)
+                                      for _ in range(3)]
+        restored = pickle.loads(pickle.dumps(self.user))
+        self.assertFalse(restored.is_history_loaded())
+        self.assertEqual([t.ticket_id for t in restored.purchase_history],
+                         [t.ticket_id for t in self.user.purchase_history])
+
+    def test_transaction_record_round_trip(self):
+        transaction = Transaction(Utils.generate_unique_id(), "Zoë Customer", "Two-Day Pass", 3, 1296.0, "2024-12-01")
+        restored = pickle.loads(pickle.dumps(transaction))
+        self.assertEqual(str(restored), str(transaction))
+
+
+class TestPurchaseHistory(unittest.TestCase):
+    def setUp(self):
+        self.user = User(Utils.generate_unique_id(), "Column User", "column@example.com", "pw")
+
+    def test_records_have_no_instance_dictionary(self):
+        transaction = make_transaction("Two-Day Pass", 1, 432.0, "2024-12-01", None, "Column User")
+        for record in (make_ticket(user=self.user, default_discount=0.05), transaction, self.user):
+            self.assertFalse(hasattr(record, "__dict__"))
+
+    def test_legacy_transaction_state_is_restored(self):
+        transaction = Transaction.__new__(Transaction)
+        transaction.__setstate__({"transaction_id": "old", "customer_name": "Old Customer", "ticket_type": "Child Ticket",
+                                  "quantity": 2, "total_price": 370.0, "date_of_purchase": "2024-12-01"})
+        self.assertEqual(transaction.total_price, 370.0)
+
+    def test_views_read_like_tickets(self):
+        tickets = [make_ticket(user=self.user, payment_method="credit card", default_discount=0.05),
+                   make_ticket("Annual Membership", user=self.user, payment_method="credit card", default_discount=0.05)]
+        history = PurchaseHistory(tickets)
+        self.assertEqual(len(history), 2)
+        for view, ticket in zip(history, tickets):
+            self.assertEqual(view.price, ticket.price)
+            self.assertAlmostEqual(view.discount, ticket.discount)
+            self.assertEqual(view.ticket_id, ticket.ticket_id)
+            self.assertEqual(view.validity, ticket.validity)
+        self.assertEqual(history[-1].validity_end_date, tickets[-1].validity_end_date)
+        self.assertEqual(PurchaseHistory.from_records(history.to_records())[0].price, tickets[0].price)
+
+    def test_tickets_without_a_record_form_are_kept_whole(self):
+        odd_ticket = Ticket("not-a-uuid", "Child Ticket", 185, "1 Day", "2024-12-25")
+        history = PurchaseHistory([make_ticket(user=self.user), odd_ticket])
+        self.assertIs(history[1], odd_ticket)
+        with self.assertRaises(ValueError):
+            history.to_records()
+
+    def test_reloaded_history_is_columnar(self):
+        self.user.purchase_history = [make_ticket(user=self.user) for _ in range(3)]
+        restored = pickle.loads(pickle.dumps(self.user))
+        self.assertIsInstance(restored.purchase_history, PurchaseHistory)
+        restored.purchase_ticket(make_ticket(user=restored))
+        self.assertEqual(len(pickle.loads(pickle.dumps(restored)).purchase_history), 4)
+
+
+def _sell_from_kiosk(folder, sales, kiosk_name):
+    """Run by each process of TestSharedDataDirectory.test_concurrent_processes_do_not_lose_sales."""
+    constants.SHARED_DATA_DIRECTORY = True
+    filename = os.path.join(folder, "sales_reports.pkl")
+    reports = DataStorage.load_tracked(filename)
+    for _ in range(sales):
+        report = reports.get("2024-12-25")
+        if report is None:
+            report = SalesReport(Utils.generate_unique_id(), "2024-12-25")
+            reports["2024-12-25"] = report
+        report.add_transaction(Transaction(Utils.generate_unique_id(), kiosk_name, "Child Ticket", 1, 185.0, "2024-12-25"))
+        DataStorage.flush(reports, filename)
+
+
+class TestSharedDataDirectory(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.reports_file = os.path.join(self.folder, "sales_reports.pkl")
+        self.users_file = os.path.join(self.folder, "users.pkl")
+        constants.SHARED_DATA_DIRECTORY = True
+
+    def tearDown(self):
+        constants.SHARED_DATA_DIRECTORY = False
+        shutil.rmtree(self.folder)
+
+    def add_sale(self, reports, customer_name):
+        report = reports.get("2024-12-25")
+        if report is None:
+            report = SalesReport(Utils.generate_unique_id(), "2024-12-25")
+            reports["2024-12-25"] = report
+        report.add_transaction(Transaction(Utils.generate_unique_id(), customer_name, "Two-Day Pass", 1, 480.0, "2024-12-25"))
+
+    def test_reports_created_at_two_kiosks_are_merged(self):
+        first_kiosk = DataStorage.load_tracked(self.reports_file)
+        second_kiosk = DataStorage.load_tracked(self.reports_file)
+        self.add_sale(first_kiosk, "First")
+        self.add_sale(second_kiosk, "Second")
+        DataStorage.flush(first_kiosk, self.reports_file)
+        DataStorage.flush(second_kiosk, self.reports_file)
+
+        names = [t.customer_name for t in DataStorage.load_from_file(self.reports_file)["2024-12-25"].transactions]
+        self.assertEqual(sorted(names), ["First", "Second"])
+        DataStorage.refresh(first_kiosk, self.reports_file)
+        self.assertEqual(len(first_kiosk["2024-12-25"].transactions), 2)
+
+    def test_conflicting_accounts_keep_the_saved_version(self):
+        first_kiosk = DataStorage.load_tracked(self.users_file)
+        second_kiosk = DataStorage.load_tracked(self.users_file)
+        first_kiosk["same@example.com"] = User(Utils.generate_unique_id(), "First", "same@example.com", "one")
+        second_kiosk["same@example.com"] = User(Utils.generate_unique_id(), "Second", "same@example.com", "two")
+        DataStorage.flush(first_kiosk, self.users_file)
+        with self.assertRaises(ConcurrentUpdateError):
+            DataStorage.flush(second_kiosk, self.users_file)
+        self.assertEqual(second_kiosk["same@example.com"].name, "First")
+        self.assertEqual(DataStorage.load_from_file(self.users_file)["same@example.com"].name, "First")
+
+    def test_catch_up_across_compaction(self):
+        first_kiosk = DataStorage.load_tracked(self.reports_file)
+        second_kiosk = DataStorage.load_tracked(self.reports_file)
+        for name in ("A", "B", "C"):
+            self.add_sale(first_kiosk, name)
+            DataStorage.flush(first_kiosk, self.reports_file)
+        DataStorage.compact(self.reports_file)
+        self.add_sale(first_kiosk, "D")
+        DataStorage.flush(first_kiosk, self.reports_file)
+
+        DataStorage.refresh(second_kiosk, self.reports_file)
+        self.assertEqual([t.customer_name for t in second_kiosk["2024-12-25"].transactions], ["A", "B", "C", "D"])
+
+    def test_concurrent_processes_do_not_lose_sales(self):
+        processes = [multiprocessing.Process(target=_sell_from_kiosk, args=(self.folder, 25, f"Kiosk {index}"))
+                     for index in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([process.exitcode for process in processes], [0, 0, 0])
+        self.assertEqual(len(DataStorage.load_from_file(self.reports_file)["2024-12-25"].transactions), 75)
+
+
+class TestInMemoryBackend(unittest.TestCase):
+    def setUp(self):
+        self.backend = InMemoryBackend()
+        self.previous_backend = DataStorage.use_backend(self.backend)
+        self.addCleanup(DataStorage.use_backend, self.previous_backend)
+
+    def test_flush_appends_changes_and_compact_folds_them(self):
+        users = DataStorage.load_tracked(FILE_PATH_USERS)
+        users["a@example.com"] = User("a", "A", "a@example.com", "pw")
+        DataStorage.save_to_file(users, FILE_PATH_USERS)
+
+        users["a@example.com"].purchase_ticket(Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2026-12-25"))
+        users["b@example.com"] = User("b", "B", "b@example.com", "pw")
+        DataStorage.flush(users, FILE_PATH_USERS)
+        self.assertEqual(len(self.backend.logs[FILE_PATH_USERS]), 1)
+
+        loaded = DataStorage.load_tracked(FILE_PATH_USERS)
+        self.assertEqual(sorted(loaded), ["a@example.com", "b@example.com"])
+        self.assertEqual(len(loaded["a@example.com"].purchase_history), 1)
+        self.assertIsNot(loaded["a@example.com"], users["a@example.com"])
+
+        self.assertEqual(DataStorage.compact(FILE_PATH_USERS), 2)
+        self.assertNotIn(FILE_PATH_USERS, self.backend.logs)
+        self.assertEqual(len(DataStorage.load_from_file(FILE_PATH_USERS)["a@example.com"].purchase_history), 1)
+
+    def test_backends_are_isolated_and_leave_the_data_folder_alone(self):
+        folder = os.path.dirname(FILE_PATH_USERS)
+        before = sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+        DataStorage.save_to_file({"x": 1}, FILE_PATH_SALES_REPORTS)
+        self.assertEqual(DataStorage.load_from_file(FILE_PATH_SALES_REPORTS), {"x": 1})
+
+        other = InMemoryBackend()
+        DataStorage.use_backend(other)
+        self.assertEqual(DataStorage.load_from_file(FILE_PATH_SALES_REPORTS), {})
+        self.assertEqual(other.filenames(), [])
+        self.assertEqual(self.backend.filenames(), [FILE_PATH_SALES_REPORTS])
+        self.assertEqual(sorted(os.listdir(folder)) if os.path.isdir(folder) else [], before)
+
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.previous_backend = DataStorage.use_backend(InMemoryBackend())
+        self.addCleanup(DataStorage.use_backend, self.previous_backend)
+        self.inventory = Inventory()
+
+    def test_reserve_commit_and_release(self):
+        vip = "VIP Experience Pass"
+        first = self.inventory.reserve("2024-12-25", vip, 15)
+        with self.assertRaises(ValueError):
+            self.inventory.reserve("2024-12-25", vip, 6)
+        self.assertEqual(self.inventory.available("2024-12-25", vip), 5)
+
+        self.inventory.commit(first)
+        second = self.inventory.reserve("2024-12-25", vip, 5)
+        self.inventory.release(second)
+        self.assertEqual(self.inventory.sold("2024-12-25", vip), 15)
+        self.assertEqual(self.inventory.taken("2024-12-25", vip), 15)
+        self.assertEqual(self.inventory.available("2024-12-26", vip), 20)
+        self.assertIsNone(self.inventory.available("2024-12-25", "Single-Day Pass"))
+        with self.assertRaises(ValueError):
+            self.inventory.commit(second)
+
+    def test_expired_holds_are_given_back(self):
+        vip = "VIP Experience Pass"
+        abandoned = self.inventory.reserve("2024-12-25", vip, 15, ttl=10, now=0)
+        paying = self.inventory.reserve("2024-12-25", vip, 5, ttl=100, now=1)
+        for day in range(26, 31):
+            self.inventory.release(self.inventory.reserve(f"2024-12-{day}", vip, 1, ttl=10, now=2))
+        with self.assertRaises(ValueError):
+            self.inventory.reserve("2024-12-25", vip, 1, now=5)
+
+        self.assertEqual(self.inventory.expire_holds(now=12), [abandoned])
+        self.assertEqual(abandoned.state, "expired")
+        self.assertEqual(len(self.inventory.expiries), 1)  # Released holds are dropped as they come due
+        self.assertEqual(self.inventory.available("2024-12-25", vip), 15)
+
+        self.inventory.commit(paying)
+        self.inventory.commit(self.inventory.reserve("2024-12-25", vip, 14, now=12))
+        with self.assertRaises(ValueError):
+            self.inventory.commit(abandoned)  # Expired and the tickets are gone
+        self.assertEqual(self.inventory.sold("2024-12-25", vip), 19)
+
+    def test_renewed_hold_outlives_its_first_ttl(self):
+        vip = "VIP Experience Pass"
+        reservation = self.inventory.reserve("2024-12-25", vip, 20, ttl=10, now=0)
+        self.inventory.renew(reservation, ttl=10, now=8)
+        self.assertEqual(self.inventory.expire_holds(now=12), [])
+        self.assertEqual(self.inventory.expire_holds(now=18), [reservation])
+
+        self.inventory.renew(reservation, ttl=10, now=20)  # Still available, so it is held again
+        self.assertEqual(self.inventory.available("2024-12-25", vip), 0)
+        self.inventory.commit(reservation)
+        self.assertEqual(self.inventory.expire_holds(now=100), [])
+        self.assertEqual(self.inventory.sold("2024-12-25", vip), 20)
+
+    def test_hold_renewed_for_payment_does_not_expire(self):
+        vip = "VIP Experience Pass"
+        paying = self.inventory.reserve("2024-12-25", vip, 20, ttl=10, now=0)
+        self.inventory.renew(paying, ttl=None, now=5)  # Right before charging the customer
+        self.assertEqual(self.inventory.expire_holds(now=1000), [])
+        with self.assertRaises(ValueError):
+            self.inventory.reserve("2024-12-25", vip, 1, now=1000)
+        self.inventory.commit(paying)  # The payment was approved, however long it took
+        self.assertEqual(self.inventory.sold("2024-12-25", vip), 20)
+
+        declined = self.inventory.reserve("2024-12-26", vip, 20, ttl=10, now=0)
+        self.inventory.renew(declined, ttl=None, now=5)
+        self.inventory.release(declined)  # The payment failed
+        self.assertEqual(self.inventory.available("2024-12-26", vip), 20)
+
+    def test_concurrent_reservations_never_exceed_capacity(self):
+        granted = []
+
+        def buy():
+            try:
+                reservation = self.inventory.reserve("2024-12-25", "VIP Experience Pass", 1)
+            except ValueError:
+                return
+            self.inventory.commit(reservation)
+            granted.append(reservation)
+
+        threads = [threading.Thread(target=buy) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(granted), 20)
+        self.assertEqual(self.inventory.sold("2024-12-25", "VIP Experience Pass"), 20)
+
+    def test_sold_counts_are_saved(self):
+        reservation = self.inventory.reserve("2024-12-25", "VIP Experience Pass", 3)
+        self.inventory.commit(reservation)
+        DataStorage.flush(self.inventory.sales, FILE_PATH_INVENTORY)
+        self.inventory.commit(self.inventory.reserve("2024-12-25", "VIP Experience Pass", 2))
+        DataStorage.flush(self.inventory.sales, FILE_PATH_INVENTORY)
+
+        reloaded = Inventory()
+        self.assertEqual(reloaded.sold("2024-12-25", "VIP Experience Pass"), 5)
+        with self.assertRaises(ValueError):
+            reloaded.reserve("2024-12-25", "VIP Experience Pass", 16)
+
+    def test_sales_at_two_kiosks_are_merged(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        filename = os.path.join(folder, "inventory.pkl")
+        DataStorage.use_backend(None)
+        constants.SHARED_DATA_DIRECTORY = True
+        try:
+            first, second = Inventory(filename=filename), Inventory(filename=filename)
+            for kiosk, quantity in ((first, 12), (second, 8)):
+                kiosk.commit(kiosk.reserve("2024-12-25", "VIP Experience Pass", quantity))
+                DataStorage.flush(kiosk.sales, filename)
+            with self.assertRaises(ValueError):
+                first.reserve("2024-12-25", "VIP Experience Pass", 1)
+            self.assertEqual(Inventory(filename=filename).sold("2024-12-25", "VIP Experience Pass"), 20)
+        finally:
+            constants.SHARED_DATA_DIRECTORY = False
+
+    def test_kiosks_holding_the_last_tickets_cannot_both_sell_them(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        filename = os.path.join(folder, "inventory.pkl")
+        vip = "VIP Experience Pass"
+        DataStorage.use_backend(None)
+        constants.SHARED_DATA_DIRECTORY = True
+        try:
+            first, second = Inventory(filename=filename), Inventory(filename=filename)
+            # Neither kiosk sees the other's hold
+            held = [kiosk.reserve("2024-12-25", vip, 20) for kiosk in (first, second)]
+            first.commit(held[0])
+            with self.assertRaises(ValueError):
+                second.commit(held[1])
+            second.release(held[1])
+            self.assertEqual(Inventory(filename=filename).sold("2024-12-25", vip), 20)
+
+            # Renewing without expiry before the payment saves the tickets, so the check comes before charging
+            paying, late = first.reserve("2024-12-26", vip, 15), second.reserve("2024-12-26", vip, 10)
+            first.renew(paying, ttl=None)
+            with self.assertRaises(ValueError):
+                second.renew(late, ttl=None)
+            first.release(paying)  # The payment failed: the tickets are given back
+            second.renew(late, ttl=None)
+            second.commit(late)
+            self.assertEqual(Inventory(filename=filename).sold("2024-12-26", vip), 10)
+            DataStorage.refresh(first.sales, filename)
+            self.assertEqual(first.available("2024-12-26", vip), 10)
+        finally:
+            constants.SHARED_DATA_DIRECTORY = False
+
+
+class TestPricingEngine(unittest.TestCase):
+    def setUp(self):
+        self.catalog = TicketCatalog({
+            ticket_type: {"price": price, "validity": TICKET_VALIDITY[ticket_type], "discount": 0.0}
+            for ticket_type, price in TICKET_PRICES.items()
+        })
+        self.catalog["Child Ticket"]["discount"] = 0.05
+        self.engine = PricingEngine(self.catalog)
+        self.member = User(Utils.generate_unique_id(), "Member", "member@example.com", "pw")
+        membership = Ticket(Utils.generate_unique_id(), "Annual Membership", 1840, "1 Year", "2024-01-01")
+        membership.set_validity_dates(self.member)
+        self.member.purchase_history.append(membership)
+        self.newcomer = User(Utils.generate_unique_id(), "Newcomer", "new@example.com", "pw")
+
+    def test_quotes_match_ticket_discount_rules(self):
+        for ticket_type, details in self.catalog.items():
+            for payment_method in ("credit card", "cash", "coupon", "digital wallet"):
+                for group_size in (1, 19, 20, 35):
+                    for user in (self.member, self.newcomer):
+                        expected = Ticket(Utils.generate_unique_id(), ticket_type, details["price"], details["validity"],
+                                          "2024-12-25", default_discount=details["discount"])
+                        expected.apply_discounts(user, group_size, payment_method)
+                        ticket = Ticket(Utils.generate_unique_id(), ticket_type, details["price"], details["validity"],
+                                        "2024-12-25", default_discount=details["discount"])
+                        self.engine.price_ticket(ticket, user, group_size, payment_method)
+                        self.assertEqual((ticket.price, ticket.discount), (expected.price, expected.discount))
+
+        self.assertEqual(self.engine.quote("Two-Day Pass", "credit card"), 432.0)
+        self.assertEqual(self.engine.quote("Group Ticket (10+)", "cash", group_size=20), 176.0)
+        self.assertEqual(self.engine.quote("Annual Membership", "cash", renewal=True), 1564.0)
+
+    @unittest.skipIf(pricing.np is None, "NumPy is not installed")
+    def test_batch_quotes_match_per_ticket_pricing(self):
+        np = pricing.np
+        lines = []
+        for ticket_type in self.catalog:
+            for payment_method in ("credit card", "cash", "net banking"):
+                for group_size in (1, 20):
+                    for user in (self.member, self.newcomer):
+                        lines.append((ticket_type, group_size, payment_method, user))
+        batch = self.engine.quote_batch(
+            [TICKET_TYPE_CODES[ticket_type] for ticket_type, _, _, _ in lines],
+            [group_size for _, group_size, _, _ in lines],
+            [payment_method for _, _, payment_method, _ in lines],
+            ["2024-12-25"] * len(lines),
+            membership_ends=[self.member.purchase_history[0].validity_end_date if user is self.member else None
+                             for _, _, _, user in lines]
+        )
+        for row, (ticket_type, group_size, payment_method, user) in enumerate(lines):
+            details = self.catalog[ticket_type]
+            ticket = Ticket(Utils.generate_unique_id(), ticket_type, details["price"], details["validity"],
+                            "2024-12-25", default_discount=details["discount"])
+            ticket.apply_discounts(user, group_size, payment_method)
+            ticket.set_validity_dates(user)
+            self.assertEqual(batch.prices[row], ticket.price)
+            self.assertEqual(batch.discounts[row], ticket.discount)
+            self.assertEqual(batch.totals[row], ticket.price * group_size)
+            self.assertEqual(batch.validity_start[row], np.datetime64(ticket.validity_start_date))
+            self.assertEqual(batch.validity_end[row], np.datetime64(ticket.validity_end_date))
+
+        with self.assertRaises(ValueError):
+            self.engine.quote_batch([0], [1], ["cash"], ["2024-12-25"])
+
+    def test_table_is_rebuilt_when_the_catalog_changes(self):
+        table = self.engine.table
+        self.engine.quote("Single-Day Pass", "cash")
+        self.assertIs(self.engine.table, table)
+
+        self.catalog.set_discount("Single-Day Pass", 0.2)
+        self.assertEqual(self.engine.quote("Single-Day Pass", "cash"), 220.0)
+        self.assertIsNot(self.engine.table, table)
+        with self.assertRaises(ValueError):
+            self.engine.quote("Unknown Pass", "cash")
+
+        plain = {"Single-Day Pass": {"price": 275, "validity": "1 Day", "discount": 0.0}}
+        engine = PricingEngine(plain)
+        plain["Single-Day Pass"]["discount"] = 0.1
+        self.assertEqual(engine.quote("Single-Day Pass", "cash"), 275)
+        engine.rebuild()
+        self.assertEqual(engine.quote("Single-Day Pass", "cash"), 247.5)
+
+
+class TestPurchaseIndex(unittest.TestCase):
+    def test_indexes_follow_appended_tickets(self):
+        user = User(Utils.generate_unique_id(), "Member", "member@example.com", "pw")
+        self.assertEqual(user.count_tickets(*ADULT_TICKET_TYPES), 0)
+        self.assertIsNone(user.latest_membership_end())
+
+        user.purchase_ticket(make_ticket("Annual Membership", "2024-01-10", user))
+        renewal = make_ticket("Annual Membership", "2024-06-01", user)
+        self.assertEqual(renewal.validity_start_date, date(2025, 1, 10))
+        user.purchase_ticket(renewal)
+        # Tickets replayed from the write-ahead log are appended to the list directly
+        user.purchase_history.extend([make_ticket("Child Ticket", "2024-06-01", user)])
+
+        self.assertEqual(user.count_tickets("Annual Membership"), 2)
+        self.assertEqual(user.count_tickets(*ADULT_TICKET_TYPES), 2)
+        self.assertEqual(user.latest_membership_end(), date(2026, 1, 10))
+        self.assertEqual([t.ticket_type for t in user.tickets_for_visit_date("2024-06-01")],
+                         ["Annual Membership", "Child Ticket"])
+        self.assertEqual(user.purchase_index.size, 3)
+
+        user.purchase_history = [make_ticket("Single-Day Pass", "2024-07-01", user)]
+        self.assertEqual(user.count_tickets("Annual Membership"), 0)
+        self.assertEqual(len(user.tickets_for_visit_date("2024-07-01")), 1)
+
+    def test_index_is_rebuilt_after_loading(self):
+        user = User(Utils.generate_unique_id(), "Member", "member@example.com", "pw")
+        for day in range(1, 4):
+            user.purchase_ticket(make_ticket("Annual Membership", f"2024-01-0{day}", user))
+        self.assertEqual(user.count_tickets("Annual Membership"), 3)
+
+        state = user.__getstate__()
+        self.assertNotIn("_index", state)
+        loaded = pickle.loads(pickle.dumps(user))
+        self.assertEqual(loaded.count_tickets("Annual Membership"), 3)
+        self.assertEqual(loaded.latest_membership_end(), user.latest_membership_end())
+        self.assertTrue(PricingEngine.is_renewal(loaded, "Annual Membership"))
+
+
+class TestTicketBlock(unittest.TestCase):
+    def make_block(self, quantity):
+        ticket = make_ticket("Group Ticket (10+)")
+        ticket.apply_discount(0.2)
+        return TicketBlock(ticket, quantity)
+
+    def test_block_numbers_tickets_and_splits(self):
+        block = self.make_block(500)
+        ids = [ticket.ticket_id for ticket in block]
+        self.assertEqual(len(set(ids)), 500)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(ids[-1], SnowflakeIdGenerator.offset_id(ids[0], 499))
+
+        before, ticket, after = block.split(10)
+        self.assertEqual((len(before), len(after)), (10, 489))
+        self.assertEqual(ticket.ticket_id, ids[10])
+        self.assertEqual(ticket.price, 176.0)
+        self.assertEqual(after.ticket_id, ids[11])
+        self.assertEqual(pickle.loads(pickle.dumps(block)).ticket_id_at(499), ids[-1])
+
+    def test_block_is_one_history_entry(self):
+        user = User(Utils.generate_unique_id(), "Teacher", "teacher@example.com", "pw")
+        user.purchase_ticket(Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2024-12-25"))
+        user.mark_clean()
+        block = self.make_block(500)
+        user.purchase_block(block)
+
+        changes = user.pending_changes("teacher@example.com")
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(len(changes[0][3]), 1)
+        self.assertLess(len(pickle.dumps(changes)), 1000)
+        history = user.purchase_history
+        self.assertIsInstance(history, PurchaseHistory)
+        self.assertEqual(len(history), 501)
+        self.assertEqual(history[1].ticket_id, block.ticket_id)
+        self.assertEqual(history[-1].ticket_id, block.ticket_id_at(499))
+        self.assertEqual([t.ticket_id for t in history][2], block.ticket_id_at(1))
+        self.assertEqual(user.count_tickets("Group Ticket (10+)"), 500)
+        self.assertEqual(len(user.tickets_for_visit_date("2024-12-25")), 501)
+        self.assertEqual(user.purchase_index.rows_by_visit_date["2024-12-25"], [0, 1])  # One row per block
+
+        # Replaying the logged change gives the same history; snapshots expand the block into records
+        replayed = PurchaseHistory()
+        replayed.extend(history[:1])
+        replayed.extend(changes[0][3])
+        self.assertEqual([t.ticket_id for t in replayed], [t.ticket_id for t in history])
+        decoded = PurchaseHistory.from_records(history.to_records())
+        self.assertEqual([t.ticket_id for t in decoded], [t.ticket_id for t in history])
+        loaded = pickle.loads(pickle.dumps(user))
+        self.assertEqual(loaded.purchase_history[250].ticket_id, history[250].ticket_id)
+
+    def test_block_is_counted_once_after_eviction(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        user = User(Utils.generate_unique_id(), "Teacher", "teacher@example.com", "pw")
+        user.purchase_ticket(Ticket(Utils.generate_unique_id(), "Single-Day Pass", 275, "1 Day", "2024-12-25"))
+        user.purchase_block(self.make_block(5))
+        self.assertEqual(user.count_tickets("Group Ticket (10+)"), 5)
+
+        self.assertTrue(user.evict_purchase_history(os.path.join(folder, "users.pkl")))
+        self.assertEqual(len(user.purchase_history), 6)
+        self.assertEqual(user.count_tickets("Group Ticket (10+)"), 5)
+        self.assertEqual(user.count_tickets("Single-Day Pass"), 1)
+        self.assertEqual(len(user.tickets_for_visit_date("2024-12-25")), 6)
+
+
+def _issue_ids(folder, count, results):
+    """Run by each process of TestSnowflakeIds.test_processes_issue_distinct_ids."""
+    generator = SnowflakeIdGenerator(NodeLease.acquire(folder))
+    results.put([generator.next_id() for _ in range(count)])
+
+
+class TestSnowflakeIds(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_ids_sort_by_time_and_scan_by_range(self):
+        now = [1_750_000_000.0]
+        generator = SnowflakeIdGenerator(NodeLease.acquire(self.folder), clock=lambda: now[0])
+        first = [generator.next_id() for _ in range(5000)]  # More than one millisecond's sequence
+        now[0] -= 5  # The clock goes back
+        second = [generator.next_id() for _ in range(10)]
+        now[0] += 60
+        third = generator.next_id()
+        ids = first + second + [third]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all(SnowflakeIdGenerator.node_of(i) == generator.node_id for i in ids))
+
+        moment = SnowflakeIdGenerator.timestamp_of(third)
+        self.assertEqual(moment.timestamp(), 1_750_000_055.0)
+        in_range = [i for i in ids if SnowflakeIdGenerator.first_id_at(moment) <= i]
+        self.assertEqual(in_range, [third])
+        self.assertEqual(Utils.parse_id(Utils.format_id(third)), third)
+        self.assertEqual(len(Utils.format_id(third)), 13)
+
+    def test_next_holder_of_a_node_starts_after_its_high_water_mark(self):
+        now = [1_750_000_000.0]
+        lease = NodeLease.acquire(self.folder)
+        issued = SnowflakeIdGenerator(lease, clock=lambda: now[0]).reserve(10_000)
+        self.assertNotEqual(NodeLease.acquire(self.folder).node_id, lease.node_id)
+        lease.release()
+
+        now[0] -= 10  # The next process starts with a clock that is behind
+        successor = SnowflakeIdGenerator(NodeLease.acquire(self.folder), clock=lambda: now[0])
+        self.assertEqual(successor.node_id, lease.node_id)
+        self.assertGreater(successor.next_id(), SnowflakeIdGenerator.offset_id(issued, 9_999))
+
+    def test_processes_issue_distinct_ids(self):
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_issue_ids, args=(self.folder, 2000, results)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        ids = [i for _ in processes for i in results.get(timeout=30)]
+        for process in processes:
+            process.join()
+        self.assertEqual(len(set(ids)), 6000)
+        self.assertEqual(len({SnowflakeIdGenerator.node_of(i) for i in ids}), 3)
+
+    def test_records_keep_uuid_ids_of_older_tickets(self):
+        old = Ticket("3f2b8c1e-8d4a-4b6e-9a3c-1d2e3f4a5b6c", "Child Ticket", 185, "1 Day", "2024-12-25")
+        new = Ticket(Utils.generate_unique_id(), "Child Ticket", 185, "1 Day", "2024-12-25")
+        self.assertEqual(len(TicketRecordFormat.encode(old)), 46)
+        self.assertEqual(len(TicketRecordFormat.encode(new)), 38)
+        history = PurchaseHistory.from_records(TicketRecordFormat.encode_many([old, new, new]))
+        self.assertEqual([t.ticket_id for t in history], [old.ticket_id, new.ticket_id, new.ticket_id])
+        self.assertEqual(PurchaseHistory.from_records(history.to_records())[0].ticket_id, old.ticket_id)
+        self.assertEqual([f["ticket_id"] for f in TicketRecordFormat.decode_many(history.to_records())],
+                         [old.ticket_id, new.ticket_id, new.ticket_id])
+
+
+class TestSalesRollup(unittest.TestCase):
+    def setUp(self):
+        self.report = make_reports([make_transaction("Two-Day Pass", 2, 864.2, payment_method="credit card"),
+                                    make_transaction("Two-Day Pass", 1, 432.1),
+                                    make_transaction("Child Ticket", 3, 555.0)])["2024-12-25"]
+
+    def test_totals_are_kept_as_transactions_are_added(self):
+        report = self.report
+        rollup = report.rollup
+        self.assertEqual(rollup.totals(), (1851.3, 6, 3))
+        self.assertEqual(rollup.totals("ticket_type", "Two-Day Pass"), (1296.3, 3, 2))
+        self.assertEqual(rollup.totals("payment_method", "cash"), (987.1, 4, 2))
+        self.assertEqual(rollup.totals("day", "2024-12-25").count, 3)
+        self.assertEqual(rollup.totals("ticket_type", "VIP Experience Pass"), (0, 0, 0))
+        hour = report.transactions[0].purchased_at.hour
+        self.assertEqual(rollup.breakdown("hour"), {hour: rollup.totals()})
+        self.assertEqual(SalesRollup.from_transactions(report.transactions).counters, rollup.counters)
+        self.assertIn("cash: 987.10 DHS, 4 tickets, 2 transactions", report.summary())
+        with self.assertRaises(ValueError):
+            rollup.totals("customer")
+
+    def test_rollup_is_saved_with_the_report_and_follows_the_log(self):
+        report = self.report
+        loaded = pickle.loads(pickle.dumps(report))
+        self.assertEqual(loaded.__dict__["_rolled_up"], 3)
+        self.assertEqual(loaded.rollup.counters, report.rollup.counters)
+
+        # Transactions replayed from the write-ahead log are appended to the list directly
+        WriteAheadLog.apply_change({"2024-12-25": loaded}, WriteAheadLog.extend_record(
+            "2024-12-25", "transactions", [make_transaction("Child Ticket", 1, 185.0, payment_method=None)]))
+        self.assertEqual(loaded.rollup.totals(), (2036.3, 7, 4))
+        self.assertEqual(loaded.rollup.totals("payment_method", None).quantity, 1)
+        self.assertEqual(report.rollup.totals().count, 3)
+
+        # Reports saved before rollups are rolled up from their transactions
+        state = loaded.__getstate__()
+        del state["_rollup"], state["_rolled_up"]
+        legacy = SalesReport.__new__(SalesReport)
+        legacy.__setstate__(state)
+        self.assertEqual(legacy.rollup.counters, loaded.rollup.counters)
+
+    def test_transaction_records_keep_the_payment_method(self):
+        transaction = make_transaction("Two-Day Pass", 2, 864.0, payment_method="digital wallet")
+        record = TransactionRecordFormat.encode(transaction)
+        self.assertEqual(record[0], 3)
+        self.assertEqual(TransactionRecordFormat.decode(record)[0]["payment_method"], "digital wallet")
+
+        older = TransactionRecordFormat.LAYOUTS[2].pack(2, transaction.transaction_id, TICKET_TYPE_CODES["Two-Day Pass"],
+                                                        2, 86400, date(2024, 12, 25).toordinal(), 0)
+        self.assertIsNone(TransactionRecordFormat.decode(older)[0]["payment_method"])
+        legacy = Transaction("3f2b8c1e-8d4a-4b6e-9a3c-1d2e3f4a5b6c", "Old", "Child Ticket", 1, 185.0, "2024-12-25", "cash")
+        self.assertIsNone(legacy.purchased_at)
+        self.assertEqual(pickle.loads(pickle.dumps(legacy)).payment_method, "cash")
+
+
+class TestSalesReportIndex(unittest.TestCase):
+    def setUp(self):
+        sales = [("2024-12-23", "Two-Day Pass", 2, 864.2), ("2024-12-24", "Child Ticket", 1, 185.0),
+                 ("2024-12-24", "Two-Day Pass", 1, 432.1), ("2024-12-26", "Child Ticket", 3, 555.0)]
+        self.reports = make_reports(make_transaction(ticket_type, quantity, total_price, day)
+                                    for day, ticket_type, quantity, total_price in sales)
+
+    def test_dates_between_includes_both_ends(self):
+        reports = self.reports
+        index = SalesReportIndex(reports)
+        self.assertEqual(index.dates_between("2024-12-24", "2024-12-26"), ["2024-12-24", "2024-12-26"])
+        self.assertEqual(index.dates_between("2024-12-25", "2024-12-25"), [])
+        self.assertEqual(index.dates_between(end=date(2024, 12, 24)), ["2024-12-23", "2024-12-24"])
+        self.assertEqual(index.dates_between(), sorted(reports))
+
+        reports["2024-12-25"] = SalesReport(Utils.generate_unique_id(), "2024-12-25")
+        self.assertEqual(index.dates_between("2024-12-25", "2024-12-25"), ["2024-12-25"])
+        with self.assertRaises(ValueError):
+            index.dates_between("25/12/2024")
+
+    def test_totals_and_transactions_by_ticket_type(self):
+        reports = self.reports
+        index = SalesReportIndex(reports)
+        window = [t for day in ("2024-12-24", "2024-12-26") for t in reports[day].transactions
+                  if t.ticket_type == "Child Ticket"]
+        self.assertEqual(list(index.transactions("2024-12-24", None, "Child Ticket")), window)
+        self.assertEqual(index.totals("2024-12-24", None, "Child Ticket"),
+                         (round(sum(t.total_price for t in window), 2), sum(t.quantity for t in window), len(window)))
+        self.assertEqual(index.totals(), (2036.3, 7, 4))
+        self.assertEqual(index.rollup("2024-12-23", "2024-12-24").totals("ticket_type", "Two-Day Pass"),
+                         (1296.3, 3, 2))
+
+        # Transactions replayed from the write-ahead log are picked up by the type index
+        report = reports["2024-12-26"]
+        self.assertEqual(len(report.transactions_of_type("Child Ticket")), 1)
+        WriteAheadLog.apply_change(reports, WriteAheadLog.extend_record("2024-12-26", "transactions", [
+            make_transaction("Child Ticket", 1, 185.0, "2024-12-26", None)]))
+        self.assertEqual(len(report.transactions_of_type("Child Ticket")), 2)
+        self.assertEqual(index.totals("2024-12-26", "2024-12-26", "Child Ticket").quantity, 4)
+
+
+class TestSalesExporter(unittest.TestCase):
+    def setUp(self):
+        self.reports = list(make_reports([
+            make_transaction("Child Ticket", 1, 185.0, "2024-12-24", customer_name="Export, Customer"),
+            make_transaction("Two-Day Pass", 1, 432.1, "2024-12-25", customer_name="Export, Customer")]).values())
+
+    def test_csv_and_json_lines_have_one_row_per_transaction(self):
+        reports = self.reports
+        output = io.StringIO(newline='')
+        self.assertEqual(SalesExporter.write_csv(reports, output), 2)
+        rows = list(csv.DictReader(io.StringIO(output.getvalue(), newline='')))
+        self.assertEqual([row["ticket_type"] for row in rows], ["Child Ticket", "Two-Day Pass"])
+        self.assertEqual(rows[0]["customer_name"], "Export, Customer")
+        self.assertEqual(rows[1]["transaction_id"], Utils.format_id(reports[1].transactions[0].transaction_id))
+
+        output = io.StringIO()
+        SalesExporter.write(reports, output, "jsonl")
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([line["total_price"] for line in lines], [185.0, 432.1])
+        self.assertEqual(lines[1]["report_date"], "2024-12-25")
+        with self.assertRaises(ValueError):
+            SalesExporter.write(reports, output, "xml")
+
+    def test_text_is_rendered_line_by_line_and_paged(self):
+        report = self.reports[0]
+        lines = list(report.iter_lines())
+        self.assertTrue(all(line.endswith("\n") and line.count("\n") == 1 for line in lines))
+        self.assertEqual("".join(lines), str(report))
+        self.assertIn("Total Price: 185.00 DHS\n", lines)
+
+        output = io.StringIO()
+        answers = iter(["", "q"])
+        self.assertFalse(SalesExporter.page(iter(lines), 3, output, lambda _: next(answers)))
+        self.assertEqual(output.getvalue(), "".join(lines[:6]))
+        output = io.StringIO()
+        self.assertTrue(SalesExporter.page(iter(lines), 100, output, lambda _: "q"))
+        self.assertEqual(output.getvalue(), str(report))
+
+
+@unittest.skipIf(sales_analytics.np is None, "NumPy is not installed")
+class TestSalesAnalytics(unittest.TestCase):
+    def setUp(self):
+        sales = [("2024-12-23", "Ann", "Two-Day Pass", 2, 864.2), ("2024-12-23", "Bob", "Child Ticket", 1, 185.0),
+                 ("2024-12-29", "Ann", "Child Ticket", 3, 555.0), ("2025-01-08", "Cy", "Two-Day Pass", 1, 432.1)]
+        self.reports = make_reports(make_transaction(ticket_type, quantity, total_price, day, customer_name=customer)
+                                    for day, customer, ticket_type, quantity, total_price in sales)
+
+    def test_revenue_pivot_and_average_basket(self):
+        np = sales_analytics.np
+        reports = self.reports
+        analytics = SalesAnalytics(reports)
+        pivot = analytics.revenue_by_type_by_day()
+        self.assertEqual([str(day) for day in pivot.days], ["2024-12-23", "2024-12-29", "2025-01-08"])
+        self.assertEqual(pivot.ticket_types, ["Two-Day Pass", "Child Ticket"])
+        np.testing.assert_allclose(pivot.revenue, [[864.2, 185.0], [0, 555.0], [432.1, 0]])
+        self.assertEqual(len(analytics.revenue_by_type_by_day("2024-12-24", "2025-01-07").days), 1)
+
+        basket = analytics.average_basket()
+        self.assertEqual(basket[:3], (4, 3, 1.75))
+        self.assertAlmostEqual(basket.revenue, 2036.3 / 4, places=2)
+        self.assertEqual(analytics.average_basket("2024-12-23", "2024-12-29", "Child Ticket"), (2, 2, 2.0, 370.0))
+        self.assertEqual(analytics.average_basket("2026-01-01"), (0, 0, 0.0, 0.0))
+        with self.assertRaises(ValueError):
+            analytics.average_basket(ticket_type="Season Pass")
+
+        # Transactions appended later are loaded on the next query
+        reports["2025-01-08"].add_transaction(make_transaction("Child Ticket", 1, 185.0, "2025-01-08", customer_name="Ann"))
+        self.assertEqual(analytics.average_basket().transactions, 5)
+        self.assertEqual(analytics.revenue_by_type_by_day("2025-01-08").revenue.tolist(), [[432.1, 185.0]])
+
+    def test_week_over_week(self):
+        np = sales_analytics.np
+        weekly = SalesAnalytics(self.reports).week_over_week()
+        self.assertEqual([str(day) for day in weekly.week_start], ["2024-12-23", "2024-12-30", "2025-01-06"])
+        np.testing.assert_allclose(weekly.revenue, [1604.2, 0, 432.1])
+        self.assertEqual(weekly.quantity.tolist(), [6, 0, 1])
+        np.testing.assert_allclose(weekly.revenue_change[1:], [-1604.2, 432.1])
+        self.assertTrue(np.isnan(weekly.revenue_change[0]))
+        self.assertEqual(weekly.revenue_change_ratio[1], -1.0)
+        self.assertTrue(np.isnan(weekly.revenue_change_ratio[2]))  # No sales the week before
+
+
+class _UnreadTransactions(list):
+    """Transactions that fail the test if they are walked."""
+    def __iter__(self):
+        raise AssertionError("The transactions were read.")
+
+
+class TestEndOfDayClose(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.reports_file = os.path.join(self.folder, "sales_reports.pkl")
+        self.rollups_file = os.path.join(self.folder, "sales_rollups.pkl")
+        sales = [("2024-11-30", "Child Ticket", 185.0), ("2024-12-01", "Two-Day Pass", 432.1),
+                 ("2024-12-02", "Child Ticket", 370.0), ("2024-12-03", "Two-Day Pass", 864.2)]
+        DataStorage.save_to_file(make_reports(
+            make_transaction(ticket_type, 2 if total_price > 300 else 1, total_price, day, customer_name="Closing Customer")
+            for day, ticket_type, total_price in sales), self.reports_file)
+        self.reports = DataStorage.load_tracked(self.reports_file)
+        self.rollups = DataStorage.load_tracked(self.rollups_file)
+        self.closer = EndOfDayClose(self.reports, self.rollups, self.reports_file, self.rollups_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_past_days_are_sealed_archived_and_rolled_up(self):
+        transactions = list(self.reports["2024-12-02"].transactions)
+        self.assertEqual(self.closer.close_due("2024-12-03"), ["2024-11-30", "2024-12-01", "2024-12-02"])
+        self.assertEqual(self.closer.close_due("2024-12-03"), [])
+
+        reports = DataStorage.load_tracked(self.reports_file)
+        rollups = DataStorage.load_tracked(self.rollups_file)
+        closed = reports["2024-12-02"]
+        self.assertTrue(closed.closed)
+        self.assertFalse(reports["2024-12-03"].closed)
+        self.assertEqual(closed.transaction_count, 1)
+        self.assertEqual([t.transaction_id for t in closed.transactions], [t.transaction_id for t in transactions])
+        self.assertEqual(closed.rollup.totals(), (370.0, 2, 1))
+        self.assertNotIn("transactions", closed.__getstate__())
+        with self.assertRaises(ValueError):
+            closed.add_transaction(transactions[0])
+
+        self.assertEqual(sorted(rollups), ["2024", "2024-11", "2024-12"])
+        self.assertEqual(rollups["2024-12"].days, ["2024-12-01", "2024-12-02"])
+        self.assertEqual(rollups["2024"].rollup.totals(), (987.1, 5, 3))
+
+    def test_long_periods_read_period_rollups(self):
+        self.closer.close_due("2024-12-04")
+        index = SalesReportIndex(self.reports, self.rollups)
+        self.assertEqual(index.rollups_between(), [self.rollups["2024"].rollup])
+        self.assertEqual(index.rollups_between("2024-12-01"), [self.rollups["2024-12"].rollup])
+        self.assertEqual(len(index.rollups_between("2024-12-02")), 2)  # Part of a month: daily rollups
+        self.assertEqual(index.totals(), SalesReportIndex(self.reports).totals())
+        self.assertEqual(index.totals("2024-12-01", "2024-12-31", "Child Ticket"), (370.0, 2, 1))
+
+        # Days whose reports were sealed but whose period rollups were not saved are folded by the next close
+        del self.rollups["2024-12"]
+        self.assertEqual(EndOfDayClose.close_days(self.reports, self.rollups, self.closer.archive, "2024-12-04"),
+                         ["2024-12-01", "2024-12-02", "2024-12-03"])
+        self.assertEqual(self.rollups["2024-12"].rollup.totals(), (1666.3, 6, 3))
+        self.assertEqual(self.rollups["2024"].rollup.totals().count, 4)
+
+    def test_admin_totals_are_read_from_rollups_alone(self):
+        expected = [(day, report.rollup.totals()) for day, report in sorted(self.reports.items())]
+        self.closer.close_due("2024-12-03")
+        reports = DataStorage.load_tracked(self.reports_file)
+        for report in reports.values():
+            if report.closed:
+                report._archive = None  # Reading a closed day's transactions now fails
+            else:
+                report.transactions = _UnreadTransactions(report.transactions)
+
+        index = SalesReportIndex(reports, DataStorage.load_tracked(self.rollups_file))
+        self.assertEqual(index.daily_totals(), expected)
+        self.assertEqual(index.daily_totals("2024-12-02"), expected[2:])
+        self.assertEqual(index.rollup().totals(), (1851.3, 7, 4))
+        self.assertEqual(index.totals("2024-11-01", "2024-11-30"), (185.0, 1, 1))
+
+    def test_close_running_beside_purchases_keeps_every_sale(self):
+        lock = threading.RLock()
+        closer = EndOfDayClose(self.reports, self.rollups, self.reports_file, self.rollups_file, lock=lock)
+        clock = {"today": "2024-12-04"}
+        sold, done = [], threading.Event()
+
+        def purchases():
+            try:
+                sell()
+            finally:
+                done.set()
+
+        def sell():
+            for n in range(200):
+                if n == 100:
+                    clock["today"] = "2024-12-05"  # Midnight passes halfway through
+                with lock:
+                    today = clock["today"]
+                    report = self.reports.get(today)
+                    if not report:
+                        report = SalesReport(Utils.generate_unique_id(), today)
+                        self.reports[today] = report
+                    transaction = Transaction(Utils.generate_unique_id(), f"Customer {n}", "Child Ticket",
+                                              1, 185.0, today, "cash")
+                    report.add_transaction(transaction)
+                    DataStorage.flush_all({self.reports_file: self.reports})
+                sold.append(transaction.transaction_id)
+
+        def closes():
+            while not done.is_set():
+                closer.close_due(clock["today"])
+
+        threads = [threading.Thread(target=purchases), threading.Thread(target=closes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        closer.close_due("2024-12-05")
+
+        reports = DataStorage.load_tracked(self.reports_file)
+        self.assertTrue(reports["2024-12-04"].closed)
+        saved = [t.transaction_id for day in ("2024-12-04", "2024-12-05") for t in reports[day].transactions]
+        self.assertEqual(sorted(saved), sorted(sold))
+
+class TestSketches(unittest.TestCase):
+    def test_hyperloglog_estimates_distinct_keys_and_merges_as_union(self):
+        morning, afternoon = HyperLogLog(), HyperLogLog()
+        for number in range(8000):
+            morning.add(f"Customer {number}")
+            morning.add(f"Customer {number}")  # Repeat visits are not counted twice
+        for number in range(4000, 12000):
+            afternoon.add(f"Customer {number}")
+        self.assertAlmostEqual(morning.estimate(), 8000, delta=400)
+        morning.merge(afternoon)
+        self.assertAlmostEqual(morning.estimate(), 12000, delta=600)
+        self.assertEqual(pickle.loads(pickle.dumps(morning)).estimate(), morning.estimate())
+        self.assertEqual(HyperLogLog().estimate(), 0)
+        with self.assertRaises(ValueError):
+            morning.merge(HyperLogLog(8))
+
+    def test_heavy_hitters_are_kept_within_bounded_counters(self):
+        counts, summary, sketch = {}, SpaceSaving(20), CountMinSketch(256, 4)
+        for number in range(3000):
+            name = f"Tour Group {number % 5}" if number % 3 == 0 else f"Visitor {number}"
+            quantity = 10 if name.startswith("Tour") else 1
+            counts[name] = counts.get(name, 0) + quantity
+            summary.add(name, quantity)
+            sketch.add(name, quantity)
+        self.assertLessEqual(len(summary.counters), 40)
+        self.assertEqual({name for name, _, _ in summary.top(5)}, {f"Tour Group {number}" for number in range(5)})
+        for name, count, error in summary.top(5):
+            self.assertTrue(counts[name] <= count <= counts[name] + error)
+        self.assertTrue(all(sketch.estimate(name) >= count for name, count in counts.items()))
+
+        other = sketch.copy()
+        other.add("Tour Group 0", 5)
+        sketch.merge(other)
+        self.assertGreaterEqual(sketch.estimate("Tour Group 0"), 2 * counts["Tour Group 0"] + 5)
+        summary.merge(summary.copy())
+        self.assertEqual(summary.top(1)[0][0], max(counts, key=counts.get))
+
+    def test_rollups_sketch_customers_across_days(self):
+        reports = {}
+        for day, names in (("2024-12-01", ["Amina", "Omar", "Omar"]), ("2024-12-02", ["Omar", "Layla"])):
+            reports[day] = SalesReport(Utils.generate_unique_id(), day)
+            for name in names:
+                reports[day].add_transaction(Transaction(Utils.generate_unique_id(), name, "Child Ticket", 2,
+                                                         370.0, day, "cash"))
+        rollup = SalesReportIndex(reports).rollup()
+        self.assertEqual(rollup.distinct_customers(), 3)
+        self.assertEqual(rollup.top_buyers(2), [("Omar", 6), ("Amina", 2)])
+        self.assertEqual(rollup.top_ticket_types(), [("Child Ticket", (1850.0, 10, 5))])
+        self.assertIn("  Omar: 6 tickets", rollup.customer_lines())
+
+        # Reports saved before customers were sketched are rolled up again from their transactions
+        state = reports["2024-12-01"].__getstate__()
+        legacy = SalesRollup()
+        legacy.__setstate__({"counters": state["_rollup"].counters})
+        self.assertIsNone(legacy.distinct_customers())
+        self.assertIsNone(SalesRollup.combine([rollup, legacy]).distinct_customers())
+        state["_rollup"] = legacy
+        report = SalesReport.__new__(SalesReport)
+        report.__setstate__(state)
+        self.assertEqual(report.rollup.top_buyers(), [("Omar", 4), ("Amina", 2)])
+
+    def test_daily_rollups_stay_small_until_customers_fill_the_top_buyers(self):
+        def day(names):
+            return SalesRollup.from_transactions(Transaction(Utils.generate_unique_id(), name, "Child Ticket", 1,
+                                                             185.0, "2024-12-01", "cash") for name in names)
+
+        quiet = day(["Amina", "Omar", "Omar"])
+        self.assertIsNone(quiet.buyer_tickets)
+        self.assertLess(len(pickle.dumps(quiet)), 3000)
+        self.assertEqual(quiet.customer_tickets("Omar"), 2)
+        self.assertEqual(quiet.customer_tickets("Layla"), 0)
+
+        busy = day(f"Visitor {number}" for number in range(constants.SKETCH_TOP_K + 100))
+        self.assertIsNotNone(busy.buyer_tickets)
+        month = SalesRollup.combine([quiet, day(["Omar"] * 3), busy])
+        self.assertIsNotNone(month.buyer_tickets)
+        self.assertEqual(month.customer_tickets("Omar"), 5)  # Exact days are counted into the month's sketch
+        self.assertEqual(month.top_buyers(1), [("Omar", 5)])
+
+
+class TestPaymentGateway(unittest.TestCase):
+    def setUp(self):
+        self.server = SimulatedGatewayServer(latency=(0.01, 0.02), seed=7)
+        self.host, self.port = self.server.start()
+        self.processors = []
+
+    def tearDown(self):
+        for processor in self.processors:
+            processor.stop()
+        self.server.stop()
+
+    def processor(self, **options):
+        gateway = NetworkGatewayAdapter(self.host, self.port, **options)
+        processor = PaymentProcessor({"credit card": gateway, "cash": LocalAdapter(), "coupon": LocalAdapter()})
+        self.processors.append(processor)
+        return processor
+
+    def test_concurrent_payments_share_pooled_connections(self):
+        processor = self.processor(pool_size=4)
+        payments = [Payment(Utils.generate_unique_id(), "credit card") for _ in range(20)]
+        outcomes = processor.submit_many((payment, 50.0) for payment in payments).result()
+        self.assertEqual(outcomes, [True] * 20)
+        self.assertEqual(processor.adapters["credit card"].pool.opened, 4)
+        self.assertEqual(self.server.connections_accepted, 4)
+        self.assertEqual(self.server.requests_handled, 20)
+        self.assertEqual(len({payment.reference for payment in payments}), 20)
+        self.assertTrue(all(payment.status == "Success" for payment in payments))
+
+        # Kiosk payment methods keep their own rules and need no gateway
+        self.assertTrue(processor.process(Payment(Utils.generate_unique_id(), "cash"), 500.0))
+        coupon = Payment(Utils.generate_unique_id(), "coupon")
+        self.assertFalse(processor.process(coupon, 500.0))
+        self.assertEqual(coupon.status, "Failed")
+        self.assertFalse(processor.process(Payment(Utils.generate_unique_id(), "cheque"), 10.0))
+
+    def test_gateway_failures_are_retried_and_declines_reported(self):
+        self.server.failure_rate = 0.5
+        payments = [Payment(Utils.generate_unique_id(), "credit card") for _ in range(10)]
+        outcomes = self.processor(retries=20).submit_many((payment, 50.0) for payment in payments).result()
+        self.assertEqual(outcomes, [True] * 10)
+        self.assertGreater(self.server.requests_handled, 10)
+
+        self.server.failure_rate, self.server.decline_rate = 0.0, 1.0
+        declined = Payment(Utils.generate_unique_id(), "credit card")
+        self.assertFalse(self.processor().process(declined, 50.0))
+        self.assertEqual((declined.status, declined.reference), ("Failed", None))
+
+    def test_lost_replies_are_retried_without_charging_twice(self):
+        self.server.lost_reply_rate = 1.0
+        payment = Payment(Utils.generate_unique_id(), "credit card", idempotency_key="order-3/payment")
+        with self.assertRaisesRegex(GatewayUnavailableError, "may have been taken"):
+            self.processor(retries=2).process(payment, 50.0)
+        self.assertEqual((self.server.requests_handled, self.server.charges), (3, 1))
+
+        # Retrying the purchase with the same key gets the original approval
+        self.server.lost_reply_rate = 0.0
+        retried = Payment(Utils.generate_unique_id(), "credit card", idempotency_key="order-3/payment")
+        self.assertTrue(self.processor().process(retried, 50.0))
+        self.assertEqual((retried.reference, self.server.charges), ("SIM-00000001", 1))
+
+    def test_cli_retry_after_a_lost_reply_reuses_the_order_key(self):
+        previous_backend = DataStorage.use_backend(InMemoryBackend())
+        self.addCleanup(DataStorage.use_backend, previous_backend)
+        DataStorage.save_to_file({
+            ticket_type: {"price": price, "validity": TICKET_VALIDITY[ticket_type], "discount": 0.0}
+            for ticket_type, price in TICKET_PRICES.items()
+        }, FILE_PATH_TICKETS)
+        sys.modules.pop("main", None)  # Load the command line's data from the in-memory backend
+        main = importlib.import_module("main")
+        self.addCleanup(sys.modules.pop, "main", None)
+        main.payments = self.processor(retries=2)
+        user = User(Utils.generate_unique_id(), "Ann", "ann@example.com", "pw")
+        main.users[user.email] = user
+        visit_date = (date.today() + timedelta(days=30)).isoformat()
+        main.input = lambda prompt="": answers.pop(0)
+        self.addCleanup(delattr, main, "input")
+
+        self.server.lost_reply_rate = 1.0
+        answers = ["Single-Day Pass", visit_date, "2", "2"]
+        self.assertIsNone(main.purchase_ticket(user))  # The payment may have been taken
+        self.assertEqual(self.server.charges, 1)
+
+        self.server.lost_reply_rate = 0.0
+        answers = ["Single-Day Pass", visit_date, "2", "2"]
+        receipt = main.purchase_ticket(user)
+        self.assertEqual((receipt["payment_reference"], self.server.charges), ("SIM-00000001", 1))
+        self.assertEqual(len(user.purchase_history), 2)
+
+        # Once completed, ordering the same tickets again is a new purchase
+        answers = ["Single-Day Pass", visit_date, "2", "2"]
+        self.assertEqual(main.purchase_ticket(user)["payment_reference"], "SIM-00000002")
+        self.assertEqual(main.order_keys, {})
+
+    def test_payment_key_reused_for_another_amount_is_rejected(self):
+        processor = self.processor()
+        self.assertTrue(processor.process(Payment(Utils.generate_unique_id(), "credit card", "K/payment"), 100.0))
+        with self.assertRaisesRegex(ValueError, "different amount"):
+            processor.process(Payment(Utils.generate_unique_id(), "credit card", "K/payment"), 5000.0)
+        self.assertEqual(self.server.requests_handled, 1)  # Stopped before reaching the gateway
+
+        # Another kiosk process, which never saw the key, is stopped by the gateway
+        with self.assertRaisesRegex(ValueError, "different amount"):
+            self.processor().process(Payment(Utils.generate_unique_id(), "credit card", "K/payment"), 5000.0)
+        self.assertEqual(self.server.charges, 1)
+
+        # Purchases derive the payment key from what is bought, so changing the order changes the key
+        order = ("ann@example.com", "Single-Day Pass", "2026-12-25", 2, "credit card")
+        self.assertEqual(IdempotencyStore.derive_key("K", "payment", order, 550.0),
+                         IdempotencyStore.derive_key("K", "payment", order, 550.0))
+        self.assertNotEqual(IdempotencyStore.derive_key("K", "payment", order, 550.0),
+                            IdempotencyStore.derive_key("K", "payment", order[:3] + (20, "credit card"), 5500.0))
+
+    def test_unreachable_gateway_raises(self):
+        self.server.stop()
+        payment = Payment(Utils.generate_unique_id(), "credit card")
+        with self.assertRaises(GatewayUnavailableError):
+            self.processor(retries=1).process(payment, 50.0)
+        self.assertEqual(payment.status, "Failed")
+
+
+class TestIdempotency(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "idempotency_keys.pkl")
+        self.store = IdempotencyStore(DataStorage.load_tracked(self.filename), self.filename, wait=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_ttl_cache_expires_and_drops_oldest(self):
+        now = [0.0]
+        cache = TTLCache(capacity=2, ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (None, 2, 3))
+        now[0] = 10.0
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 1)
+
+    def test_retries_return_the_recorded_outcome(self):
+        fingerprint = ("ann@example.com", "Single-Day Pass", "2026-12-25", 2, "cash")
+        self.assertIsNone(self.store.begin("order-1", fingerprint))
+        self.store.end("order-1")  # Failed without an outcome: the next attempt does the work again
+        self.assertIsNone(self.store.begin("order-1", fingerprint))
+        self.store.record("order-1", {"total_price": 550.0}, fingerprint)
+        DataStorage.flush(self.store.records, self.filename)
+        self.store.end("order-1")
+        self.assertEqual(self.store.begin("order-1", fingerprint).result, {"total_price": 550.0})
+        with self.assertRaises(ValueError):
+            self.store.begin("order-1", fingerprint[:3] + (5, "cash"))
+
+        # The outcome survives a restart, until it expires
+        restarted = IdempotencyStore(DataStorage.load_tracked(self.filename), self.filename)
+        self.assertEqual(restarted.begin("order-1").result, {"total_price": 550.0})
+        self.assertEqual(restarted.purge(time.time() + IDEMPOTENCY_TTL_SECONDS), 1)
+        self.assertIsNone(IdempotencyStore(restarted.records, self.filename, ttl=0).begin("order-1"))
+
+    def test_concurrent_retries_do_the_work_once(self):
+        done, outcomes = [], []
+
+        def purchase():
+            completed = self.store.begin("order-2")
+            if completed is not None:
+                outcomes.append(completed.result)
+                return
+            try:
+                time.sleep(0.05)
+                done.append(1)
+                self.store.record("order-2", "receipt")
+                outcomes.append("receipt")
+            finally:
+                self.store.end("order-2")
+
+        threads = [threading.Thread(target=purchase) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(done), 1)
+        self.assertEqual(outcomes, ["receipt"] * 8)
+
 
 if __name__ == '__main__':
     unittest.main()
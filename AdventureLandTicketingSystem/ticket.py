@@ -1,10 +1,17 @@
 from datetime import datetime, timedelta
 
+from record_format import TicketRecordFormat
+from constants import MIN_GROUP_SIZE_FOR_DISCOUNT, TICKET_VALIDITY_DAYS
+from pricing import PricingEngine
+
 class Ticket:
+    __slots__ = ("ticket_id", "ticket_type", "price", "base_price", "validity", "visit_date",
+                 "discount", "default_discount", "validity_start_date", "validity_end_date")
+
     def __init__(self, ticket_id, ticket_type, price, validity, visit_date, default_discount=0.0):
         """
         Initialize a ticket with basic details.
-        :param ticket_id: Unique identifier for the ticket (str).
+        :param ticket_id: Unique identifier for the ticket (int, or str for tickets issued before integer IDs).
         :param ticket_type: Type of the ticket (e.g., Single-Day Pass) (str).
         :param price: Base price of the ticket (float).
         :param validity: Validity duration of the ticket (str).
@@ -21,57 +28,84 @@ class Ticket:
         self.default_discount = default_discount  # Discount from tickets data (set by admin)
         self.validity_start_date = None
         self.validity_end_date = None
-        self.limited_availability = 20  # Default for VIP tickets per day
 
-    def apply_discounts(self, user, num_tickets, payment_method):
-        """Apply discounts based on ticket type and conditions."""
-        # Apply default discount from tickets data
-        if self.default_discount > 0:
-            self.apply_discount(self.default_discount)
+    @classmethod
+    def from_record(cls, record):
+        """
+        Rebuild a ticket from its binary record (see `TicketRecordFormat`).
+        :param record: The encoded record, of any known version (bytes).
+        :return: The ticket (Ticket).
+        """
+        fields, _ = TicketRecordFormat.decode(record)
+        return cls._from_fields(fields)
 
-        # For Two-Day Pass, 10% discount for online purchases
-        if self.ticket_type == "Two-Day Pass" and payment_method in ["net banking", "credit card", "digital wallet"]:
-            self.apply_discount(0.10)
+    @classmethod
+    def from_records(cls, records):
+        """
+        Rebuild tickets from consecutive binary records.
+        :param records: The encoded records (bytes).
+        :return: The tickets (list).
+        """
+        return [cls._from_fields(fields) for fields in TicketRecordFormat.decode_many(records)]
 
-        # For Group Ticket (10+), 20% discount for groups of 20 or more
-        if self.ticket_type == "Group Ticket (10+)" and num_tickets >= 20:
-            self.apply_discount(0.20)
+    @classmethod
+    def _from_fields(cls, fields):
+        ticket = cls.__new__(cls)
+        for name, value in fields.items():
+            setattr(ticket, name, value)
+        return ticket
 
-        # For Annual Membership renewal, 15% discount
-        if self.ticket_type == "Annual Membership":
-            previous_membership = any(
-                t.ticket_type == "Annual Membership" for t in user.purchase_history
-            )
-            if previous_membership:
-                self.apply_discount(0.15)
+    def __reduce_ex__(self, protocol):
+        # Pickle as a compact binary record; fall back to the attribute dictionary
+        # for tickets the record format cannot represent exactly.
+        try:
+            return (Ticket.from_record, (TicketRecordFormat.encode(self),))
+        except ValueError:
+            return super().__reduce_ex__(protocol)
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Ticket.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (__dict__, slots) pair from the default slot pickling
+            dict_state, slot_state = state
+            state = {**(dict_state or {}), **(slot_state or {})}
+        state = TicketRecordFormat.upgrade_legacy_state(state)
+        for name in Ticket.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+
+    def apply_discounts(self, user, num_tickets, payment_method):
+        """
+        Apply discounts based on ticket type and conditions.
+
+        Purchases price tickets with a `PricingEngine` instead; this applies the same rules
+        one by one on top of any discount the ticket already has.
+        """
+        discounts = PricingEngine.discounts(
+            self.ticket_type,
+            self.default_discount,
+            online=payment_method in PricingEngine.ONLINE_PAYMENT_METHODS,
+            large_group=num_tickets >= MIN_GROUP_SIZE_FOR_DISCOUNT,
+            renewal=PricingEngine.is_renewal(user, self.ticket_type)
+        )
+        for discount in discounts:
+            self.apply_discount(discount)
 
     def set_validity_dates(self, user):
         """Set the validity start and end dates based on ticket type."""
         start_date = datetime.strptime(self.visit_date, "%Y-%m-%d").date()
-        if self.ticket_type == "Single-Day Pass":
-            self.validity_start_date = start_date
-            self.validity_end_date = start_date
-        elif self.ticket_type == "Two-Day Pass":
-            self.validity_start_date = start_date
-            self.validity_end_date = start_date + timedelta(days=1)
-        elif self.ticket_type == "Annual Membership":
-            previous_memberships = [t for t in user.purchase_history if t.ticket_type == "Annual Membership"]
-            if previous_memberships:
-                last_membership = max(previous_memberships, key=lambda t: t.validity_end_date)
-                self.validity_start_date = last_membership.validity_end_date + timedelta(days=1)
-                self.validity_end_date = self.validity_start_date + timedelta(days=365)
-            else:
-                self.validity_start_date = start_date
-                self.validity_end_date = start_date + timedelta(days=365)
-        elif self.ticket_type == "Child Ticket":
-            self.validity_start_date = start_date
-            self.validity_end_date = start_date
-        elif self.ticket_type == "VIP Experience Pass":
-            self.validity_start_date = start_date
-            self.validity_end_date = start_date
-        elif self.ticket_type == "Group Ticket (10+)":
-            self.validity_start_date = start_date
-            self.validity_end_date = start_date
+        extra_days = TICKET_VALIDITY_DAYS.get(self.ticket_type)
+        if extra_days is None:
+            return
+        if self.ticket_type == "Annual Membership":
+            # A renewed membership starts the day after the latest one ends
+            last_membership_end = user.latest_membership_end()
+            if last_membership_end is not None:
+                start_date = last_membership_end + timedelta(days=1)
+        self.validity_start_date = start_date
+        self.validity_end_date = start_date + timedelta(days=extra_days)
 
     def apply_discount(self, discount_percentage):
         """Apply a discount to the ticket price."""
@@ -87,8 +121,8 @@ class Ticket:
             raise ValueError("Child Ticket must be accompanied by an adult ticket.")
         if self.ticket_type == "Group Ticket (10+)" and group_size < 10:
             raise ValueError("Group Ticket requires a minimum of 10 tickets.")
-        if self.ticket_type == "VIP Experience Pass" and tickets_sold_today + group_size > self.limited_availability:
-            raise ValueError("VIP Experience Pass is sold out for today.")
+        from inventory import Inventory  # Imported here: inventory imports data_storage, which imports this module
+        Inventory.check_capacity(self.ticket_type, tickets_sold_today, group_size)
 
     def __str__(self):
         discount_str = f" (Discount Applied: {self.discount * 100}%)" if self.discount > 0 else ""
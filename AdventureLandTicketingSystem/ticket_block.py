@@ -0,0 +1,114 @@
+import uuid
+
+from id_generator import SnowflakeIdGenerator
+from record_format import TicketRecordFormat
+from ticket import Ticket
+
+
+def offset_ticket_id(first_id, offset):
+    """
+    Return the ID of the ticket `offset` places after `first_id` in a block.
+
+    Args:
+        first_id (int): The ID of the first ticket of the block. Blocks issued before integer
+            IDs are numbered from a UUID string.
+        offset (int): The position of the ticket in the block.
+
+    Returns:
+        int: The ticket's ID (a UUID string for blocks numbered from one).
+    """
+    if not offset:
+        return first_id
+    if isinstance(first_id, str):
+        return str(uuid.UUID(int=uuid.UUID(first_id).int + offset))
+    return SnowflakeIdGenerator.offset_id(first_id, offset)
+
+
+class TicketBlock:
+    """
+    N identical admissions bought together, stored as one entry.
+
+    The tickets share every field except their IDs, a range reserved from the ID generator
+    that starts at `ticket_id` (see `offset_ticket_id`). Individual tickets are only created when one is asked for (`ticket`, iteration)
+    or split off (`split`), e.g. when it is scanned or refunded.
+    """
+    __slots__ = Ticket.__slots__ + ("quantity",)
+
+    def __init__(self, ticket, quantity, first_id=None):
+        """
+        Initialize a block from a priced ticket.
+
+        Args:
+            ticket (Ticket): The ticket every admission in the block is a copy of (its ID is not used).
+            quantity (int): The number of admissions.
+            first_id (int): The ID of the first admission; a new ID range is reserved if None.
+        """
+        if quantity <= 0:
+            raise ValueError("A ticket block must hold at least one ticket.")
+        for name in Ticket.__slots__:
+            setattr(self, name, getattr(ticket, name))
+        if first_id is None:
+            first_id = SnowflakeIdGenerator.default().reserve(quantity)
+        self.ticket_id = first_id
+        self.quantity = quantity
+
+    def ticket_id_at(self, offset):
+        """Return the ID of the ticket at a position in the block."""
+        if not 0 <= offset < self.quantity:
+            raise IndexError("ticket block index out of range")
+        return offset_ticket_id(self.ticket_id, offset)
+
+    def ticket(self, offset):
+        """
+        Split out the ticket at a position in the block as a standalone `Ticket`.
+
+        Args:
+            offset (int): The position of the ticket in the block.
+
+        Returns:
+            Ticket: The ticket.
+        """
+        ticket = Ticket.__new__(Ticket)
+        for name in Ticket.__slots__:
+            setattr(ticket, name, getattr(self, name))
+        ticket.ticket_id = self.ticket_id_at(offset)
+        return ticket
+
+    def split(self, offset):
+        """
+        Take one ticket out of the block, e.g. to refund it.
+
+        Args:
+            offset (int): The position of the ticket in the block.
+
+        Returns:
+            tuple: (block of the tickets before it or None, the ticket, block of the tickets after it or None).
+        """
+        ticket = self.ticket(offset)
+        before = TicketBlock(self, offset, self.ticket_id) if offset else None
+        after = None
+        if offset + 1 < self.quantity:
+            after = TicketBlock(self, self.quantity - offset - 1, self.ticket_id_at(offset + 1))
+        return before, ticket, after
+
+    def __len__(self):
+        return self.quantity
+
+    def __iter__(self):
+        for offset in range(self.quantity):
+            yield self.ticket(offset)
+
+    def __str__(self):
+        return f"{self.quantity} x {Ticket.__str__(self)}"
+
+    def __reduce_ex__(self, protocol):
+        # Pickle the shared fields as one ticket record
+        try:
+            return (TicketBlock._from_record, (TicketRecordFormat.encode(self), self.quantity))
+        except ValueError:
+            return super().__reduce_ex__(protocol)
+
+    @staticmethod
+    def _from_record(record, quantity):
+        ticket = Ticket.from_record(record)
+        return TicketBlock(ticket, quantity, ticket.ticket_id)
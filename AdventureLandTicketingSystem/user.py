@@ -1,14 +1,40 @@
-class User:
+import constants
+from change_tracking import TrackedRecord
+from purchase_history import PurchaseHistory
+from purchase_history_store import PurchaseHistoryStore
+from purchase_index import PurchaseIndex
+from record_format import TicketRecordFormat
+from ticket import Ticket
+
+class User(TrackedRecord):
     """
     Represents a user in the Adventure Land Theme Park Ticketing System.
 
+    Tickets bought since the user was last saved are tracked, so saving the user
+    writes only those tickets instead of the whole purchase history.
+
+    When the users file is snapshotted, the purchase history is moved into a
+    `PurchaseHistoryStore` and the pickled user keeps only segment offsets. The
+    history is read back on first access and can be evicted again afterwards.
+    A history that is pickled inline is stored as packed ticket records and is
+    likewise only decoded on first access. Decoded histories are kept in a columnar
+    `PurchaseHistory` unless `COLUMNAR_PURCHASE_HISTORY` is turned off.
+
+    Lookups that used to scan the history (ticket counts by type, the latest membership
+    end date, tickets for a visit date) go through a `PurchaseIndex`. It is built on first
+    use, then only indexes tickets appended since, and is never pickled.
+
     Attributes:
-        user_id (str): Unique identifier for the user.
+        user_id (int): Unique identifier for the user.
         name (str): Name of the user.
         email (str): Email address of the user.
         password (str): Password for user authentication.
         purchase_history (list): List of tickets purchased by the user.
     """
+    __slots__ = ("user_id", "name", "email", "password", "_history", "_history_store", "_history_segments",
+                 "_spilled_count", "_unloaded_tail", "_history_records", "_index", "__weakref__")
+    tracked_list = "purchase_history"
+
     def __init__(self, user_id, name, email, password):
         """
         Initialize a User object with basic details.
@@ -17,7 +43,178 @@ class User:
         self.name = name
         self.email = email
         self.password = password
+        self._history_store = None
+        self._history_segments = []  # (offset, length) of segments in the history store
+        self._spilled_count = 0  # Number of leading tickets that are stored in those segments
+        self._unloaded_tail = []
+        self._history_records = None  # Inline history as packed ticket records, not decoded yet
         self.purchase_history = []  # Stores purchased ticket details
+        self._init_tracking()
+
+    @property
+    def purchase_history(self):
+        """The user's tickets, read from the purchase history store on first access."""
+        if self._history is None:
+            columnar = constants.COLUMNAR_PURCHASE_HISTORY
+            if self._history_records is not None:
+                if columnar:
+                    self._history = PurchaseHistory.from_records(self._history_records)
+                else:
+                    self._history = Ticket.from_records(self._history_records)
+                self._history_records = None
+            else:
+                history = PurchaseHistory() if columnar else []
+                self._history_store.read(self._history_segments, history)
+                history.extend(self._unloaded_tail)
+                self._history = history
+                self._unloaded_tail = []
+        return self._history
+
+    @purchase_history.setter
+    def purchase_history(self, history):
+        self._history = history
+        self._index = None
+        self._history_segments = []
+        self._spilled_count = 0
+        self._unloaded_tail = []
+        self._history_records = None
+
+    @property
+    def purchase_index(self):
+        """The `PurchaseIndex` of the purchase history, brought up to date with appended tickets."""
+        if self._index is None:
+            self._index = PurchaseIndex()
+        self._index.update(self.purchase_history)
+        return self._index
+
+    def count_tickets(self, *ticket_types):
+        """Return the number of purchased tickets of the given types."""
+        return self.purchase_index.count(*ticket_types)
+
+    def latest_membership_end(self):
+        """Return the latest validity end date of the user's Annual Memberships, or None."""
+        return self.purchase_index.latest_membership_end
+
+    def tickets_for_visit_date(self, visit_date):
+        """Return the purchased tickets for a visit date (YYYY-MM-DD), in purchase order."""
+        index = self.purchase_index
+        history = self.purchase_history
+        rows = index.rows_by_visit_date.get(visit_date, ())
+        if not isinstance(history, PurchaseHistory):
+            return [history[row] for row in rows]
+        return [ticket for row in rows for ticket in history.row_tickets(row)]
+
+    def is_history_loaded(self):
+        """Return True if the purchase history is currently held in memory."""
+        return self._history is not None
+
+    def evict_purchase_history(self, filename=None):
+        """
+        Drop the in-memory purchase history, first moving the tickets that are only in memory
+        (e.g. bought this session) into the history store.
+
+        Unsaved tickets stay pending, so the next save still logs them; the new segment only
+        becomes part of the users file with its next snapshot.
+
+        Args:
+            filename (str): The users file, whose history store is used if the user has none yet.
+
+        Returns:
+            bool: True if the history was evicted, False if there is no history store to move it to.
+        """
+        if self._history is None:
+            return True
+        store = self._history_store
+        if store is None:
+            if filename is None:
+                return False
+            store = self._history_store = PurchaseHistoryStore.for_users_file(filename)
+        if self._spill(store):
+            store.sync()  # A saved copy of the user may refer to the segment before the next snapshot
+        self._history = None
+        self._index = None  # Segments hold a row per ticket, so a block pages back in as several rows
+        return True
+
+    def _spill(self, store):
+        history = self._history
+        if len(history) <= self._spilled_count:
+            return False
+        self._history_segments.append(store.append(history[self._spilled_count:]))
+        self._spilled_count = len(history)
+        return True
+
+    def after_load(self, filename):
+        """Attach the purchase history store of the users file this user was loaded from."""
+        if self._history_segments and self._history_store is None:
+            self._history_store = PurchaseHistoryStore.for_users_file(filename)
+
+    def before_snapshot(self, filename):
+        """
+        Move tickets that are only in memory into the history store of the users file being written.
+
+        Args:
+            filename (str): The path of the users file.
+
+        Returns:
+            PurchaseHistoryStore: The store that must be synced before the snapshot is renamed into place.
+        """
+        store = PurchaseHistoryStore.for_users_file(filename)
+        if self._history_store is None and self._history_segments:
+            self._history_store = store
+        if self._history_store is not store:
+            # Segments of another store are not valid here; rewrite the whole history
+            self.purchase_history  # Read it from the old store first
+            self._history_store = store
+            self._history_segments = []
+            self._spilled_count = 0
+        elif self._history is None and not self._unloaded_tail:
+            return store
+        else:
+            self.purchase_history  # Page in the history and any unloaded tail
+        self._spill(store)
+        return store
+
+    def same_record(self, other):
+        """Two copies of a user are the same account if they share the user ID."""
+        return isinstance(other, User) and other.user_id == self.user_id
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("_history_store", None)
+        state.pop("_index", None)
+        history = state.pop("_history")
+        records = state.pop("_history_records", None)
+        if not state["_history_segments"]:
+            # Not moved to a history store yet: pickle the history inline
+            state.pop("_history_segments")
+            state.pop("_spilled_count")
+            state.pop("_unloaded_tail")
+            if history is None:
+                state["_history_records"] = records
+                return state
+            try:
+                if isinstance(history, PurchaseHistory):
+                    state["_history_records"] = history.to_records()
+                else:
+                    state["_history_records"] = TicketRecordFormat.encode_many(history)
+            except ValueError:
+                state["purchase_history"] = list(history)  # As older versions did
+        elif history is not None:
+            state["_unloaded_tail"] = history[self._spilled_count:]
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        history = state.pop("purchase_history", [])
+        records = state.pop("_history_records", None)
+        state.setdefault("_history_segments", [])
+        state.setdefault("_spilled_count", 0)
+        state.setdefault("_unloaded_tail", [])
+        super().__setstate__(state)
+        self._history_store = None
+        self._history_records = records
+        self._history = None if self._history_segments or records is not None else history
+        self._index = None
 
     def create_account(self, name, email, password):
         """
@@ -35,12 +232,11 @@ class User:
         return self.email == email and self.password == password
 
     def load_purchase_history(self, history):
-        updated_history = []
-        for ticket in history:
-            if not hasattr(ticket, "visit_date"):
-                ticket.visit_date = "Unknown"
-            updated_history.append(ticket)
-        self.purchase_history = updated_history
+        """
+        Replace the purchase history. Tickets saved by older versions are upgraded when unpickled.
+        """
+        if history is not self.purchase_history:
+            self.purchase_history = list(history)
 
     def view_purchase_history(self):
         if not self.purchase_history:
@@ -48,13 +244,39 @@ class User:
             return
         print("\nPurchase History:")
         for ticket in self.purchase_history:
-            visit_date = getattr(ticket, "visit_date", "Unknown")
             print(f"{ticket.ticket_type} - Price: {ticket.price} DHS, "
-                f"Validity: {ticket.validity}, Visit Date: {visit_date}")
+                f"Validity: {ticket.validity}, Visit Date: {ticket.visit_date}")
 
     def purchase_ticket(self, ticket):
         """
         Add a ticket to purchase history.
         """
         self.purchase_history.append(ticket)
+        self.record_appended([ticket])
         print(f"Ticket '{ticket}' purchased successfully.")
+
+    def purchase_block(self, block):
+        """
+        Add a block of identical tickets to purchase history as a single entry.
+
+        With `COLUMNAR_PURCHASE_HISTORY` the block takes one row of the history and one change
+        in the write-ahead log; otherwise its tickets are added one by one.
+
+        Args:
+            block (TicketBlock): The tickets bought together.
+
+        Returns:
+            None
+        """
+        history = self.purchase_history
+        if constants.COLUMNAR_PURCHASE_HISTORY and not isinstance(history, PurchaseHistory):
+            # Keep the segments already spilled to the history store
+            history = self._history = PurchaseHistory(history)
+        if isinstance(history, PurchaseHistory):
+            history.append(block)
+            self.record_appended([block])
+        else:
+            tickets = list(block)
+            history.extend(tickets)
+            self.record_appended(tickets)
+        print(f"Tickets '{block}' purchased successfully.")
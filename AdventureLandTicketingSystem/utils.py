@@ -1,7 +1,12 @@
 import re
-import uuid
 from datetime import date, datetime
 
+from id_generator import SnowflakeIdGenerator
+
+# Crockford's base 32: IDs shown to people sort the same way as the numbers
+ID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ID_TEXT_LENGTH = 13
+
 class Utils:
     @staticmethod
     def validate_email(email):
@@ -16,10 +21,42 @@ class Utils:
     @staticmethod
     def generate_unique_id():
         """
-        Generate a unique identifier for objects.
-        :return: A unique identifier string.
+        Generate a unique, time-sortable identifier for objects (see `SnowflakeIdGenerator`).
+        :return: A unique identifier (int).
+        """
+        return SnowflakeIdGenerator.default().next_id()
+
+    @staticmethod
+    def format_id(identifier):
+        """
+        Format an identifier for display.
+        :param identifier: An ID from `generate_unique_id` (int), or an older UUID string (str).
+        :return: 13 base 32 characters for integer IDs; other IDs unchanged (str).
+        """
+        if not isinstance(identifier, int):
+            return str(identifier)
+        characters = []
+        for _ in range(ID_TEXT_LENGTH):
+            identifier, digit = divmod(identifier, 32)
+            characters.append(ID_ALPHABET[digit])
+        return "".join(reversed(characters))
+
+    @staticmethod
+    def parse_id(text):
+        """
+        Read back an identifier shown by `format_id`.
+        :param text: The displayed identifier (str).
+        :return: The integer ID, or the text itself for older UUID identifiers (int or str).
         """
-        return str(uuid.uuid4())
+        if len(text) != ID_TEXT_LENGTH:
+            return text
+        identifier = 0
+        for character in text.upper():
+            digit = ID_ALPHABET.find(character)
+            if digit < 0:
+                return text
+            identifier = identifier * 32 + digit
+        return identifier
 
     @staticmethod
     def calculate_discounted_price(base_price, discount_percentage):
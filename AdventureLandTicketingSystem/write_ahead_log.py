@@ -0,0 +1,401 @@
+import contextlib
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+import constants
+from file_lock import FileLock
+
+
+class WriteAheadLog:
+    """
+    An append-only change log that sits next to a pickled data file.
+
+    Instead of re-pickling a whole dictionary after every change, callers append
+    only the records that changed. Each append is written as one framed batch
+    (log sequence number + length + CRC32 + pickled list of changes) so a torn
+    write at the end of the log is detected and discarded on replay.
+
+    The log starts with a small header holding the sequence number of the last
+    batch already folded into the snapshot. Batches at or below the snapshot's
+    checkpoint are skipped on replay, which makes compaction safe to interrupt.
+
+    A change is a tuple whose first element is the operation:
+        ("set", key, value)               -> data[key] = value
+        ("extend", key, attribute, items) -> getattr(data[key], attribute).extend(items)
+        ("delete", key)                   -> data.pop(key, None)
+
+    With `constants.SHARED_DATA_DIRECTORY` set, `lock()` also locks '<filename>.lock'
+    so that writers in other processes are excluded, and the cached last sequence
+    number is checked against the file before it is reused.
+    """
+    SET = "set"
+    EXTEND = "extend"
+    DELETE = "delete"
+
+    MAGIC = b"ALWAL\x00\x00\x01"
+    FILE_HEADER = struct.Struct("<8sQ")  # magic, base sequence number
+    HEADER = struct.Struct("<QII")  # sequence number, payload length, CRC32 of sequence number + payload
+
+    _locks = {}
+    _last_lsn = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, filename):
+        """
+        Initialize a log bound to a data file.
+
+        Args:
+            filename (str): The path of the data file the log belongs to. The log itself
+                is stored as '<filename>.wal'.
+        """
+        self.filename = filename
+        self.path = WriteAheadLog.log_path(filename)
+
+    @staticmethod
+    def log_path(filename):
+        """
+        Return the path of the log file that belongs to a data file.
+
+        Args:
+            filename (str): The path of the data file.
+
+        Returns:
+            str: The path of the log file.
+        """
+        return f"{filename}.wal"
+
+    @staticmethod
+    def set_record(key, value):
+        """Build a change that stores a whole record under a key."""
+        return (WriteAheadLog.SET, key, value)
+
+    @staticmethod
+    def extend_record(key, attribute, items):
+        """Build a change that appends items to a list attribute of an existing record."""
+        return (WriteAheadLog.EXTEND, key, attribute, list(items))
+
+    @staticmethod
+    def delete_record(key):
+        """Build a change that removes a record."""
+        return (WriteAheadLog.DELETE, key)
+
+    @staticmethod
+    def apply_change(data, change):
+        """
+        Apply a single change to an in-memory dictionary.
+
+        Args:
+            data (dict): The dictionary being rebuilt.
+            change (tuple): The change to apply.
+
+        Returns:
+            None
+        """
+        op = change[0]
+        if op == WriteAheadLog.SET:
+            data[change[1]] = change[2]
+        elif op == WriteAheadLog.EXTEND:
+            record = data.get(change[1])
+            if record is None:
+                raise ValueError(f"Cannot extend missing record '{change[1]}'.")
+            getattr(record, change[2]).extend(change[3])
+        elif op == WriteAheadLog.DELETE:
+            data.pop(change[1], None)
+        else:
+            raise ValueError(f"Unknown log operation '{op}'.")
+
+    def lock(self):
+        """
+        Return the lock that serializes writers of this log.
+
+        Returns:
+            threading.RLock or FileLock: The lock shared by every `WriteAheadLog` for the same file,
+                which also excludes other processes when the data directory is shared.
+        """
+        if constants.SHARED_DATA_DIRECTORY:
+            return FileLock.for_path(f"{self.filename}.lock")
+        with WriteAheadLog._registry_lock:
+            return WriteAheadLog._locks.setdefault(self.path, threading.RLock())
+
+    @staticmethod
+    def frame(lsn, changes):
+        """
+        Encode a batch of changes as one log frame.
+
+        Args:
+            lsn (int): The sequence number of the batch.
+            changes (list): The changes in the batch.
+
+        Returns:
+            bytes: The encoded frame.
+        """
+        payload = pickle.dumps(list(changes), protocol=pickle.HIGHEST_PROTOCOL)
+        checksum = zlib.crc32(payload, zlib.crc32(struct.pack("<Q", lsn)))
+        return WriteAheadLog.HEADER.pack(lsn, len(payload), checksum) + payload
+
+    def append(self, changes):
+        """
+        Append a batch of changes to the log and flush it to disk.
+
+        Args:
+            changes (list): The changes to append. They are replayed together or not at all.
+
+        Returns:
+            int: The sequence number given to the batch.
+        """
+        return self.append_batches([changes])[-1]
+
+    def append_batches(self, batches):
+        """
+        Append several batches with a single write and a single fsync.
+
+        Args:
+            batches (list): Lists of changes; each list keeps its own sequence number and is
+                replayed all-or-nothing.
+
+        Returns:
+            list: The sequence numbers given to the batches, in order.
+        """
+        with self.lock():
+            first = self.last_lsn() + 1
+            lsns = list(range(first, first + len(batches)))
+            self.write_frames(b"".join(WriteAheadLog.frame(lsn, changes) for lsn, changes in zip(lsns, batches)))
+            if lsns:
+                WriteAheadLog._last_lsn[self.path] = (lsns[-1], self._stamp())
+            return lsns
+
+    def write_frames(self, frames):
+        """
+        Write already encoded frames at the end of the log and fsync them. The caller must hold `lock()`.
+
+        Args:
+            frames (bytes): One or more frames built with `frame`.
+
+        Returns:
+            None
+        """
+        if not os.path.exists(self.path):
+            self.reset(0)
+        with open(self.path, 'ab') as file:
+            file.write(frames)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def last_lsn(self):
+        """
+        Return the sequence number of the last batch in the log.
+
+        Returns:
+            int: The sequence number, or the log's base sequence number if it holds no batches.
+        """
+        with self.lock():
+            cached = WriteAheadLog._last_lsn.get(self.path)
+            stamp = self._stamp()
+            if cached is None or cached[1] != stamp:
+                # Unknown, or the file changed under us (another process appended or compacted it)
+                last, start = self.base_lsn(), None
+                if cached is not None and cached[1] and stamp and cached[1][0] == stamp[0] and stamp[1] > cached[1][1]:
+                    last, start = cached[0], cached[1][1]
+                for lsn, _, _ in self._scan(start=start, read_payloads=False):
+                    last = lsn
+                cached = (last, stamp)
+                WriteAheadLog._last_lsn[self.path] = cached
+            return cached[0]
+
+    def file_id(self):
+        """
+        Return an identifier of the current log file that changes whenever the log is rewritten.
+
+        Returns:
+            tuple: (device, inode) of the log file, or None if it does not exist.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_dev, stat.st_ino)
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return ((stat.st_dev, stat.st_ino), stat.st_size)
+
+    def base_lsn(self):
+        """Return the sequence number the log starts after (0 if the log does not exist)."""
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as file:
+            header = file.read(WriteAheadLog.FILE_HEADER.size)
+        if len(header) < WriteAheadLog.FILE_HEADER.size:
+            return 0
+        magic, base = WriteAheadLog.FILE_HEADER.unpack(header)
+        if magic != WriteAheadLog.MAGIC:
+            raise ValueError(f"{self.path} is not a write-ahead log.")
+        return base
+
+    def _scan(self, end=None, read_payloads=True, start=None):
+        """Yield (lsn, changes, frame end offset) for complete frames; changes is None when payloads are skipped."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as file:
+            file.seek(WriteAheadLog.FILE_HEADER.size if start is None else start)
+            while end is None or file.tell() < end:
+                header = file.read(WriteAheadLog.HEADER.size)
+                if len(header) < WriteAheadLog.HEADER.size:
+                    break
+                lsn, length, checksum = WriteAheadLog.HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length or zlib.crc32(payload, zlib.crc32(struct.pack("<Q", lsn))) != checksum:
+                    break
+                if read_payloads:
+                    yield lsn, pickle.loads(payload), file.tell()
+                else:
+                    yield lsn, None, file.tell()
+
+    def read_batches(self, end=None, repair=False):
+        """
+        Read every complete batch from the log.
+
+        Args:
+            end (int): Stop at this byte offset (defaults to the end of the file).
+            repair (bool): Cut off a partially written or corrupted batch at the end of the log
+                so later appends are not hidden behind it.
+
+        Returns:
+            list: (sequence number, changes) pairs in the order they were written.
+        """
+        with self.lock() if repair else contextlib.nullcontext():
+            batches = []
+            valid_end = WriteAheadLog.FILE_HEADER.size
+            for lsn, changes, offset in self._scan(end):
+                batches.append((lsn, changes))
+                valid_end = offset
+
+            if repair and os.path.exists(self.path) and os.path.getsize(self.path) > valid_end:
+                print(f"Discarding incomplete entries at the end of {self.path}.")
+                os.truncate(self.path, valid_end)
+                WriteAheadLog._last_lsn.pop(self.path, None)
+            return batches
+
+    def read_from(self, start):
+        """
+        Read the complete batches written after a known position, cutting off a torn batch at the end.
+
+        The caller must hold `lock()`, so no writer can be in the middle of an append.
+
+        Args:
+            start (int): Byte offset just past a batch that was already read.
+
+        Returns:
+            tuple: (list of (sequence number, changes) pairs, byte offset just past the last complete batch).
+        """
+        batches = []
+        valid_end = start
+        for lsn, changes, offset in self._scan(start=start):
+            batches.append((lsn, changes))
+            valid_end = offset
+        if os.path.exists(self.path) and os.path.getsize(self.path) > valid_end:
+            print(f"Discarding incomplete entries at the end of {self.path}.")
+            os.truncate(self.path, valid_end)
+            WriteAheadLog._last_lsn.pop(self.path, None)
+        return batches, valid_end
+
+    def replay(self, data, after_lsn=0, versions=None):
+        """
+        Apply logged changes on top of a loaded snapshot.
+
+        Args:
+            data (dict): The snapshot loaded from the data file.
+            after_lsn (int): The snapshot's checkpoint; batches at or below it are already in the snapshot.
+            versions (dict): If given, updated with the sequence number of the last change of each key.
+
+        Returns:
+            int: The number of changes applied.
+        """
+        applied = 0
+        for lsn, batch in self.read_batches(repair=True):
+            if lsn <= after_lsn:
+                continue
+            for change in batch:
+                WriteAheadLog.apply_change(data, change)
+                if versions is not None:
+                    WriteAheadLog.record_version(versions, change, lsn)
+                applied += 1
+        return applied
+
+    @staticmethod
+    def record_version(versions, change, lsn):
+        """
+        Note in a key -> sequence number map that a change to a key was written at `lsn`.
+
+        Args:
+            versions (dict): The map to update.
+            change (tuple): The change.
+            lsn (int): The sequence number of the batch holding the change.
+
+        Returns:
+            None
+        """
+        if change[0] == WriteAheadLog.DELETE:
+            versions.pop(change[1], None)
+        else:
+            versions[change[1]] = lsn
+
+    def size(self):
+        """Return the number of bytes of batches in the log."""
+        if not os.path.exists(self.path):
+            return 0
+        return max(os.path.getsize(self.path) - WriteAheadLog.FILE_HEADER.size, 0)
+
+    def end_offset(self):
+        """Return the current end of the log file in bytes."""
+        return os.path.getsize(self.path) if os.path.exists(self.path) else WriteAheadLog.FILE_HEADER.size
+
+    def reset(self, base_lsn):
+        """
+        Start an empty log after a snapshot has absorbed every batch up to `base_lsn`.
+
+        Args:
+            base_lsn (int): The checkpoint sequence number of the new snapshot.
+
+        Returns:
+            None
+        """
+        self.truncate_before(None, base_lsn)
+
+    def truncate_before(self, offset, base_lsn):
+        """
+        Drop the batches before `offset` once a snapshot contains them, keeping anything appended later.
+
+        The shortened log is written to a temporary file and renamed over the old one.
+
+        Args:
+            offset (int): Byte offset of the first batch to keep, or None to drop everything.
+            base_lsn (int): The checkpoint sequence number of the snapshot that absorbed the dropped batches.
+
+        Returns:
+            None
+        """
+        with self.lock():
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            tail = b""
+            if offset is not None and os.path.exists(self.path):
+                with open(self.path, 'rb') as file:
+                    file.seek(offset)
+                    tail = file.read()
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(WriteAheadLog.FILE_HEADER.pack(WriteAheadLog.MAGIC, base_lsn))
+                file.write(tail)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            WriteAheadLog._last_lsn.pop(self.path, None)
+